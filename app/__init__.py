@@ -1,6 +1,15 @@
 from app.oai_pmh_client import OAIPMHClient
+from app.oai_pmh_transport import PooledHTTPTransport
+from app.oai_pmh_cache import CachingTransport
+from app.digest_index import DigestIndex
+from app.disk_budget import DiskBudget
+from app.download_cache import DownloadCache
 from app.download_client import DownloadClient
+from app.download_client import DownloadResult
+from app.download_client import DownloadTimeoutError
+from app.download_client import IncompleteDownloadError
 from app.dynamodb_client import DynamoDBClient
+from app.harvest_window_planner import HarvestWindowPlanner
 from app.kinesis_client import KinesisClient
 from app.message_generator import MessageGenerator
 from app.message_validator import MessageValidator
@@ -9,8 +18,17 @@ from app.s3_client import S3Client
 
 __all__ = [
     'OAIPMHClient',
+    'PooledHTTPTransport',
+    'CachingTransport',
+    'DigestIndex',
+    'DiskBudget',
+    'DownloadCache',
     'DownloadClient',
+    'DownloadResult',
+    'DownloadTimeoutError',
+    'IncompleteDownloadError',
     'DynamoDBClient',
+    'HarvestWindowPlanner',
     'KinesisClient',
     'MessageGenerator',
     'MessageValidator',
@@ -0,0 +1,68 @@
+import logging
+
+from threading import Lock
+
+
+class BucketIndex(object):
+    """ The size and ETag of the objects in an S3 bucket, so that a file the bucket already holds
+        isn't uploaded again. Rather than a HEAD request for each object, the objects under a
+        prefix are listed together the first time one of them is looked up, and the index is
+        kept up to date with the objects uploaded since.
+        """
+
+    def __init__(self, client, bucket_name):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.objects = {}
+        self.listed_prefixes = set()
+        self.hits = 0
+        self.lock = Lock()
+        # One lock for each prefix, held while it's listed, so that it's only listed once
+        # without holding up lookups under other prefixes.
+        self.prefix_locks = {}
+
+    def __str__(self):
+        return 'BucketIndex({} objects under {} prefixes, {} hits)'.format(
+            len(self.objects), len(self.listed_prefixes), self.hits)
+
+    def get(self, object_key):
+        """ Returns the size and ETag of the object with the given key as a dict, or None if
+            there is no such object.
+            """
+        prefix = self._prefix(object_key)
+        with self.lock:
+            prefix_lock = self.prefix_locks.setdefault(prefix, Lock())
+        with prefix_lock:
+            with self.lock:
+                listed = prefix in self.listed_prefixes
+            if not listed:
+                objects = self._list_prefix(prefix)
+                with self.lock:
+                    for key, listed_object in objects.items():
+                        # An object uploaded while its prefix was listed is already up to date.
+                        self.objects.setdefault(key, listed_object)
+                    self.listed_prefixes.add(prefix)
+        with self.lock:
+            return self.objects.get(object_key)
+
+    def put(self, object_key, size, etag):
+        with self.lock:
+            self.objects[object_key] = {'Size': size, 'ETag': etag}
+
+    def record_hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def _list_prefix(self, prefix):
+        logging.info('Listing objects with prefix [%s] in S3 Bucket [%s]', prefix,
+                     self.bucket_name)
+        paginator = self.client.get_paginator('list_objects_v2')
+        objects = {}
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for listed in page.get('Contents', []):
+                objects[listed['Key']] = {'Size': listed['Size'], 'ETag': listed['ETag']}
+        return objects
+
+    def _prefix(self, object_key):
+        prefix = object_key.rpartition('/')[0]
+        return prefix + '/' if prefix else ''
@@ -0,0 +1,41 @@
+import logging
+
+from threading import Lock
+
+
+class DigestIndex(object):
+    """ Remembers which content-addressed objects are already in the S3 bucket, along with their
+        ETags, so that a file that was pushed for one record isn't uploaded again for another.
+        Objects are remembered in memory, and, given a `DynamoDBClient` with a digest table,
+        shared with other runs of the adaptor.
+        """
+
+    def __init__(self, dynamodb_client=None):
+        self.dynamodb_client = dynamodb_client
+        self.etags = {}
+        self.hits = 0
+        self.lock = Lock()
+
+    def __str__(self):
+        return 'DigestIndex({} objects, {} hits)'.format(len(self.etags), self.hits)
+
+    def get(self, object_key):
+        """ Returns the ETag of the object with the given key, or None if it isn't known to be in
+            the bucket.
+            """
+        with self.lock:
+            etag = self.etags.get(object_key)
+        if etag is None and self.dynamodb_client is not None:
+            etag = self.dynamodb_client.fetch_digest_etag(object_key)
+        if etag is not None:
+            with self.lock:
+                self.etags[object_key] = etag
+                self.hits += 1
+            logging.info('Found object [%s] in digest index', object_key)
+        return etag
+
+    def put(self, object_key, etag):
+        with self.lock:
+            self.etags[object_key] = etag
+        if self.dynamodb_client is not None:
+            self.dynamodb_client.update_digest_etag(object_key, etag)
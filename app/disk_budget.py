@@ -0,0 +1,76 @@
+import logging
+
+from threading import Condition
+
+
+class DiskReservation(object):
+    """ Room reserved on disk for one download, given back when the file is removed.
+        """
+
+    def __init__(self, budget, size):
+        self.budget = budget
+        self.size = size
+        self.released = False
+
+    def __repr__(self):
+        return 'DiskReservation({} bytes)'.format(self.size)
+
+    def covers(self, size):
+        return self.budget.budgeted_size(size) <= self.size
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.budget.release(self.size)
+
+
+class DiskBudget(object):
+    """ Limits how many bytes the downloads in flight may write to disk between them. A download
+        reserves room for its whole file before writing any of it, waiting until enough has been
+        released by others if necessary. A file bigger than the whole budget, or of unknown size,
+        reserves the whole budget, so it only runs once nothing else is on disk.
+        """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.reserved_bytes = 0
+        self.condition = Condition()
+
+    def __str__(self):
+        return 'DiskBudget({} of {} bytes reserved)'.format(self.reserved_bytes, self.max_bytes)
+
+    def try_reserve(self, size):
+        """ Reserves room for a file of `size` bytes, or None if unknown, returning the
+            `DiskReservation`, or None if there isn't room right now.
+            """
+        size = self.budgeted_size(size)
+        with self.condition:
+            if not self._fits(size):
+                return None
+            self.reserved_bytes += size
+        return DiskReservation(self, size)
+
+    def reserve(self, size, timeout=None):
+        """ Reserves room for a file of `size` bytes, or None if unknown, waiting until there is
+            room for it, or returning None if there still isn't after `timeout` seconds.
+            """
+        size = self.budgeted_size(size)
+        with self.condition:
+            if not self._fits(size):
+                logging.info('Waiting for [%s] bytes of disk, [%s] of [%s] bytes reserved', size,
+                             self.reserved_bytes, self.max_bytes)
+                if not self.condition.wait_for(lambda: self._fits(size), timeout):
+                    return None
+            self.reserved_bytes += size
+        return DiskReservation(self, size)
+
+    def release(self, size):
+        with self.condition:
+            self.reserved_bytes -= size
+            self.condition.notify_all()
+
+    def budgeted_size(self, size):
+        return self.max_bytes if size is None else min(size, self.max_bytes)
+
+    def _fits(self, size):
+        return self.reserved_bytes + size <= self.max_bytes
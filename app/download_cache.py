@@ -0,0 +1,73 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+ENTRY_SUFFIX = '.json'
+
+
+class DownloadCache(object):
+    """ Remembers, for each file URL pushed to S3, the ETag and Last-Modified validators the
+        repository sent with it and the S3 object it was pushed to. A later download of the same
+        URL can then ask the repository whether the file has changed, and if it hasn't, use the
+        S3 object again rather than transferring the file.
+        """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __str__(self):
+        return 'DownloadCache({}, {} hits)'.format(self.cache_dir, self.hits)
+
+    def get(self, url):
+        try:
+            with open(self._entry_path(url)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # Guard against the unlikely case of two URLs with the same digest.
+        return entry if entry.get('url') == url else None
+
+    def conditional_headers(self, url):
+        """ Returns the headers that ask the repository to only send the file at `url` if it has
+            changed since it was cached.
+            """
+        entry = self.get(url)
+        headers = {}
+        if entry is not None:
+            if entry.get('etag') is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified') is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def s3_object(self, url):
+        entry = self.get(url)
+        if entry is None:
+            return None
+        logging.info('File [%s] is unchanged since it was pushed to [%s]', url,
+                     entry['s3_object']['download_url'])
+        self.hits += 1
+        return entry['s3_object']
+
+    def put(self, url, etag, last_modified, s3_object):
+        # Without a validator there's no way to ask whether the file has changed.
+        if etag is None and last_modified is None:
+            return
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            's3_object': s3_object
+        }
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temp_path, self._entry_path(url))
+
+    def _entry_path(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + ENTRY_SUFFIX)
@@ -1,27 +1,635 @@
+import base64
+import functools
+import hashlib
+import io
+import json
 import logging
 import math
 import os
+import random
 import requests
 import tempfile
+import time
 
-from tqdm import tqdm
+from collections import Counter, OrderedDict, deque
+from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from urllib.parse import urlparse
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+# The longest a download will wait before retrying, whatever a server's Retry-After header asks.
+MAX_RETRY_AFTER = 60
+# The errors raised when a response body stops short.
+READ_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+               ProtocolError, ReadTimeoutError)
+PARTIAL_SUFFIX = '.download'
+STATE_SUFFIX = '.json'
+
+
+class IncompleteDownloadError(IOError):
+    """ Raised when the body of a download stops short, leaving a partial file to resume from.
+        """
+    pass
+
+
+class StalledDownloadError(IncompleteDownloadError):
+    """ Raised when a download is making too little progress to be worth waiting for.
+        """
+    pass
+
+
+class DownloadTimeoutError(IOError):
+    """ Raised when a download is still running when its deadline passes.
+        """
+    pass
+
+
+class TransferWatchdog(object):
+    """ Checks on the progress of a transfer as each chunk arrives, aborting it once `deadline`
+        has passed, or if it has averaged less than `min_rate` bytes a second over a window of
+        `window_seconds`. A transfer that stops altogether is left to the read timeout.
+        """
+
+    def __init__(self, url, min_rate=0, window_seconds=60, deadline=None):
+        self.url = url
+        self.min_rate = min_rate
+        self.window_seconds = window_seconds
+        self.deadline = deadline
+        self.window_start = time.time()
+        self.window_bytes = 0
+
+    def check(self, byte_count):
+        now = time.time()
+        if self.deadline is not None and now > self.deadline:
+            raise DownloadTimeoutError('Download of %s ran past its deadline' % self.url)
+        self.window_bytes += byte_count
+        elapsed_seconds = now - self.window_start
+        if elapsed_seconds < self.window_seconds:
+            return
+        if self.window_bytes < self.min_rate * elapsed_seconds:
+            raise StalledDownloadError(
+                'Download of %s stalled at %.1f bytes a second over %.0f seconds' %
+                (self.url, self.window_bytes / elapsed_seconds, elapsed_seconds))
+        self.window_start, self.window_bytes = now, 0
+
+
+class WatchedReader(object):
+    """ A file-like wrapper around a response body, such as one being streamed to S3, that checks
+        on the transfer with a `TransferWatchdog` as it is read. Once the body ends, its length is
+        checked against `expected_size`, if known, and passed to `on_complete`.
+        """
+
+    def __init__(self, stream, watchdog, expected_size=None, on_complete=None):
+        self.stream = stream
+        self.watchdog = watchdog
+        self.expected_size = expected_size
+        self.on_complete = on_complete
+        self.bytes_read = 0
+        self.complete = False
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.watchdog.check(len(data))
+        self.bytes_read += len(data)
+        if not data and size != 0 and not self.complete:
+            # A connection dropped early may just look like the end of the body.
+            if self.expected_size is not None and self.bytes_read != self.expected_size:
+                raise IncompleteDownloadError('Download of %s ended after %s of %s bytes' % (
+                    self.watchdog.url, self.bytes_read, self.expected_size))
+            self.complete = True
+            if self.on_complete is not None:
+                self.on_complete(self.bytes_read)
+        return data
+
+
+class PartDigests(object):
+    """ The MD5 digests of each `part_size` bytes of a file, calculated alongside its other
+        digests, so that the ETag S3 gives a multipart upload of the file can be worked out
+        without reading it again.
+        """
+
+    name = 'parts'
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.digests = []
+        self.part = hashlib.md5()
+        self.part_written = 0
+
+    def update(self, data):
+        data = memoryview(data)
+        while len(data):
+            count = min(len(data), self.part_size - self.part_written)
+            self.part.update(data[:count])
+            self.part_written += count
+            data = data[count:]
+            if self.part_written == self.part_size:
+                self.digests.append(self.part.digest())
+                self.part = hashlib.md5()
+                self.part_written = 0
+
+    def part_md5s(self):
+        # The last part is whatever is left over.
+        return self.digests + ([self.part.digest()] if self.part_written else [])
+
+
+class DownloadResult(object):
+    """ A file downloaded to local disk, with its size and digests calculated as it was written.
+        `md5` is base64 encoded, as S3 expects, and `sha256` is hex encoded, or None unless the
+        download client was asked for SHA-256 digests. `part_digests` are the `PartDigests` of
+        the file, or None unless the download client was given a part size. `etag` and
+        `last_modified` are the validators the server sent with the file, if any.
+
+        A small file may have been kept in memory instead, in which case `file_path` is None and
+        `data` holds its bytes. If the server said the file hasn't changed since it was cached,
+        nothing is downloaded and `s3_object` is the S3 object the file was pushed to before.
+        """
+
+    def __init__(self, file_path, file_size, md5, sha256=None, etag=None, last_modified=None,
+                 s3_object=None, data=None, part_digests=None):
+        self.file_path = file_path
+        self.file_size = file_size
+        self.md5 = md5
+        self.sha256 = sha256
+        self.part_digests = part_digests
+        self.etag = etag
+        self.last_modified = last_modified
+        self.s3_object = s3_object
+        self.data = data
+        # The room on disk reserved for the file, if the downloads have a disk budget.
+        self.reservation = None
+
+    @classmethod
+    def unchanged(cls, s3_object):
+        return cls(None, s3_object['file_size'], s3_object['file_checksum'],
+                   s3_object.get('file_checksum_sha256'), s3_object=s3_object)
+
+    def __repr__(self):
+        return 'DownloadResult({}, {} bytes, md5 {})'.format(
+            self.file_path or 'in memory', self.file_size, self.md5)
+
+    def open(self):
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.file_path, 'rb')
+
+    def discard(self):
+        if self.file_path is None:
+            return
+        logging.info('Deleting downloaded file [%s]', self.file_path)
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            logging.warning('An error occurred removing file [%s]', self.file_path)
+        if self.reservation is not None:
+            self.reservation.release()
+
+
+class DownloadStats(object):
+    """ Counts the files downloaded, the bytes written and the time they took, along with how long
+        each took to get a response.
+        """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.files = 0
+        self.bytes = 0
+        self.elapsed_seconds = 0.0
+        self.first_byte_seconds = 0.0
+
+    def record(self, byte_count, elapsed_seconds, first_byte_seconds):
+        with self.lock:
+            self.files += 1
+            self.bytes += byte_count
+            self.elapsed_seconds += elapsed_seconds
+            self.first_byte_seconds += first_byte_seconds
+
+    def __str__(self):
+        return '{} files, {} bytes in {:.3f}s ({:.1f} KB/s), {:.3f}s average to first byte'.format(
+            self.files, self.bytes, self.elapsed_seconds,
+            self.bytes / 1024 / self.elapsed_seconds if self.elapsed_seconds else 0.0,
+            self.first_byte_seconds / self.files if self.files else 0.0)
+
+
+class PartialDownload(object):
+    """ A download in progress, and what is needed to carry on with it if it is interrupted: the
+        validators the server sent with the file, and the byte range segments of the file with
+        how many bytes of each have been written so far. The state is saved beside the file, so
+        that a download kept in a partial directory can resume in a later run.
+        """
+
+    def __init__(self, url, file_path, persistent=False):
+        self.url = url
+        self.file_path = file_path
+        self.persistent = persistent
+        # When the first response arrived, for the transfer metrics.
+        self.first_byte_time = None
+        self.reservation = None
+        self.etag = None
+        self.last_modified = None
+        self.size = None
+        # Each segment is [first byte, last byte or None if unknown, bytes written].
+        self.segments = [[0, None, 0]]
+
+    @classmethod
+    def load(cls, url, file_path):
+        partial = cls(url, file_path, persistent=True)
+        try:
+            with open(file_path + STATE_SUFFIX) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return partial
+        if state.get('url') != url or not os.path.exists(file_path):
+            return partial
+        partial.etag = state.get('etag')
+        partial.last_modified = state.get('last_modified')
+        partial.size = state.get('size')
+        partial.segments = state.get('segments') or partial.segments
+        logging.info('Found partial download of URL [%s] with [%s] bytes written', url,
+                     partial.written())
+        return partial
+
+    def __repr__(self):
+        return 'PartialDownload({}, {} of {} bytes)'.format(
+            self.file_path, self.written(), self.size)
+
+    def written(self):
+        return sum(written for _, _, written in self.segments)
+
+    def is_complete(self, segment):
+        start, end, written = segment
+        return end is not None and start + written > end
+
+    def validator(self):
+        # A weak ETag can't be used with If-Range, so fall back to the modification date.
+        if self.etag is not None and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    def range_headers(self, segment):
+        start, end, written = segment
+        if start + written == 0 and end is None:
+            return {}
+        return {
+            'Range': 'bytes={}-{}'.format(start + written, '' if end is None else end),
+            'If-Range': self.validator()
+        }
+
+    def can_resume(self):
+        return self.written() > 0 and self.validator() is not None
+
+    def reset(self):
+        self.etag = None
+        self.last_modified = None
+        self.size = None
+        self.segments = [[0, None, 0]]
+
+    def restart(self, response):
+        """ Starts the download again from the first byte, with the validators of the given full
+            response.
+            """
+        self.reset()
+        # Ranges count bytes of the encoded body, but the file holds the decoded bytes, so a
+        # compressed download can only ever be fetched from the beginning.
+        if 'Content-Encoding' not in response.headers:
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+            length = response.headers.get('Content-Length')
+            self.size = int(length) if length is not None else None
+        self.segments = [[0, None if self.size is None else self.size - 1, 0]]
+        with open(self.file_path, 'wb'):
+            pass
+
+    def split(self, count):
+        """ Splits the file into `count` segments of about the same size, which can be fetched in
+            parallel.
+            """
+        segment_size = math.ceil(self.size / count)
+        self.segments = [[start, min(start + segment_size, self.size) - 1, 0]
+                         for start in range(0, self.size, segment_size)]
+
+    def save(self):
+        if not self.persistent:
+            return
+        state = {
+            'url': self.url,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'size': self.size,
+            'segments': self.segments
+        }
+        temp_path = self.file_path + STATE_SUFFIX + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.file_path + STATE_SUFFIX)
+
+    def forget(self):
+        # The download is finished with, one way or another, so it mustn't be resumed.
+        if self.file_path is None:
+            return
+        try:
+            os.remove(self.file_path + STATE_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    def discard(self):
+        if self.file_path is None:
+            return
+        logging.info('Deleting partial download [%s]', self.file_path)
+        self.forget()
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
 
 
 class DownloadClient(object):
 
-    def download_file(self, url):
-        # Create a temporary file object.
-        temp_file = self._get_temp_file_name()
+    def __init__(self, max_workers=8, max_per_host=2, pool_size=4, max_retries=3,
+                 backoff_factor=0.5, sha256=False, partial_dir=None, segments=1,
+                 segment_min_size=64 * 1024 * 1024, buffer_size=1024 * 1024, cache=None,
+                 spool_size=0, disk_budget=None, connect_timeout=10, read_timeout=60,
+                 min_rate=0, stall_seconds=60, part_size=None):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.sha256 = sha256
+        self.partial_dir = partial_dir
+        self.segments = segments
+        self.segment_min_size = segment_min_size
+        self.buffer_size = buffer_size
+        self.cache = cache
+        self.spool_size = spool_size
+        self.disk_budget = disk_budget
+        self.timeout = (connect_timeout, read_timeout)
+        self.min_rate = min_rate
+        self.stall_seconds = stall_seconds
+        # Given the part size files are uploaded in, their part digests are calculated too.
+        self.part_size = part_size
+        self.stats = DownloadStats()
+        # The partial files currently being written, which no other download may share.
+        self.active_partials = set()
+        self.lock = Lock()
+        if partial_dir is not None:
+            os.makedirs(partial_dir, exist_ok=True)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = self._initialise_session()
 
-        # Get a handle on the description and file path for the temporary file.
-        file_descriptor = temp_file[0]
-        file_path = temp_file[1]
+    def _initialise_session(self):
+        # Share one session between every download, so connections to each repository host are
+        # kept alive and reused rather than handshaking again for every file.
+        logging.info('Initialising download HTTP session')
+        session = requests.Session()
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        return session
 
-        # Download the file and if it was successful, return the file path.
-        if self._do_download_file(url, file_descriptor, file_path):
-            return file_path
-        else:
+    def connection_stats(self):
+        """ Returns the number of connections opened and requests made to each host the session
+            has a connection pool for. Every request beyond the first on a connection reused it.
+            """
+        pools = self.adapter.poolmanager.pools
+        stats = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats[pool.host] = {
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests
+                }
+        return stats
+
+    def download_files(self, urls, deadline=None):
+        """ Downloads the given URLs concurrently, yielding each URL along with its
+            `DownloadResult`, or None, as soon as it completes. At most `max_workers` downloads run
+            at once, and no more than `max_per_host` of those from the same host. If iteration
+            stops early, the files of downloads that have not been yielded yet are removed. Any
+            download still running at `deadline`, a `time.time()` value, is aborted.
+            """
+        download_file = self.download_file if deadline is None else \
+            functools.partial(self.download_file, deadline=deadline)
+        return self.transfer_files(urls, download_file, DownloadResult.discard)
+
+    def transfer_files(self, urls, transfer, discard=None):
+        """ Calls `transfer` with each of the given URLs concurrently, within the same limits as
+            `download_files`, yielding each URL along with the result as soon as it completes.
+            If iteration stops early, `discard` is called with the result of every transfer that
+            has not been yielded yet.
+            """
+        pending = OrderedDict()
+        for url in urls:
+            pending.setdefault(urlparse(url).netloc, deque()).append(url)
+        in_flight = {}
+        host_downloads = Counter()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending or in_flight:
+                # Start as many downloads as the limits allow, taking turns between the hosts so
+                # that one host with many files doesn't hold up the others.
+                for host in list(pending):
+                    urls_for_host = pending[host]
+                    while urls_for_host and host_downloads[host] < self.max_per_host and \
+                            len(in_flight) < self.max_workers:
+                        url = urls_for_host.popleft()
+                        in_flight[executor.submit(transfer, url)] = (host, url)
+                        host_downloads[host] += 1
+                    if not urls_for_host:
+                        del pending[host]
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    host, url = in_flight.pop(future)
+                    host_downloads[host] -= 1
+                    yield url, future.result()
+        finally:
+            self._discard_transfers(in_flight, discard)
+            executor.shutdown(wait=False)
+
+    def _discard_transfers(self, in_flight, discard):
+        # Wait for any transfers that are still running, and discard whatever they leave behind.
+        for future in in_flight:
+            try:
+                result = future.result()
+            except Exception:
+                continue
+            if result is not None and discard is not None:
+                discard(result)
+
+    def open_download(self, url, deadline=None):
+        """ Returns the streamed response for the given URL, with its body decoded as it is read
+            from `response.raw`, or None if it can't be downloaded. The caller must close it.
+            With a cache, the response is a 304 with no body if the file hasn't changed since
+            it was cached. Retries give up rather than wait past `deadline`.
+            """
+        logging.info('Opening download of URL [%s]', url)
+        response = self._get(url, self._conditional_headers(url), deadline)
+        logging.info('Got HTTP response [%s] from URL [%s]', response, url)
+        if response.status_code == 304:
+            return response
+        if response.status_code != 200:
+            logging.warning(
+                'Received non-200 HTTP status code for URL [%s], cannot access target for download',
+                url
+            )
+            response.close()
             return None
+        response.raw.decode_content = True
+        return response
+
+    def watch(self, response, deadline=None):
+        """ Returns the body of the given response as a file-like object that aborts the transfer
+            if it stalls or runs past `deadline`, and raises `IncompleteDownloadError` if it ends
+            short of its Content-Length. The transfer is added to `stats` once it has been read.
+            """
+        # The response arrived `elapsed` after the request was sent.
+        first_byte_time = time.time()
+        start_time = first_byte_time - response.elapsed.total_seconds()
+        return WatchedReader(
+            response.raw,
+            self._watchdog(response.url, deadline),
+            self._decoded_length(response),
+            lambda file_size: self._record_download(
+                response.url, file_size, start_time, first_byte_time)
+        )
+
+    def _watchdog(self, url, deadline):
+        return TransferWatchdog(url, self.min_rate, self.stall_seconds, deadline)
+
+    def download_file(self, url, deadline=None):
+        """ Downloads the given URL to a local file, returning its `DownloadResult`, or None if it
+            can't be downloaded. If the transfer is interrupted, it carries on from the last byte
+            written with a `Range` request, as long as the server sent a validator to make sure
+            the file hasn't changed in the meantime. With a `partial_dir`, an interrupted
+            download is left there when the retries run out, to be resumed by a later run.
+            Files of up to `spool_size` bytes are kept in memory rather than written to disk.
+            Any other file waits for room in the `disk_budget`, which it keeps until the result
+            is discarded. A download that stalls, or is still running at `deadline`, is aborted.
+            """
+        start_time = time.time()
+        partial = self._open_partial(url)
+        try:
+            for attempt in range(self.max_retries + 1):
+                if deadline is not None and time.time() > deadline:
+                    raise DownloadTimeoutError('Download of %s ran past its deadline' % url)
+                try:
+                    download = self._do_download_file(url, partial, deadline)
+                except IncompleteDownloadError:
+                    partial.save()
+                    if attempt == self.max_retries:
+                        raise
+                    logging.warning(
+                        'Download of URL [%s] interrupted after [%s] bytes, attempt [%s] of [%s]',
+                        url, partial.written(), attempt + 1, self.max_retries + 1)
+                    self._back_off(url, self._backoff_seconds(attempt), deadline)
+                    continue
+                if download is not None and download.file_path is not None:
+                    partial.forget()
+                    download.reservation, partial.reservation = partial.reservation, None
+                else:
+                    partial.discard()
+                if download is not None and download.s3_object is None:
+                    self._record_download(
+                        url, download.file_size, start_time, partial.first_byte_time)
+                return download
+        except Exception:
+            if partial.persistent:
+                # Whatever was written since the last save, a later run carries on from there.
+                partial.save()
+                logging.warning('Keeping partial download [%s] of URL [%s]', partial, url)
+            else:
+                partial.discard()
+            raise
+        finally:
+            if partial.reservation is not None:
+                partial.reservation.release()
+            with self.lock:
+                self.active_partials.discard(partial.file_path)
+
+    def _conditional_headers(self, url):
+        return self.cache.conditional_headers(url) if self.cache is not None else {}
+
+    def _record_download(self, url, file_size, start_time, first_byte_time):
+        elapsed_seconds = time.time() - start_time
+        first_byte_seconds = first_byte_time - start_time
+        self.stats.record(file_size, elapsed_seconds, first_byte_seconds)
+        logging.info(
+            'Downloaded [%s] bytes from URL [%s] in [%.3f] seconds at [%.1f] KB/s, '
+            'first byte after [%.3f] seconds',
+            file_size,
+            url,
+            elapsed_seconds,
+            file_size / 1024 / elapsed_seconds if elapsed_seconds else 0.0,
+            first_byte_seconds
+        )
+
+    def _open_partial(self, url):
+        if self.partial_dir is not None:
+            # Name the file after the URL, so that a later run can find it again.
+            digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+            file_path = os.path.join(self.partial_dir, digest + PARTIAL_SUFFIX)
+            with self.lock:
+                in_use = file_path in self.active_partials
+                self.active_partials.add(file_path)
+            if not in_use:
+                return PartialDownload.load(url, file_path)
+        # The temporary file is only created once the download turns out to need one.
+        return PartialDownload(url, None)
+
+    def _get(self, url, headers=None, deadline=None):
+        # Retry connection errors and server errors, backing off for a random time of up to
+        # `backoff_factor * 2 ** attempt` seconds, unless the server says how long to wait.
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.get(url, stream=True, headers=headers,
+                                            timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                logging.warning('Unable to connect to URL [%s], attempt [%s] of [%s]', url,
+                                attempt + 1, self.max_retries + 1)
+                self._back_off(url, self._backoff_seconds(attempt), deadline)
+                continue
+            if response.status_code < 500 or attempt == self.max_retries:
+                return response
+            retry_after = response.headers.get('Retry-After')
+            logging.warning('Got HTTP [%s] from URL [%s], attempt [%s] of [%s]',
+                            response.status_code, url, attempt + 1, self.max_retries + 1)
+            response.close()
+            retry_after = self._retry_after_seconds(retry_after)
+            if retry_after is not None:
+                self._back_off(url, min(retry_after, MAX_RETRY_AFTER), deadline)
+            else:
+                self._back_off(url, self._backoff_seconds(attempt), deadline)
+
+    def _backoff_seconds(self, attempt):
+        return random.uniform(0, self.backoff_factor * 2 ** attempt)
+
+    def _back_off(self, url, seconds, deadline):
+        # There's no point waiting to retry a download that would be past its deadline by then.
+        if deadline is not None and time.time() + seconds > deadline:
+            raise DownloadTimeoutError(
+                'Download of %s would run past its deadline before it could be retried' % url)
+        time.sleep(seconds)
+
+    def _retry_after_seconds(self, retry_after):
+        # Retry-After is either a number of seconds, or the HTTP date to retry after.
+        if retry_after is None:
+            return None
+        if retry_after.isdigit():
+            return int(retry_after)
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if retry_at is None:
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
 
     def _get_temp_file_name(self):
         # Generate a temporary file with the appropriate prefix and suffix.
@@ -29,41 +637,259 @@ class DownloadClient(object):
         logging.info('Generated temporary file [%s]', temp_file)
         return temp_file
 
-    def _do_download_file(self, url, target_file_descriptor, target_file_path):
-        # Initialise the download by getting a handle on the response object.
-        logging.info('Downloading URL [%s] to file [%s]', url, target_file_path)
-        response = requests.get(url, stream=True)
+    def _do_download_file(self, url, partial, deadline=None):
+        # Ask for the first missing part of the file, if there is any to carry on from.
+        pending = [segment for segment in partial.segments if not partial.is_complete(segment)]
+        if pending and partial.can_resume():
+            headers = partial.range_headers(pending[0])
+        else:
+            headers = self._conditional_headers(url)
+        logging.info('Downloading URL [%s] to file [%s] with headers [%s]', url,
+                     partial.file_path, headers)
+        response = self._get(url, headers, deadline)
         logging.info('Got HTTP response [%s] from URL [%s]', response, url)
+        if partial.first_byte_time is None:
+            partial.first_byte_time = time.time()
 
-        # EPrints currently returns 401 status codes for some files. We can ignore these for now,
-        # we're only interested in successful downloads.
-        if response.status_code == 200:
-
-            # Execute the download, using tqdm to provide us with a progress bar for the download.
-            total_size = int(response.headers.get('content-length', 0))
-            wrote = 0
-            with open(target_file_path, 'wb') as handle:
-                for data in tqdm(
-                        response.iter_content(1024),
-                        total=math.ceil(total_size // 1024),
-                        unit='KB'
-                ):
-                    wrote = wrote + len(data)
-                    handle.write(data)
-            logging.info(
-                'Download complete, closing descriptor [%s] for [%s]',
-                target_file_descriptor,
-                target_file_path
-            )
-            os.close(target_file_descriptor)
-            return True
+        if response.status_code == 304:
+            response.close()
+            s3_object = self.cache.s3_object(url)
+            return DownloadResult.unchanged(s3_object) if s3_object is not None else None
+        elif response.status_code == 206 and 'Range' in headers:
+            if self._content_range_start(response) != pending[0][0] + pending[0][2]:
+                # Not the range asked for, so don't trust what was written before either.
+                response.close()
+                partial.reset()
+                raise IncompleteDownloadError(
+                    'Got an unexpected range %s of URL %s' %
+                    (response.headers.get('Content-Range'), url))
+            if not self._reserve_disk(url, partial, partial.size, deadline):
+                response.close()
+                return self._do_download_file(url, partial, deadline)
+            logging.info('Resuming download [%s] of URL [%s]', partial, url)
+        elif response.status_code == 200 and self._can_spool(response):
+            return self._spool_download(url, response, deadline)
+        elif response.status_code == 200 and \
+                not self._reserve_disk(url, partial, self._decoded_length(response), deadline):
+            # Now that there's room, ask for the file again rather than have kept the server
+            # waiting.
+            response.close()
+            return self._do_download_file(url, partial, deadline)
+        elif response.status_code == 200:
+            # Either this is a new download, or the server ignored the range because the file
+            # changed, so start from the beginning.
+            if partial.file_path is None:
+                file_descriptor, partial.file_path = self._get_temp_file_name()
+                os.close(file_descriptor)
+            partial.restart(response)
+            if self._can_split(partial, response):
+                partial.split(min(self.segments, partial.size // self.segment_min_size))
+                logging.info('Downloading URL [%s] in [%s] segments', url,
+                             len(partial.segments))
+            pending = list(partial.segments)
         else:
-            # We didn't get a 200 status code, close and delete the file and return false.
+            # EPrints currently returns 401 status codes for some files. We can ignore these
+            # for now, we're only interested in successful downloads.
             logging.warning(
                 'Received non-200 HTTP status code for URL [%s], cannot access target for download',
                 url
             )
-            logging.info('Deleting temporary file [%s]', target_file_path)
-            os.close(target_file_descriptor)
-            os.remove(target_file_path)
-            return False
+            response.close()
+            return None
+
+        # A single segment is hashed as the bytes go past, so the file never has to be read back
+        # just to checksum it. Segments arrive out of order, so are hashed once they're written.
+        hashes = self._new_hashes()
+        if len(partial.segments) == 1:
+            self._hash_file(partial.file_path, hashes, partial.segments[0][2])
+        else:
+            hashes = None
+        self._fetch_segments(url, partial, pending, response, hashes, deadline)
+        if hashes is None:
+            hashes = self._new_hashes()
+            self._hash_file(partial.file_path, hashes)
+        logging.info('Download complete for [%s]', partial.file_path)
+        md5, sha256, part_digests = self._hash_values(hashes)
+        return DownloadResult(
+            partial.file_path,
+            partial.written(),
+            md5,
+            sha256,
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified'),
+            part_digests=part_digests
+        )
+
+    def _decoded_length(self, response):
+        # The Content-Length of a compressed response says nothing of the size of the file.
+        length = response.headers.get('Content-Length')
+        if length is None or 'Content-Encoding' in response.headers:
+            return None
+        return int(length)
+
+    def _reserve_disk(self, url, partial, size, deadline=None):
+        # Reserve room for the whole file before writing any of it. Returns False if that meant
+        # waiting for other downloads to finish with their files, for no longer than the time
+        # left before `deadline`.
+        if self.disk_budget is None:
+            return True
+        if partial.reservation is not None:
+            if partial.reservation.covers(size):
+                return True
+            partial.reservation.release()
+        partial.reservation = self.disk_budget.try_reserve(size)
+        if partial.reservation is not None:
+            return True
+        logging.info('Queueing download of URL [%s] until there is room on disk', url)
+        timeout = None if deadline is None else max(deadline - time.time(), 0)
+        partial.reservation = self.disk_budget.reserve(size, timeout)
+        if partial.reservation is None:
+            raise DownloadTimeoutError(
+                'Download of %s ran past its deadline waiting for room on disk' % url)
+        return False
+
+    def _can_spool(self, response):
+        length = response.headers.get('Content-Length')
+        return length is not None and int(length) <= self.spool_size and \
+            'Content-Encoding' not in response.headers
+
+    def _spool_download(self, url, response, deadline):
+        # A small file is read into memory and pushed to S3 from there, sparing the filesystem a
+        # create, write, read and remove. If it's interrupted, it's simply fetched again.
+        size = int(response.headers['Content-Length'])
+        data = bytearray()
+        hashes = self._new_hashes(parts=False)
+        with closing(response):
+            try:
+                for chunk in self._read_chunks(response, deadline):
+                    data += chunk
+                    for digest in hashes:
+                        digest.update(chunk)
+            except READ_ERRORS as e:
+                raise IncompleteDownloadError(
+                    'Download of %s interrupted: %s' % (url, e)) from e
+        if len(data) != size:
+            raise IncompleteDownloadError(
+                'Download of %s stopped after %s of %s bytes' % (url, len(data), size))
+        logging.info('Download of URL [%s] complete, kept [%s] bytes in memory', url, size)
+        md5, sha256, _ = self._hash_values(hashes)
+        return DownloadResult(
+            None,
+            size,
+            md5,
+            sha256,
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified'),
+            data=bytes(data)
+        )
+
+    def _can_split(self, partial, response):
+        return self.segments > 1 and partial.size is not None and \
+            partial.size >= 2 * self.segment_min_size and partial.validator() is not None and \
+            response.headers.get('Accept-Ranges') == 'bytes'
+
+    def _content_range_start(self, response):
+        # e.g. Content-Range: bytes 1024-2047/4096
+        content_range = response.headers.get('Content-Range', '')
+        try:
+            return int(content_range.split()[1].split('-')[0])
+        except (IndexError, ValueError):
+            return None
+
+    def _fetch_segments(self, url, partial, pending, response, hashes, deadline):
+        # The response already open carries the first pending segment, and any others are
+        # requested alongside it.
+        if len(pending) == 1:
+            self._fetch_segment(partial, pending[0], response, hashes, deadline)
+            return
+        with ThreadPoolExecutor(max_workers=len(pending) - 1) as executor:
+            futures = [executor.submit(self._fetch_range, url, partial, segment, deadline)
+                       for segment in pending[1:]]
+            try:
+                self._fetch_segment(partial, pending[0], response, hashes, deadline)
+            finally:
+                for future in futures:
+                    future.exception()
+            for future in futures:
+                future.result()
+
+    def _fetch_range(self, url, partial, segment, deadline):
+        response = self._get(url, partial.range_headers(segment), deadline)
+        if response.status_code != 206 or \
+                self._content_range_start(response) != segment[0] + segment[2]:
+            response.close()
+            raise IncompleteDownloadError(
+                'Got HTTP %s rather than the range %s of URL %s' %
+                (response.status_code, partial.range_headers(segment)['Range'], url))
+        self._fetch_segment(partial, segment, response, None, deadline)
+
+    def _fetch_segment(self, partial, segment, response, hashes, deadline):
+        start, end, _ = segment
+        with closing(response), open(partial.file_path, 'r+b') as handle:
+            handle.seek(start + segment[2])
+            try:
+                for data in self._read_chunks(response, deadline):
+                    if end is not None:
+                        data = data[:end + 1 - start - segment[2]]
+                    handle.write(data)
+                    for digest in hashes or ():
+                        digest.update(data)
+                    segment[2] += len(data)
+                    if partial.is_complete(segment):
+                        break
+            except READ_ERRORS as e:
+                raise IncompleteDownloadError(
+                    'Download of %s interrupted: %s' % (partial.url, e)) from e
+        if end is not None and not partial.is_complete(segment):
+            raise IncompleteDownloadError(
+                'Download of %s stopped after %s of %s bytes in range %s-%s' %
+                (partial.url, segment[2], end + 1 - start, start, end))
+
+    def _read_chunks(self, response, deadline=None):
+        # Read straight into one reused buffer, rather than allocating a new object for every
+        # chunk. A compressed body is left to requests to decode, as the decoded chunks can be
+        # larger than the buffer.
+        watchdog = self._watchdog(response.url, deadline)
+        if 'Content-Encoding' in response.headers:
+            for chunk in response.iter_content(self.buffer_size):
+                watchdog.check(len(chunk))
+                yield chunk
+            return
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        while True:
+            count = response.raw.readinto(buffer)
+            if not count:
+                return
+            watchdog.check(count)
+            yield view[:count]
+
+    def _new_hashes(self, parts=True):
+        # A file small enough to keep in memory is never uploaded in parts.
+        hashes = [hashlib.md5()] + ([hashlib.sha256()] if self.sha256 else [])
+        if parts and self.part_size is not None:
+            hashes.append(PartDigests(self.part_size))
+        return hashes
+
+    def _hash_values(self, hashes):
+        # The base64 MD5, hex SHA-256 and `PartDigests` of a file, or None for those not asked for.
+        hashes = {hash_.name: hash_ for hash_ in hashes}
+        return (
+            base64.b64encode(hashes['md5'].digest()).decode('utf-8'),
+            hashes['sha256'].hexdigest() if 'sha256' in hashes else None,
+            hashes.get(PartDigests.name)
+        )
+
+    def _hash_file(self, file_path, hashes, length=None):
+        # Hash the bytes already on disk, up to `length` bytes if given.
+        remaining = length
+        with open(file_path, 'rb') as f:
+            while remaining is None or remaining > 0:
+                data = f.read(self.buffer_size if remaining is None
+                              else min(self.buffer_size, remaining))
+                if not data:
+                    break
+                for digest in hashes:
+                    digest.update(data)
+                if remaining is not None:
+                    remaining -= len(data)
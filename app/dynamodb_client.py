@@ -1,15 +1,30 @@
 import boto3
+import json
 import logging
+import time
 
 from datetime import datetime, timedelta
 from dateutil import parser
 
+# BatchGetItem reads at most this many items in one request.
+BATCH_GET_ITEM_LIMIT = 100
+# Keys that BatchGetItem leaves unprocessed are asked for again at most this many times.
+BATCH_GET_ITEM_MAX_RETRIES = 8
+
+
+class UnprocessedKeysError(IOError):
+    """ Raised when DynamoDB still hasn't read some of the keys asked for once the retries run
+        out.
+        """
+    pass
+
 
 class DynamoDBClient(object):
 
-    def __init__(self, watermark_table_name, processed_table_name):
+    def __init__(self, watermark_table_name, processed_table_name, digest_table_name=None):
         self.watermark_table_name = watermark_table_name
         self.processed_table_name = processed_table_name
+        self.digest_table_name = digest_table_name
         self.client = self._initialise_client()
 
     def _initialise_client(self):
@@ -62,38 +77,186 @@ class DynamoDBClient(object):
             }
         )
 
-    def fetch_processed_status(self, oai_pmh_identifier):
-        # Query the DynamoDB table to fetch the status of a record with the given identifier.
+    def fetch_set_high_watermarks(self):
+        # Query DynamoDB to fetch the high watermark of each set harvested separately, stored
+        # alongside the high watermark as a JSON object keyed by set spec.
+        logging.info('Fetching set high watermarks from table [%s]', self.watermark_table_name)
+        response = self.client.get_item(
+            TableName=self.watermark_table_name,
+            Key={
+                'Key': {
+                    'S': 'SetHighWatermarks'
+                }
+            }
+        )
+        if 'Item' in response:
+            set_high_watermarks = {
+                set_spec: parser.parse(high_watermark)
+                for set_spec, high_watermark in json.loads(response['Item']['Value']['S']).items()
+            }
+            logging.info('Got [%s] set high watermarks', len(set_high_watermarks))
+            return set_high_watermarks
+        else:
+            logging.info('No set high watermarks exist')
+            return {}
+
+    def update_set_high_watermarks(self, set_high_watermarks):
+        # Unlike the high watermark, each set's watermark is the end of the window it has been
+        # completely harvested up to, so it is stored as given.
         logging.info(
-            'Fetching processed record with identifier [%s] from table [%s]',
-            oai_pmh_identifier,
-            self.processed_table_name
+            'Setting [%s] set high watermarks in table [%s]',
+            len(set_high_watermarks),
+            self.watermark_table_name
+        )
+        self.client.put_item(
+            TableName=self.watermark_table_name,
+            Item={
+                'Key': {
+                    'S': 'SetHighWatermarks'
+                },
+                'Value': {
+                    'S': json.dumps({
+                        set_spec: high_watermark.isoformat()
+                        for set_spec, high_watermark in set_high_watermarks.items()
+                    })
+                },
+                'LastUpdated': {
+                    'S': datetime.now().isoformat()
+                }
+            }
         )
+
+    def fetch_harvest_checkpoint(self):
+        # Query DynamoDB to fetch the checkpoint of an interrupted harvest, stored alongside the
+        # high watermark.
+        logging.info('Fetching harvest checkpoint from table [%s]', self.watermark_table_name)
         response = self.client.get_item(
-            TableName=self.processed_table_name,
+            TableName=self.watermark_table_name,
             Key={
-                'Identifier': {
-                    'S': oai_pmh_identifier
+                'Key': {
+                    'S': 'HarvestCheckpoint'
                 }
             }
         )
 
-        # If this identifier has never been seen before, it won't have a row in the DyanmoDB table.
+        # If the last harvest completed, or has never been interrupted, there is no checkpoint.
         if 'Item' in response:
-            status = response['Item']['Status']['S']
-            logging.info(
-                'Got processed record status [%s] for identifier [%s]',
-                status,
-                oai_pmh_identifier
-            )
-            return status
+            item = response['Item']
+            # Checkpoints taken before the high watermark was recorded with them have none.
+            checkpoint = {
+                'from': parser.parse(item['From']['S']),
+                'until': parser.parse(item['Until']['S']) if item['Until']['S'] != '-' else None,
+                'resumption_tokens': json.loads(item['ResumptionTokens']['S']),
+                'high_watermark': parser.parse(item['HighWatermark']['S'])
+                if 'HighWatermark' in item else None
+            }
+            logging.info('Got harvest checkpoint [%s]', checkpoint)
+            return checkpoint
         else:
-            logging.info(
-                'No processed record exists for identifier [%s]',
-                oai_pmh_identifier
-            )
+            logging.info('No harvest checkpoint exists')
             return None
 
+    def update_harvest_checkpoint(self, from_datetime, until_datetime, resumption_tokens,
+                                  high_watermark):
+        # Record the resumption tokens needed to continue the harvest of the given window, keyed
+        # by metadata prefix, along with the high watermark the harvest started from. An
+        # open-ended window has no until datetime.
+        logging.info(
+            'Setting harvest checkpoint [%s] for window [%s] to [%s] in table [%s]',
+            resumption_tokens,
+            from_datetime,
+            until_datetime,
+            self.watermark_table_name
+        )
+        self.client.put_item(
+            TableName=self.watermark_table_name,
+            Item={
+                'Key': {
+                    'S': 'HarvestCheckpoint'
+                },
+                'From': {
+                    'S': from_datetime.isoformat()
+                },
+                'Until': {
+                    'S': until_datetime.isoformat() if until_datetime is not None else '-'
+                },
+                'ResumptionTokens': {
+                    'S': json.dumps(resumption_tokens)
+                },
+                'HighWatermark': {
+                    'S': high_watermark.isoformat()
+                },
+                'LastUpdated': {
+                    'S': datetime.now().isoformat()
+                }
+            }
+        )
+
+    def clear_harvest_checkpoint(self):
+        # Remove the checkpoint once the harvest it belongs to has completed.
+        logging.info('Clearing harvest checkpoint in table [%s]', self.watermark_table_name)
+        self.client.delete_item(
+            TableName=self.watermark_table_name,
+            Key={
+                'Key': {
+                    'S': 'HarvestCheckpoint'
+                }
+            }
+        )
+
+    def fetch_processed_statuses(self, oai_pmh_identifiers):
+        """ Fetches the status of each of the records with the given identifiers, returning a
+            dict of status by identifier that leaves out those never seen before. The statuses
+            are read with a BatchGetItem request for each 100 identifiers, rather than a GetItem
+            request each.
+            """
+        # A BatchGetItem request may not ask for the same key twice.
+        identifiers = list(dict.fromkeys(oai_pmh_identifiers))
+        logging.info(
+            'Fetching [%s] processed records from table [%s]',
+            len(identifiers),
+            self.processed_table_name
+        )
+        statuses = {}
+        for start in range(0, len(identifiers), BATCH_GET_ITEM_LIMIT):
+            request_items = {
+                self.processed_table_name: {
+                    'Keys': [
+                        {'Identifier': {'S': identifier}}
+                        for identifier in identifiers[start:start + BATCH_GET_ITEM_LIMIT]
+                    ],
+                    # Status is a reserved word, so has to be given by placeholder. The
+                    # identifier is needed to tell which record each status belongs to.
+                    'ProjectionExpression': 'Identifier, #status',
+                    'ExpressionAttributeNames': {'#status': 'Status'}
+                }
+            }
+            attempt = 0
+            while request_items:
+                response = self.client.batch_get_item(RequestItems=request_items)
+                for item in response['Responses'].get(self.processed_table_name, []):
+                    statuses[item['Identifier']['S']] = item['Status']['S']
+                # Keys that weren't read, because of throttling or the size limit of a response,
+                # are asked for again after backing off exponentially.
+                request_items = response.get('UnprocessedKeys')
+                if request_items:
+                    unprocessed = len(request_items[self.processed_table_name]['Keys'])
+                    if attempt == BATCH_GET_ITEM_MAX_RETRIES:
+                        raise UnprocessedKeysError(
+                            '%s keys still unprocessed from table %s after %s retries' %
+                            (unprocessed, self.processed_table_name, attempt))
+                    logging.info(
+                        'Retrying [%s] unprocessed keys from table [%s], attempt [%s] of [%s]',
+                        unprocessed,
+                        self.processed_table_name,
+                        attempt + 1,
+                        BATCH_GET_ITEM_MAX_RETRIES
+                    )
+                    time.sleep(min(0.05 * 2 ** attempt, 5))
+                    attempt += 1
+        logging.info('Got [%s] processed record statuses', len(statuses))
+        return statuses
+
     def update_processed_record(self, oai_pmh_identifier, message, status, reason):
         # Add or update the row in the DynamoDB table with the given idetnfier.
         logging.info(
@@ -123,3 +286,52 @@ class DynamoDBClient(object):
                 }
             }
         )
+
+    def fetch_digest_etag(self, object_key):
+        # Query the digest table to find whether a content-addressed object has already been
+        # pushed to S3, returning its ETag if so.
+        if self.digest_table_name is None:
+            return None
+        logging.info(
+            'Fetching object [%s] from digest table [%s]',
+            object_key,
+            self.digest_table_name
+        )
+        response = self.client.get_item(
+            TableName=self.digest_table_name,
+            Key={
+                'ObjectKey': {
+                    'S': object_key
+                }
+            }
+        )
+        if 'Item' in response:
+            return response['Item']['ETag']['S']
+        else:
+            return None
+
+    def update_digest_etag(self, object_key, etag):
+        # Record that a content-addressed object is in S3. The object's contents are fixed by its
+        # key, so an existing row never needs to change.
+        if self.digest_table_name is None:
+            return
+        logging.info(
+            'Adding object [%s] with ETag [%s] to digest table [%s]',
+            object_key,
+            etag,
+            self.digest_table_name
+        )
+        self.client.put_item(
+            TableName=self.digest_table_name,
+            Item={
+                'ObjectKey': {
+                    'S': object_key
+                },
+                'ETag': {
+                    'S': etag
+                },
+                'LastUpdated': {
+                    'S': datetime.now().isoformat()
+                }
+            }
+        )
@@ -0,0 +1,62 @@
+import logging
+
+from datetime import timedelta
+
+# The smallest window the planner will split a dense range down to. Below this the adaptor simply
+# takes the first records up to the flow limit, as it did before windows were adaptive.
+MINIMUM_WINDOW = timedelta(seconds=1)
+
+
+class HarvestWindowPlanner(object):
+    """ Chooses the size of the next datestamp window to harvest. Windows are widened
+        exponentially across ranges with no records to process, split in half when they hold more
+        records than the flow limit, and otherwise sized from the record density observed in the
+        previous windows.
+        """
+
+    def __init__(self, flow_limit, initial_window, maximum_window, growth_factor=2):
+        self.flow_limit = flow_limit
+        self.window = initial_window
+        self.maximum_window = maximum_window
+        self.growth_factor = growth_factor
+        self.observations = []
+
+    def window_end(self, from_datetime, now):
+        # Open-ended windows (i.e. up to "now") are represented by None, as OAI-PMH expects.
+        until_datetime = from_datetime + self.window
+        if until_datetime >= now:
+            logging.info('Harvest window from [%s] reaches [%s], leaving it open-ended',
+                         from_datetime, now)
+            return None
+        logging.info('Harvest window from [%s] to [%s] (width [%s])',
+                     from_datetime, until_datetime, self.window)
+        return until_datetime
+
+    def split_window(self, from_datetime, until_datetime):
+        """ Halves the window, returning False if it is already as small as it can be.
+            """
+        width = until_datetime - from_datetime
+        if width <= MINIMUM_WINDOW:
+            logging.info('Harvest window from [%s] to [%s] cannot be split any further',
+                         from_datetime, until_datetime)
+            return False
+        self.window = max(width / 2, MINIMUM_WINDOW)
+        logging.info('Harvest window from [%s] to [%s] has more than [%s] records, splitting '
+                     'to width [%s]', from_datetime, until_datetime, self.flow_limit, self.window)
+        return True
+
+    def record_window(self, from_datetime, until_datetime, record_count):
+        """ Remembers how many records were found in the given window and uses the density of
+            the range to size the next one.
+            """
+        width = until_datetime - from_datetime
+        self.observations.append((from_datetime, until_datetime, record_count))
+        growth_limit = min(width * self.growth_factor, self.maximum_window)
+        if record_count == 0:
+            self.window = growth_limit
+        else:
+            # Aim for a window that holds roughly the flow limit, given the observed density.
+            density_window = width * self.flow_limit / record_count
+            self.window = max(min(density_window, growth_limit), MINIMUM_WINDOW)
+        logging.info('Found [%s] records between [%s] and [%s], next window width is [%s]',
+                     record_count, from_datetime, until_datetime, self.window)
@@ -186,6 +186,10 @@ class MessageGenerator(object):
                     'checksumUuid': uuid.uuid4(),
                     'checksumValue': s3_object['file_checksum']
                 },
+                'fileChecksumSha256': {
+                    'checksumUuid': uuid.uuid4(),
+                    'checksumValue': s3_object['file_checksum_sha256']
+                } if 'file_checksum_sha256' in s3_object else None,
                 'fileStorageLocation': s3_object['download_url'],
                 'fileStoragePlatform': {
                     'storagePlatformUuid': uuid.uuid4()
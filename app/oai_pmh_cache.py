@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+
+from threading import Lock
+from oaipmh.client import Error
+
+# The request parameters that identify an OAI-PMH response. Anything else (e.g. the endpoint's
+# session cookies or headers) is assumed not to change the response.
+KEY_PARAMS = ('verb', 'metadataPrefix', 'from', 'until', 'set', 'identifier', 'resumptionToken')
+RESPONSE_SUFFIX = '.xml'
+CACHE_MODES = ('cache', 'record', 'replay')
+
+# Found in the raw response without parsing it, to decide whether it can be cached.
+ERROR_PATTERN = re.compile(br'<(?:\w+:)?error[\s>]')
+RESUMPTION_TOKEN_PATTERN = re.compile(br'<(?:\w+:)?resumptionToken[^>]*>([^<]+)<')
+
+
+class ResponseCacheMissError(Error):
+    """ Raised in replay mode when a request has no cached response.
+        """
+    pass
+
+
+class CachingTransport(object):
+    """ Wraps an OAI-PMH transport with an on-disk cache of the raw responses, keyed by a hash of
+        the request parameters and evicted least recently used first once the cache grows beyond
+        its size budget.
+
+        In 'cache' mode, only the pages of a window with an `until` datestamp that aren't OAI-PMH
+        errors are cached, and only for `ttl` seconds, if given, as records modified or deleted
+        since move out of past windows. The pages of a window are followed from one to the next
+        by resumption tokens, which the repository may have expired by the time a cached page
+        hands one out. If the repository rejects one, every cached page of that window is
+        dropped, so that the window can be harvested afresh. In 'record' mode, every response is
+        cached, and in 'replay' mode every request must be served from the cache, so a recorded
+        harvest can be repeated without network access.
+        """
+
+    def __init__(self, transport, cache_dir, max_bytes, mode='cache', ttl=None):
+        if mode not in CACHE_MODES:
+            raise ValueError('Unknown OAI-PMH cache mode [{}]'.format(mode))
+        self.transport = transport
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.ttl = ttl
+        # The cached pages of each bounded window so far, by the resumption tokens they handed
+        # out. These can be cached in 'cache' mode even though the requests using them have no
+        # `until` datestamp.
+        self.chains = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def stats(self):
+        return self.transport.stats
+
+    def __str__(self):
+        return 'CachingTransport({}, {} mode, {} hits, {} misses)'.format(
+            self.cache_dir, self.mode, self.hits, self.misses)
+
+    def request(self, url, params):
+        path = self._response_path(url, params)
+        content = self._read_response(path)
+        if content is not None:
+            logging.info('Serving OAI-PMH request [%s] from cache [%s]', params, path)
+            with self.lock:
+                self.hits += 1
+            self._remember_page(params, path, content)
+            return content
+        with self.lock:
+            self.misses += 1
+        if self.mode == 'replay':
+            raise ResponseCacheMissError(
+                'No cached response for request %s to %s in %s' % (params, url, self.cache_dir))
+        content = self.transport.request(url, params)
+        is_error = ERROR_PATTERN.search(self._as_bytes(content)) is not None
+        if self.mode == 'cache' and is_error and 'resumptionToken' in params and \
+                self._is_bounded(params):
+            self._drop_chain(params['resumptionToken'])
+        elif self.mode == 'record' or (not is_error and self._is_bounded(params)):
+            # An open-ended window gains records over time, and an error such as noRecordsMatch
+            # may not be an error next time, so neither can be served again outside of a
+            # recording.
+            self._write_response(path, content)
+            self._remember_page(params, path, content)
+        return content
+
+    def _is_bounded(self, params):
+        if 'resumptionToken' in params:
+            with self.lock:
+                return params['resumptionToken'] in self.chains
+        return params.get('until') is not None
+
+    def _remember_page(self, params, path, content):
+        # Adds the page to its window's chain of pages, and remembers the token it hands out as
+        # leading to the next page of the same window.
+        if not self._is_bounded(params):
+            return
+        match = RESUMPTION_TOKEN_PATTERN.search(self._as_bytes(content))
+        with self.lock:
+            chain = self.chains.get(params['resumptionToken'], []) \
+                if 'resumptionToken' in params else []
+            if path not in chain:
+                chain.append(path)
+            if match:
+                self.chains[match.group(1).strip().decode('utf-8')] = chain
+
+    def _drop_chain(self, resumption_token):
+        with self.lock:
+            chain = self.chains.get(resumption_token, [])
+            for token in [t for t, c in self.chains.items() if c is chain]:
+                del self.chains[token]
+        logging.warning('Resumption token [%s] was rejected, dropping [%s] cached pages of its '
+                        'window', resumption_token, len(chain))
+        for path in chain:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _as_bytes(self, content):
+        return content.encode('utf-8') if isinstance(content, str) else content
+
+    def _response_path(self, url, params):
+        key = '\n'.join([url] + ['%s=%s' % (name, params[name])
+                                 for name in KEY_PARAMS if params.get(name) is not None])
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + RESPONSE_SUFFIX)
+
+    def _read_response(self, path):
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            modified_time = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        if self.mode == 'cache' and self.ttl is not None and \
+                time.time() - modified_time > self.ttl:
+            logging.info('Cached OAI-PMH response [%s] has expired', path)
+            return None
+        # Mark the response as recently used for eviction, keeping the time it was written.
+        try:
+            os.utime(path, (time.time(), modified_time))
+        except FileNotFoundError:
+            pass
+        return content
+
+    def _write_response(self, path, content):
+        content = self._as_bytes(content)
+        # Write to a temporary file first so that concurrent harvests never read a partial
+        # response.
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(RESPONSE_SUFFIX):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, name))
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                logging.info('Evicting cached OAI-PMH response [%s]', name)
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
@@ -1,70 +1,466 @@
 import logging
 
+from functools import partial
+from queue import Empty, Queue, Full
+from threading import Event, Thread
 from oaipmh.client import Client
+from oaipmh.datestamp import datetime_to_datestamp
 from oaipmh.metadata import MetadataRegistry, oai_dc_reader
-from oaipmh.error import NoRecordsMatchError
+from oaipmh.error import BadResumptionTokenError, CannotDisseminateFormatError, \
+    IdDoesNotExistError, NoRecordsMatchError, NoSetHierarchyError
 from .oaiore.reader import oai_ore_reader
+from .oai_pmh_parser import IterparseRecordParser
+from .oai_pmh_transport import UrllibTransport
+
+# The number of parsed pages that may be waiting to be joined before the background harvests
+# block. This bounds how far ahead of the consumer the harvests are allowed to run.
+PAGE_QUEUE_SIZE = 4
+
+
+class TransportClient(Client):
+    """ A pyoai client that hands the HTTP request itself over to a pluggable transport.
+        """
+
+    def __init__(self, base_url, metadata_registry, transport):
+        Client.__init__(self, base_url, metadata_registry)
+        self.transport = transport
+
+    def makeRequest(self, **kw):
+        return self.transport.request(self._base_url, kw)
 
 
 class OAIPMHClient(object):
 
-    def __init__(self, url, use_ore=False):
+    def __init__(self, url, use_ore=False, transport=None, parser='dom',
+                 harvest_strategy='records', set_workers=0):
+        self.transport = transport or UrllibTransport()
         self.client = self._initialise_client(url)
+        self.record_parser = self._initialise_record_parser(parser)
         self.use_ore = use_ore
+        if harvest_strategy not in ('records', 'identifiers'):
+            raise ValueError('Unknown OAI-PMH harvest strategy [{}]'.format(harvest_strategy))
+        self.harvest_strategy = harvest_strategy
+        # With one or more set workers, each set is harvested separately and in parallel.
+        self.set_workers = set_workers
+        self.set_specs = None
 
     def _initialise_client(self, url):
         registry = MetadataRegistry()
         registry.registerReader('oai_dc', oai_dc_reader)
         registry.registerReader('ore', oai_ore_reader)
-        logging.info('Initialising OAI client with URL [%s]', url)
-        return Client(url, registry)
+        logging.info('Initialising OAI client with URL [%s] and transport [%s]', url,
+                     self.transport)
+        return TransportClient(url, registry, self.transport)
+
+    def _initialise_record_parser(self, parser):
+        # The 'dom' parser is pyoai's own, which builds the whole page before converting it.
+        logging.info('Initialising OAI client with [%s] parser', parser)
+        if parser == 'iterparse':
+            return IterparseRecordParser({'oai_dc': oai_dc_reader, 'ore': oai_ore_reader})
+        elif parser == 'dom':
+            return None
+        raise ValueError('Unknown OAI-PMH parser [{}]'.format(parser))
 
     def fetch_records_from(self, from_datetime, until_datetime=None):
-        records = self._fetch_records_by_prefix_from('oai_dc', from_datetime, until_datetime)
-        if not records:
-            # If we don't get DC records, we won't get anything.
-            return []
-        if self.use_ore:
-            oai_ore_records = self._fetch_records_by_prefix_from(
-                'ore', from_datetime, until_datetime)
-            records = self._merge_records(records, oai_ore_records)
-        records = self._filter_empty_records(records)
-        for r in records.values():
-            r['file_locations'] = self._extract_file_locations(r)
-        return sorted(records.values(), key=lambda k: k['datestamp'])
-
-    def _fetch_records_by_prefix_from(self, metadata_prefix, from_datetime, until_datetime=None):
+        # Drain the whole harvest so that the returned list is sorted across every page.
+        return sorted(
+            self.stream_records_from(from_datetime, until_datetime),
+            key=lambda k: k['datestamp']
+        )
+
+    def stream_records_from(self, from_datetime, until_datetime=None, resumption_tokens=None,
+                            checkpoint=None, unprocessed_filter=None, set_watermarks=None,
+                            set_complete=None):
+        """ Yields records as each ListRecords page is parsed, rather than waiting for the whole
+            resumption token chain to complete. Records are ordered by `datestamp` within each
+            page, but not across pages. Stopping iteration stops any further pages being fetched.
+
+            If given, `resumption_tokens` maps each metadata prefix to the token to continue the
+            harvest from. Once every record harvested so far has been consumed, `checkpoint` is
+            called with the tokens needed to continue from that point, or with None once the
+            harvest is complete.
+
+            If given, `unprocessed_filter` is passed the identifiers of each page of records, and
+            returns those that still need to be processed, so that a page is checked in one go.
+            With the 'identifiers' harvest strategy, it is passed each page of ListIdentifiers
+            headers instead, and only the records it returns are fetched in full.
+
+            With set workers, the repository's sets are harvested in parallel and merged into the
+            one stream, without duplicates. Each set is only harvested from its own watermark in
+            `set_watermarks`, if that is later than `from_datetime`, and `set_complete` is called
+            with a set's spec once every one of its records has been consumed. Sets are not
+            checkpointed with resumption tokens.
+            """
+        set_specs = self.list_sets() if self.set_workers else []
+        if set_specs:
+            pages = self._fetch_set_pages_from(
+                set_specs, from_datetime, until_datetime, unprocessed_filter,
+                set_watermarks or {}, set_complete)
+        else:
+            pages = self._fetch_pages_from(
+                from_datetime, until_datetime, resumption_tokens or {}, unprocessed_filter)
+        for records, tokens in pages:
+            records = self._filter_empty_records(records)
+            if unprocessed_filter is not None and self.harvest_strategy != 'identifiers':
+                unprocessed = set(unprocessed_filter(list(records)))
+                records = {identifier: record for identifier, record in records.items()
+                           if identifier in unprocessed}
+            for r in records.values():
+                r['file_locations'] = self._extract_file_locations(r)
+            yield from sorted(records.values(), key=lambda k: k['datestamp'])
+            if checkpoint is not None and tokens is not None:
+                checkpoint(tokens)
+        if checkpoint is not None:
+            checkpoint(None)
+
+    def list_sets(self):
+        """ Returns the spec of every set in the repository, or an empty list if the repository
+            doesn't support sets. The sets are only listed once, however many windows are
+            harvested.
+            """
+        if self.set_specs is None:
+            try:
+                self.set_specs = [set_spec for set_spec, _, _ in self.client.listSets()]
+            except NoSetHierarchyError:
+                logging.info('Repository has no sets, harvesting it as a whole')
+                self.set_specs = []
+            logging.info('Got [%s] sets', len(self.set_specs))
+        return self.set_specs
+
+    def _fetch_pages_from(self, from_datetime, until_datetime, resumption_tokens,
+                          unprocessed_filter, set_spec=None):
+        # Yields each page of records harvested with the configured strategy, paired with the
+        # resumption tokens to continue the harvest from, or None if it can't be continued yet.
+        if self.harvest_strategy == 'identifiers':
+            return (
+                (records, {'identifiers': token} if token else None)
+                for records, token in self._fetch_unprocessed_pages_from(
+                    from_datetime, until_datetime, resumption_tokens.get('identifiers'),
+                    unprocessed_filter, set_spec)
+            )
+        elif self.use_ore:
+            return self._fetch_joined_pages_from(
+                from_datetime, until_datetime, resumption_tokens, set_spec)
+        return (
+            (records, {'oai_dc': token} if token else None)
+            for records, token in self._fetch_pages_by_prefix_from(
+                'oai_dc', from_datetime, until_datetime, resumption_tokens.get('oai_dc'),
+                set_spec)
+        )
+
+    def _fetch_set_pages_from(self, set_specs, from_datetime, until_datetime, unprocessed_filter,
+                              set_watermarks, set_complete):
+        """ Harvests each set in its own window on a pool of worker threads, yielding each page
+            of records as it arrives with every record tagged with the spec of its set. Records
+            that belong to more than one set are only yielded the first time they are seen.
+            """
+        set_queue = Queue()
+        for set_spec in set_specs:
+            set_from_datetime = max(from_datetime, set_watermarks.get(set_spec, from_datetime))
+            if until_datetime is not None and set_from_datetime >= until_datetime:
+                logging.info('Set [%s] already harvested to [%s], skipping', set_spec,
+                             set_watermarks[set_spec])
+                continue
+            set_queue.put((set_spec, set_from_datetime))
+        page_queue = Queue(maxsize=PAGE_QUEUE_SIZE)
+        stop_event = Event()
+        remaining = set_queue.qsize()
+        for worker in range(min(self.set_workers, remaining)):
+            Thread(
+                target=self._fetch_sets_into_queue,
+                args=(set_queue, until_datetime, unprocessed_filter, page_queue, stop_event),
+                name='OAIPMHSetHarvester-{}'.format(worker),
+                daemon=True
+            ).start()
+
+        seen_identifiers = set()
+        try:
+            while remaining:
+                set_spec, records = page_queue.get()
+                if isinstance(records, Exception):
+                    raise records
+                if records is None:
+                    # Every page of this set has been yielded, and so consumed, by now.
+                    remaining -= 1
+                    logging.info('Finished harvesting set [%s], [%s] sets remaining', set_spec,
+                                 remaining)
+                    if set_complete is not None:
+                        set_complete(set_spec)
+                    continue
+                new_records = {}
+                for identifier, record in records.items():
+                    if identifier not in seen_identifiers:
+                        seen_identifiers.add(identifier)
+                        new_records[identifier] = dict(record, set_spec=set_spec)
+                yield new_records, None
+        finally:
+            # Tell the workers to stop, in case the consumer has stopped iterating early.
+            stop_event.set()
+
+    def _fetch_sets_into_queue(self, set_queue, until_datetime, unprocessed_filter, page_queue,
+                               stop_event):
+        """ Harvests sets from the given queue until it is empty, putting each page onto the
+            page queue followed by None once a set is complete, or the exception if it fails.
+            """
+        while not stop_event.is_set():
+            try:
+                set_spec, from_datetime = set_queue.get_nowait()
+            except Empty:
+                return
+            try:
+                for records, _ in self._fetch_pages_from(
+                        from_datetime, until_datetime, {}, unprocessed_filter, set_spec):
+                    if not self._put_page(page_queue, (set_spec, records), stop_event):
+                        logging.info('Stopping harvest of set [%s] early', set_spec)
+                        return
+                self._put_page(page_queue, (set_spec, None), stop_event)
+            except Exception as e:
+                logging.exception('An error occurred harvesting set [%s]', set_spec)
+                self._put_page(page_queue, (set_spec, e), stop_event)
+                return
+
+    def _fetch_joined_pages_from(self, from_datetime, until_datetime=None, resumption_tokens=None,
+                                 set_spec=None):
+        """ Harvests the `oai_dc` and `ore` records concurrently, joining them by identifier as
+            the pages arrive. A dict of joined records is yielded as soon as both halves of a
+            record have been seen, so only the records one harvest is ahead of the other by are
+            held in memory. Each dict is paired with the resumption tokens to continue both
+            harvests from, when nothing is left waiting to be joined, or None otherwise.
+            """
+        resumption_tokens = resumption_tokens or {}
+        page_queue = Queue(maxsize=PAGE_QUEUE_SIZE)
+        stop_event = Event()
+        pending = {'oai_dc': {}, 'ore': {}}
+        tokens = {}
+        running = set()
+        started = set()
+
+        def start_harvest(metadata_prefix):
+            running.add(metadata_prefix)
+            started.add(metadata_prefix)
+            harvester = Thread(
+                target=self._fetch_pages_into_queue,
+                args=(metadata_prefix, from_datetime, until_datetime,
+                      resumption_tokens.get(metadata_prefix), page_queue, stop_event, set_spec),
+                name='OAIPMHHarvester-{}'.format(metadata_prefix),
+                daemon=True
+            )
+            logging.info('Starting %s harvester [%s]', metadata_prefix, harvester)
+            harvester.start()
+
+        start_harvest('oai_dc')
+        if 'ore' in resumption_tokens:
+            start_harvest('ore')
+        try:
+            while running:
+                metadata_prefix, records, token = page_queue.get()
+                if isinstance(records, Exception):
+                    raise records
+                if records is None:
+                    running.discard(metadata_prefix)
+                    continue
+                if metadata_prefix == 'oai_dc' and records and 'ore' not in started:
+                    # Only query for ORE once we know there are DC records to attach it to.
+                    start_harvest('ore')
+                tokens[metadata_prefix] = token
+                other_pending = pending['ore' if metadata_prefix == 'oai_dc' else 'oai_dc']
+                joined_records = {}
+                for identifier, record in records.items():
+                    if identifier in other_pending:
+                        joined_records[identifier] = {**record, **other_pending.pop(identifier)}
+                    else:
+                        pending[metadata_prefix][identifier] = record
+                # Both harvests can only be resumed from here if neither is holding records that
+                # are waiting for the other half.
+                resumable = not pending['oai_dc'] and not pending['ore'] and \
+                    tokens.get('oai_dc') and tokens.get('ore')
+                if joined_records or resumable:
+                    yield joined_records, dict(tokens) if resumable else None
+            if pending['oai_dc']:
+                logging.warning('No ore records found for identifiers [%s], skipping',
+                                ', '.join(pending['oai_dc']))
+        finally:
+            # Tell the harvesters to stop, in case the consumer has stopped iterating early.
+            stop_event.set()
+
+    def _fetch_pages_into_queue(self, metadata_prefix, from_datetime, until_datetime,
+                                resumption_token, page_queue, stop_event, set_spec=None):
+        """ Runs a harvest for a single metadata prefix, putting each page onto the given queue
+            followed by None once the harvest is complete, or the exception if it fails.
+            """
         try:
-            if not until_datetime:
-                logging.info('Querying for %s records from [%s]', metadata_prefix, from_datetime)
-                # Fetch all records since the given from_datetime parameter.
-                records = self.client.listRecords(
-                    metadataPrefix=metadata_prefix, from_=from_datetime)
-                logging.info('Got %s records since [%s]', metadata_prefix, from_datetime)
-            else:
-                logging.info(
-                    'Querying for %s records from [%s] to [%s]', metadata_prefix,
-                    from_datetime, until_datetime)
-                # Fetch all records between the given from_datetime and the given until_datetime
-                records = self.client.listRecords(
-                    metadataPrefix=metadata_prefix, from_=from_datetime, until=until_datetime)
-                logging.info('Got %s records between [%s] and [%s]',
-                             metadata_prefix, from_datetime, until_datetime)
-
-            if not records:
-                return []
-            else:
-                return dict(self._structured_record(metadata_prefix, r) for r in records)
+            for records, token in self._fetch_pages_by_prefix_from(
+                    metadata_prefix, from_datetime, until_datetime, resumption_token, set_spec):
+                if not self._put_page(page_queue, (metadata_prefix, records, token), stop_event):
+                    logging.info('Stopping %s harvest early', metadata_prefix)
+                    return
+            self._put_page(page_queue, (metadata_prefix, None, None), stop_event)
+        except Exception as e:
+            logging.exception('An error occurred harvesting %s records', metadata_prefix)
+            self._put_page(page_queue, (metadata_prefix, e, None), stop_event)
+
+    def _put_page(self, page_queue, item, stop_event):
+        # Block while the queue is full, but give up if the consumer has gone away.
+        while not stop_event.is_set():
+            try:
+                page_queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _fetch_unprocessed_pages_from(self, from_datetime, until_datetime=None,
+                                      resumption_token=None, unprocessed_filter=None,
+                                      set_spec=None):
+        """ Yields a dict of structured records for each page of a ListIdentifiers response,
+            along with the resumption token for the next page. Only the records whose
+            identifiers pass `unprocessed_filter` are fetched, one GetRecord at a time.
+            """
+        for headers, token in self._fetch_identifier_pages_from(
+                from_datetime, until_datetime, resumption_token, set_spec):
+            identifiers = [h.identifier() for h in headers if not h.isDeleted()]
+            if unprocessed_filter is not None:
+                identifiers = unprocessed_filter(identifiers)
+            logging.info('Fetching [%s] of [%s] records listed since [%s]',
+                         len(identifiers), len(headers), from_datetime)
+            yield dict(self._fetch_records_by_identifier(identifiers)), token
+
+    def _fetch_identifier_pages_from(self, from_datetime, until_datetime=None,
+                                     resumption_token=None, set_spec=None):
+        # Yields each page of headers from a ListIdentifiers response, with the resumption token
+        # for the next page.
+        request_args = self._request_args('ListIdentifiers', 'oai_dc', from_datetime,
+                                          until_datetime, set_spec)
+        try:
+            yield from self._follow_resumption_tokens(
+                self._request_identifiers_page, request_args, resumption_token,
+                lambda headers: [h.identifier() for h in headers],
+                lambda headers, seen: [h for h in headers if h.identifier() not in seen])
+        except NoRecordsMatchError:
+            logging.info('No identifiers since [%s]', from_datetime)
+
+    def _request_identifiers_page(self, **request_args):
+        tree = self.client.makeRequestErrorHandling(**request_args)
+        return self.client.buildIdentifiers(self.client.getNamespaces(), tree)
+
+    def _fetch_records_by_identifier(self, identifiers):
+        # Yields each record in full, merging the ORE metadata into it if it is in use.
+        metadata_prefixes = ['oai_dc', 'ore'] if self.use_ore else ['oai_dc']
+        for identifier in identifiers:
+            record = {}
+            try:
+                for metadata_prefix in metadata_prefixes:
+                    records, _ = self._request_page(
+                        metadata_prefix,
+                        verb='GetRecord',
+                        identifier=identifier,
+                        metadataPrefix=metadata_prefix
+                    )
+                    record.update(records[identifier])
+            except (IdDoesNotExistError, CannotDisseminateFormatError):
+                logging.warning('Unable to get record [%s], skipping', identifier)
+                continue
+            yield identifier, record
+
+    def _fetch_pages_by_prefix_from(self, metadata_prefix, from_datetime, until_datetime=None,
+                                    resumption_token=None, set_spec=None):
+        """ Yields a dict of structured records, keyed by identifier, for each page of a
+            ListRecords response, along with the resumption token for the next page. Resumption
+            tokens are followed until the list is complete.
+            """
+        request_args = self._request_args('ListRecords', metadata_prefix, from_datetime,
+                                          until_datetime, set_spec)
+        try:
+            for page, (records, token) in enumerate(self._follow_resumption_tokens(
+                    partial(self._request_page, metadata_prefix), request_args,
+                    resumption_token, lambda records: records.keys(),
+                    lambda records, seen: {identifier: record
+                                           for identifier, record in records.items()
+                                           if identifier not in seen}), 1):
+                logging.info('Got page [%s] of %s records ([%s] records) since [%s]',
+                             page, metadata_prefix, len(records), from_datetime)
+                yield records, token
         except NoRecordsMatchError:
             # Annoyingly, the client throws an exception if no records are found...
             logging.info('No %s records since [%s]', metadata_prefix, from_datetime)
-            return []
 
-    def _merge_records(self, records_a, records_b):
-        merged_records = {}
-        for k, v in records_a.items():
-            merged_records[k] = {**v, **records_b[k]}
-        return merged_records
+    def _request_args(self, verb, metadata_prefix, from_datetime, until_datetime=None,
+                      set_spec=None):
+        request_args = {
+            'verb': verb,
+            'metadataPrefix': metadata_prefix,
+            'from': datetime_to_datestamp(from_datetime)
+        }
+        if not until_datetime:
+            logging.info('Querying for %s %s from [%s]', metadata_prefix, verb, from_datetime)
+        else:
+            logging.info(
+                'Querying for %s %s from [%s] to [%s]', metadata_prefix, verb,
+                from_datetime, until_datetime)
+            request_args['until'] = datetime_to_datestamp(until_datetime)
+        if set_spec is not None:
+            logging.info('Restricting %s %s to set [%s]', metadata_prefix, verb, set_spec)
+            request_args['set'] = set_spec
+        return request_args
+
+    def _resume_or_request(self, request_page, request_args, resumption_token):
+        # Continue an interrupted harvest from its resumption token, if we have one, falling back
+        # to the full request if the repository no longer accepts the token.
+        verb = request_args['verb']
+        if resumption_token is not None:
+            logging.info('Resuming %s %s from resumption token [%s]',
+                         request_args['metadataPrefix'], verb, resumption_token)
+            try:
+                return request_page(verb=verb, resumptionToken=resumption_token)
+            except BadResumptionTokenError:
+                logging.warning('Resumption token [%s] was rejected, restarting %s %s',
+                                resumption_token, request_args['metadataPrefix'], verb)
+        return request_page(**request_args)
+
+    def _follow_resumption_tokens(self, request_page, request_args, resumption_token,
+                                  page_identifiers, without_identifiers):
+        """ Yields each page of a list request, along with the resumption token for the next
+            page, following the tokens until the list is complete. If the repository rejects a
+            token part way through the list, e.g. one handed out by a cached page that has since
+            expired, the list is requested again from the start, leaving out of each page the
+            identifiers that have already been yielded.
+            """
+        page, token = self._resume_or_request(request_page, request_args, resumption_token)
+        seen = set()
+        restarted = False
+        while True:
+            yield page, token
+            if token is None:
+                return
+            seen.update(page_identifiers(page))
+            try:
+                page, token = request_page(verb=request_args['verb'], resumptionToken=token)
+            except BadResumptionTokenError:
+                if restarted:
+                    raise
+                logging.warning('Resumption token [%s] was rejected part way through, restarting '
+                                '%s %s', token, request_args['metadataPrefix'],
+                                request_args['verb'])
+                restarted = True
+                page, token = request_page(**request_args)
+            if restarted:
+                page = without_identifiers(page, seen)
+
+    def _request_page(self, metadata_prefix, **request_args):
+        """ Requests a single page of records, returning a dict of structured records keyed by
+            identifier and the resumption token for the next page.
+            """
+        if self.record_parser is not None:
+            return self.record_parser.parse(
+                metadata_prefix, self.client.makeRequest(**request_args))
+        tree = self.client.makeRequestErrorHandling(**request_args)
+        records, token = self.client.buildRecords(
+            metadata_prefix,
+            self.client.getNamespaces(),
+            self.client.getMetadataRegistry(),
+            tree
+        )
+        return dict(self._structured_record(metadata_prefix, r) for r in records), token
 
     def _filter_empty_records(self, records):
         """ Records that have been deleted will exist in the oai-pmh output, but will not have
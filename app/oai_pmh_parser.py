@@ -0,0 +1,95 @@
+import logging
+
+from io import BytesIO
+from lxml import etree
+from oaipmh import error
+from oaipmh.datestamp import datestamp_to_datetime
+from .oaiore.reader import compile_fields
+
+OAI_NAMESPACE = 'http://www.openarchives.org/OAI/2.0/'
+RECORD_TAG = '{%s}record' % OAI_NAMESPACE
+RESUMPTION_TOKEN_TAG = '{%s}resumptionToken' % OAI_NAMESPACE
+ERROR_TAG = '{%s}error' % OAI_NAMESPACE
+
+# The OAI-PMH error codes that pyoai has an exception class for.
+KNOWN_ERROR_CODES = [
+    'badArgument', 'badResumptionToken', 'badVerb', 'cannotDisseminateFormat', 'idDoesNotExist',
+    'noRecordsMatch', 'noMetadataFormats', 'noSetHierarchy'
+]
+
+
+class IterparseRecordParser(object):
+    """ Parses ListRecords responses with `lxml.etree.iterparse`, converting each `<record>` into
+        the same dict that `OAIPMHClient._structured_record` builds from pyoai's DOM, and clearing
+        it as soon as it has been converted. This keeps peak memory close to the size of a single
+        record, rather than several times the size of the page.
+        """
+
+    def __init__(self, readers):
+        namespaces = {'oai': OAI_NAMESPACE}
+        self.identifier = etree.XPath(
+            'string(oai:header/oai:identifier/text())', namespaces=namespaces)
+        self.datestamp = etree.XPath(
+            'string(oai:header/oai:datestamp/text())', namespaces=namespaces)
+        self.metadata = etree.XPath('oai:metadata', namespaces=namespaces)
+        self.fields = {
+            metadata_prefix: self._compile_fields(reader)
+            for metadata_prefix, reader in readers.items()
+        }
+
+    def _compile_fields(self, reader):
+        # Readers that have already compiled their expressions can be reused as they are.
+        if hasattr(reader, '_compiled_fields'):
+            return reader._compiled_fields
+        return compile_fields(reader._fields, reader._namespaces)
+
+    def parse(self, metadata_prefix, xml):
+        """ Returns a dict of structured records keyed by identifier, along with the resumption
+            token for the next page, or None if this is the last page.
+            """
+        if isinstance(xml, str):
+            xml = xml.encode('utf-8')
+        records, token = {}, None
+        events = etree.iterparse(
+            BytesIO(xml),
+            events=('end',),
+            tag=(RECORD_TAG, RESUMPTION_TOKEN_TAG, ERROR_TAG)
+        )
+        for _, element in events:
+            if element.tag == ERROR_TAG:
+                self._raise_error(element)
+            elif element.tag == RESUMPTION_TOKEN_TAG:
+                token = (element.text or '').strip() or None
+            else:
+                identifier, record = self._structured_record(metadata_prefix, element)
+                records[identifier] = record
+            # Free the converted element, and any siblings already processed before it.
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        return records, token
+
+    def _structured_record(self, metadata_prefix, element):
+        identifier = self.identifier(element)
+        logging.info('Converting record [%s]', identifier)
+        metadata_nodes = self.metadata(element)
+        if metadata_nodes:
+            metadata = {
+                field_name: convert(xpath(metadata_nodes[0]))
+                for field_name, xpath, convert in self.fields[metadata_prefix]
+            }
+        else:
+            metadata = None
+        return identifier, {
+            'identifier': identifier,
+            'datestamp': datestamp_to_datetime(self.datestamp(element)),
+            metadata_prefix: metadata
+        }
+
+    def _raise_error(self, element):
+        # Mirror pyoai, which raises the exception matching the OAI-PMH error code.
+        code, message = element.get('code'), element.text
+        if code not in KNOWN_ERROR_CODES:
+            raise error.UnknownError(
+                'Unknown error code from server: %s, message: %s' % (code, message))
+        raise getattr(error, code[0].upper() + code[1:] + 'Error')(message)
@@ -0,0 +1,112 @@
+import logging
+import requests
+import time
+
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode
+from oaipmh.client import Error, retrieveFromUrlWaiting, urllib2, WAIT_DEFAULT, WAIT_MAX
+
+
+class TransportStats(object):
+    """ Counts the requests made by a transport, the bytes they transferred before and after
+        decompression and the time they took.
+        """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = 0
+        self.wire_bytes = 0
+        self.content_bytes = 0
+        self.elapsed_seconds = 0.0
+
+    def record(self, wire_bytes, content_bytes, elapsed_seconds):
+        with self.lock:
+            self.requests += 1
+            self.wire_bytes += wire_bytes
+            self.content_bytes += content_bytes
+            self.elapsed_seconds += elapsed_seconds
+
+    def __str__(self):
+        return '{} requests, {} bytes transferred ({} bytes decompressed) in {:.3f}s'.format(
+            self.requests, self.wire_bytes, self.content_bytes, self.elapsed_seconds)
+
+
+class UrllibTransport(object):
+    """ Issues OAI-PMH requests the way pyoai does out of the box, opening a new urllib
+        connection for every request.
+        """
+
+    def __init__(self):
+        self.stats = TransportStats()
+
+    def request(self, url, params):
+        start_time = time.time()
+        request = urllib2.Request(
+            url,
+            data=urlencode(params).encode('utf-8'),
+            headers={'User-Agent': 'pyoai'}
+        )
+        content = retrieveFromUrlWaiting(request)
+        self.stats.record(len(content), len(content), time.time() - start_time)
+        return content
+
+
+class PooledHTTPTransport(object):
+    """ Issues OAI-PMH requests over a pooled, keep-alive HTTP session that negotiates gzip or
+        deflate compression with the repository. OAI-PMH XML typically compresses very well.
+        """
+
+    def __init__(self, pool_size=4, connect_timeout=10, read_timeout=120):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = self._initialise_session(pool_size)
+        self.stats = TransportStats()
+
+    def _initialise_session(self, pool_size):
+        logging.info('Initialising pooled OAI-PMH HTTP session with pool size [%s]', pool_size)
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({
+            'User-Agent': 'pyoai',
+            'Accept-Encoding': 'gzip, deflate'
+        })
+        return session
+
+    def request(self, url, params):
+        # Like pyoai, honour 503 responses with a Retry-After header a limited number of times.
+        for _ in range(WAIT_MAX):
+            start_time = time.time()
+            response = self.session.post(url, data=params, timeout=self.timeout)
+            if response.status_code != 503:
+                break
+            retry_after = response.headers.get('Retry-After')
+            logging.warning('Got HTTP 503 from [%s], retrying after [%s] seconds', url,
+                            retry_after)
+            time.sleep(int(retry_after) if retry_after and retry_after.isdigit()
+                       else WAIT_DEFAULT)
+        else:
+            raise Error('Waited too often (more than %s times)' % WAIT_MAX)
+        response.raise_for_status()
+
+        content = response.content
+        elapsed_seconds = time.time() - start_time
+        wire_bytes = self._wire_bytes(response, content)
+        self.stats.record(wire_bytes, len(content), elapsed_seconds)
+        logging.info(
+            'Got [%s] bytes ([%s] bytes decompressed) from [%s] in [%.3f] seconds',
+            wire_bytes,
+            len(content),
+            url,
+            elapsed_seconds
+        )
+        return content
+
+    def _wire_bytes(self, response, content):
+        # The raw urllib3 response knows how many (possibly compressed) bytes were read off the
+        # socket; fall back to the decompressed size if that isn't available.
+        try:
+            return response.raw.tell() or len(content)
+        except (AttributeError, ValueError):
+            return len(content)
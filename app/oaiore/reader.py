@@ -1,51 +1,61 @@
 from lxml import etree
-from oaipmh.metadata import MetadataReader, Error, text_type
+from oaipmh.metadata import MetadataReader, Error
 from oaipmh import common
 
 
+def element_to_dict(element):
+    """ Converts a childless etree.Element to a dict.
+    """
+    d = {}
+    if element.attrib:
+        d.update((k, v) for k, v in element.attrib.items())
+    if element.text:
+        text = element.text.strip()
+        d['text'] = text
+    return d
+
+
+# Converts the result of a field's XPath expression into the value stored in the metadata map.
+# The expressions are compiled without "smart" strings, so plain strings come back rather than
+# lxml.etree._ElementUnicodeResult objects that hold a reference to the tree.
+FIELD_CONVERTERS = {
+    'bytes': str,
+    'bytesList': lambda values: [str(v) for v in values],
+    'text': str,
+    'textList': lambda values: [str(v) for v in values],
+    'dict': lambda values: [element_to_dict(v) for v in values]
+}
+
+
+def compile_fields(fields, namespaces):
+    """ Compiles each field's XPath expression once, returning a list of (field name, compiled
+        expression, converter) tuples.
+        """
+    compiled_fields = []
+    for field_name, (field_type, expr) in list(fields.items()):
+        if field_type not in FIELD_CONVERTERS:
+            raise Error('Unknown field type: %s' % field_type)
+        xpath = etree.XPath(expr, namespaces=namespaces, smart_strings=False)
+        compiled_fields.append((field_name, xpath, FIELD_CONVERTERS[field_type]))
+    return compiled_fields
+
+
 class OREMetadataReader(MetadataReader):
     """	Adds additional field_types to the MetadataReader found in the
         pyoai library to translate elements with attributes to dicts for
-        the OAI-ORE output.
+        the OAI-ORE output. The XPath expressions for each field are
+        compiled once, when the reader is created.
         """
 
-    def _element_to_dict(self, element):
-        """ Converts a childless etree.Element to a dict.
-        """
-        d = {}
-        if element.attrib:
-            d.update((k, v) for k, v in element.attrib.items())
-        if element.text:
-            text = element.text.strip()
-            d['text'] = text
-        return d
+    def __init__(self, fields, namespaces=None):
+        super(OREMetadataReader, self).__init__(fields, namespaces)
+        self._compiled_fields = compile_fields(self._fields, self._namespaces)
 
     def __call__(self, element):
-        map = {}
-        # create XPathEvaluator for this element
-        xpath_evaluator = etree.XPathEvaluator(element,
-                                               namespaces=self._namespaces)
-
-        e = xpath_evaluator.evaluate
-        # now extra field info according to xpath expr
-        for field_name, (field_type, expr) in list(self._fields.items()):
-            if field_type == 'bytes':
-                value = str(e(expr))
-            elif field_type == 'bytesList':
-                value = [str(item) for item in e(expr)]
-            elif field_type == 'text':
-                # make sure we get back unicode strings instead
-                # of lxml.etree._ElementUnicodeResult objects.
-                value = text_type(e(expr))
-            elif field_type == 'textList':
-                # make sure we get back unicode strings instead
-                # of lxml.etree._ElementUnicodeResult objects.
-                value = [text_type(v) for v in e(expr)]
-            elif field_type == 'dict':
-                value = [self._element_to_dict(v) for v in e(expr)]
-            else:
-                raise Error('Unknown field type: %s' % field_type)
-            map[field_name] = value
+        map = {
+            field_name: convert(xpath(element))
+            for field_name, xpath, convert in self._compiled_fields
+        }
         return common.Metadata(element, map)
 
 
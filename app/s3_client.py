@@ -2,75 +2,422 @@ import boto3
 import hashlib
 import base64
 import logging
+import math
 import ntpath
+import os
 
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
 from urllib.parse import urlparse
 
+from .bucket_index import BucketIndex
+
+# S3 rejects multipart uploads with parts smaller than this, apart from the last one, or with
+# more parts than this.
+MINIMUM_PART_SIZE = 5 * 1024 * 1024
+MAXIMUM_PARTS = 10000
+
+# Content-addressed objects are kept under this prefix, keyed by their MD5 checksum and size.
+CONTENT_PREFIX = 'content/'
+
+
+class UploadIntegrityError(IOError):
+    """ Raised when the object S3 assembled from a multipart upload isn't made of the parts that
+        were sent.
+        """
+    pass
+
 
 class S3Client(object):
 
-    def __init__(self, bucket_name):
+    def __init__(self, bucket_name, part_size=8 * 1024 * 1024, upload_concurrency=2,
+                 multipart_threshold=64 * 1024 * 1024, digest_index=None, skip_unchanged=False):
+        if upload_concurrency < 1:
+            # A multipart upload could never read its first part.
+            raise ValueError('Upload concurrency must be at least 1, not [{}]'.format(
+                upload_concurrency))
         self.bucket_name = bucket_name
+        self.part_size = max(part_size, MINIMUM_PART_SIZE)
+        self.upload_concurrency = upload_concurrency
+        self.multipart_threshold = multipart_threshold
+        # Given a `DigestIndex`, objects are keyed by their contents rather than their URL, so
+        # that a file shared by several records is only uploaded once.
+        self.digest_index = digest_index
         self.client = self._initialise_client()
+        # Otherwise, with `skip_unchanged` set, a file isn't uploaded again if the object under
+        # its key already holds the same bytes.
+        self.bucket_index = BucketIndex(self.client, bucket_name) \
+            if skip_unchanged and digest_index is None else None
 
     def _initialise_client(self):
         logging.info('Initialising Boto3 S3 client')
         return boto3.client('s3')
 
-    def push_to_bucket(self, remote_url, file_path):
-        # Get a handle on the S3 object key
-        object_key = self._build_object_key(remote_url)
+    def push_to_bucket(self, remote_url, file_path, md5_checksum=None, sha256_checksum=None,
+                       part_digests=None):
+        # Only read the file to checksum it if the caller didn't calculate it while downloading.
+        if md5_checksum is None:
+            md5_checksum = self._calculate_file_checksum(file_path)
+        file_size = os.path.getsize(file_path)
+
+        # Get a handle on the S3 object key, and skip the upload if it's already in the bucket.
+        object_key = self._object_key(remote_url, md5_checksum, file_size)
+        indexed_object = self._indexed_object(
+            remote_url, object_key, file_size, md5_checksum, sha256_checksum,
+            self._upload_etag(file_size, md5_checksum, part_digests))
+        if indexed_object is not None:
+            return indexed_object
 
-        # Push the file into S3. By using the upload_fileobj method, this upload will be executed
-        # using multipart uplaods.
+        # Push the file into S3, in parts uploaded in parallel if it's larger than the multipart
+        # threshold.
         logging.info(
             'Pushing file [%s] to S3 Bucket [%s] with key [%s]',
             file_path,
             self.bucket_name,
             object_key
         )
-        md5_checksum = self._calculate_file_checksum(file_path)
         with open(file_path, 'rb') as data:
-            self.client.put_object(
-                Body=data,
-                Bucket=self.bucket_name,
-                Key=object_key,
-                ContentMD5=md5_checksum,
-                Metadata={
-                    'md5chksum': md5_checksum
-                }
-            )
+            if file_size > self.multipart_threshold:
+                # A single request is limited to 5GB, and only uses one connection.
+                part_size = self._file_part_size(file_size)
+                _, etag = self._multipart_upload(
+                    object_key,
+                    self._read_part(data, part_size),
+                    data,
+                    [],
+                    self._checksum_metadata(md5_checksum, sha256_checksum),
+                    part_size
+                )
+            else:
+                etag = self.client.put_object(
+                    Body=data,
+                    Bucket=self.bucket_name,
+                    Key=object_key,
+                    ContentMD5=md5_checksum,
+                    Metadata=self._checksum_metadata(md5_checksum, sha256_checksum)
+                )['ETag']
         logging.info(
             'Finished pushing file [%s] to S3 Bucket [%s] with key [%s]',
             file_path,
             self.bucket_name,
             object_key
         )
+        self._index_object(object_key, file_size, etag)
+
+        # Build up a dict of object metadata that is consumable by the caller of this method. S3
+        # checked the upload against its MD5, so its size is the size of the local file.
+        return self._object_metadata(
+            object_key, file_size, md5_checksum, sha256_checksum, etag, remote_url)
 
-        # Now we want to fetch some metadata about the object, specifically the size of the file.
+    def push_data_to_bucket(self, remote_url, data, md5_checksum, sha256_checksum=None):
+        """ Pushes a file held in memory into S3 in one request.
+            """
+        object_key = self._object_key(remote_url, md5_checksum, len(data))
+        indexed_object = self._indexed_object(
+            remote_url, object_key, len(data), md5_checksum, sha256_checksum)
+        if indexed_object is not None:
+            return indexed_object
         logging.info(
-            'Fetching S3 object metadata for object [%s] in S3 Bucket [%s]',
-            object_key,
-            self.bucket_name
+            'Pushing [%s] bytes to S3 Bucket [%s] with key [%s]',
+            len(data),
+            self.bucket_name,
+            object_key
         )
-        response = self.client.head_object(
+        etag = self.client.put_object(
+            Body=data,
             Bucket=self.bucket_name,
-            Key=object_key
-        )
+            Key=object_key,
+            ContentMD5=md5_checksum,
+            Metadata=self._checksum_metadata(md5_checksum, sha256_checksum)
+        )['ETag']
+        self._index_object(object_key, len(data), etag)
+        return self._object_metadata(
+            object_key, len(data), md5_checksum, sha256_checksum, etag, remote_url)
+
+    def push_stream_to_bucket(self, remote_url, stream, sha256=False):
+        """ Pushes the contents of a file-like object, such as an HTTP response body, into S3
+            without writing it to disk. Streams of more than one part are sent as a multipart
+            upload, uploading parts while the next is read, so at most `upload_concurrency + 1`
+            parts are held in memory. Checksums are calculated as the stream is read, including a
+            SHA-256 checksum if `sha256` is set.
+
+            The checksum of a stream of more than one part isn't known until it has been
+            uploaded, so such a stream is keyed by its URL even when objects are keyed by their
+            contents.
+            """
+        hashes = [hashlib.md5()] + ([hashlib.sha256()] if sha256 else [])
+        part = self._read_part(stream)
+        for hash_ in hashes:
+            hash_.update(part)
+        if len(part) < self.part_size:
+            # The whole stream fits in one part, so there's no need for a multipart upload.
+            md5_checksum = base64.b64encode(hashes[0].digest()).decode('utf-8')
+            sha256_checksum = hashes[1].hexdigest() if sha256 else None
+            object_key = self._object_key(remote_url, md5_checksum, len(part))
+            indexed_object = self._indexed_object(
+                remote_url, object_key, len(part), md5_checksum, sha256_checksum)
+            if indexed_object is not None:
+                return indexed_object
+            logging.info(
+                'Streaming [%s] to S3 Bucket [%s] with key [%s]',
+                remote_url,
+                self.bucket_name,
+                object_key
+            )
+            etag = self.client.put_object(
+                Body=part,
+                Bucket=self.bucket_name,
+                Key=object_key,
+                ContentMD5=md5_checksum,
+                Metadata=self._checksum_metadata(md5_checksum, sha256_checksum)
+            )['ETag']
+            self._index_object(object_key, len(part), etag)
+            file_size = len(part)
+        else:
+            object_key = self._build_object_key(remote_url)
+            logging.info(
+                'Streaming [%s] to S3 Bucket [%s] with key [%s]',
+                remote_url,
+                self.bucket_name,
+                object_key
+            )
+            file_size, etag = self._multipart_upload(object_key, part, stream, hashes)
+            self._index_object(object_key, file_size, etag)
+            md5_checksum = base64.b64encode(hashes[0].digest()).decode('utf-8')
+            sha256_checksum = hashes[1].hexdigest() if sha256 else None
         logging.info(
-            'Got S3 object metadata for object [%s] in S3 Bucket [%s]',
-            object_key,
-            self.bucket_name
+            'Finished streaming [%s] bytes to S3 Bucket [%s] with key [%s]',
+            file_size,
+            self.bucket_name,
+            object_key
         )
+        return self._object_metadata(
+            object_key, file_size, md5_checksum, sha256_checksum, etag, remote_url)
 
-        # Build up a dict of object metadata that is consumable by the caller of this method.
-        return {
-            'file_name': ntpath.basename(object_key),
+    def audit_objects(self, s3_objects):
+        """ Checks that the given objects, as returned by the push methods, are in the bucket with
+            the size and ETag they were uploaded with, returning those that aren't. Rather than a
+            HEAD request for each object, the objects under each prefix are listed together.
+            """
+        expected = {s3_object['file_path']: s3_object for s3_object in s3_objects}
+        found = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for prefix in sorted({self._listing_prefix(key) for key in expected}):
+            logging.info('Listing objects with prefix [%s] in S3 Bucket [%s]', prefix,
+                         self.bucket_name)
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+                for listed in page.get('Contents', []):
+                    if listed['Key'] in expected:
+                        found[listed['Key']] = listed
+        mismatched = []
+        for key, s3_object in expected.items():
+            listed = found.get(key)
+            if listed is None or listed['Size'] != s3_object['file_size'] or \
+                    s3_object.get('etag') not in (None, listed['ETag']):
+                logging.error('S3 object [%s] is [%s], expected [%s]', key, listed, s3_object)
+                mismatched.append(s3_object)
+        return mismatched
+
+    def verify_objects(self, s3_objects):
+        """ Raises `UploadIntegrityError` unless every one of the given objects passes
+            `audit_objects`.
+            """
+        mismatched = self.audit_objects(s3_objects)
+        if mismatched:
+            raise UploadIntegrityError('S3 objects %s do not match what was uploaded' %
+                                       [s3_object['file_path'] for s3_object in mismatched])
+
+    def _listing_prefix(self, object_key):
+        # Every content-addressed object shares one prefix, so listing it would list the whole
+        # store. Each of those is listed by its own key instead.
+        if object_key.startswith(CONTENT_PREFIX):
+            return object_key
+        prefix = object_key.rpartition('/')[0]
+        return prefix + '/' if prefix else ''
+
+    def _checksum_metadata(self, md5_checksum, sha256_checksum):
+        metadata = {'md5chksum': md5_checksum}
+        if sha256_checksum is not None:
+            metadata['sha256chksum'] = sha256_checksum
+        return metadata
+
+    def _object_metadata(self, object_key, file_size, md5_checksum, sha256_checksum=None,
+                         etag=None, remote_url=None):
+        # A content-addressed object is named after the file it was pushed for, not its key.
+        object_metadata = {
+            'file_name': ntpath.basename(
+                self._build_object_key(remote_url) if remote_url is not None else object_key),
             'file_path': object_key,
-            'file_size': response['ContentLength'],
+            'file_size': file_size,
             'file_checksum': md5_checksum,
-            'download_url': 's3://{}/{}'.format(self.bucket_name, object_key)
+            'download_url': 's3://{}/{}'.format(self.bucket_name, object_key),
+            'etag': etag
         }
+        if sha256_checksum is not None:
+            object_metadata['file_checksum_sha256'] = sha256_checksum
+        return object_metadata
+
+    def _multipart_upload(self, object_key, first_part, stream, hashes, metadata=None,
+                          part_size=None):
+        # Unless the caller already knows it, the whole object's checksum isn't known until the
+        # stream has been read, so can't be stored as metadata. Each part is checked by S3
+        # instead, and the parts S3 assembled are checked against the ones sent.
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=object_key,
+            Metadata=metadata or {}
+        )['UploadId']
+        buffers = BoundedSemaphore(self.upload_concurrency)
+        futures = []
+        file_size = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.upload_concurrency) as executor:
+                part = first_part
+                while part:
+                    # Wait for a part to finish uploading before reading another into memory.
+                    buffers.acquire()
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+                    future = executor.submit(
+                        self._upload_part, object_key, upload_id, len(futures) + 1, part)
+                    future.add_done_callback(lambda f: buffers.release())
+                    futures.append(future)
+                    file_size += len(part)
+                    part = self._read_part(stream, part_size)
+                    for hash_ in hashes:
+                        hash_.update(part)
+                parts, digests = zip(*[future.result() for future in futures])
+            self._verify_part_etags(object_key, parts, digests)
+            etag = self.client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=object_key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': list(parts)}
+            )['ETag']
+        except Exception:
+            logging.exception('Aborting multipart upload of object [%s]', object_key)
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=object_key,
+                UploadId=upload_id
+            )
+            raise
+        self._verify_multipart_etag(object_key, etag, parts, digests)
+        return file_size, etag
+
+    def _verify_part_etags(self, object_key, parts, digests):
+        # S3 gives each part the MD5 of its bytes as its ETag, so anything else means it didn't
+        # store what was sent, or the object is encrypted in a way that leaves nothing to check
+        # it against. Either way the upload is aborted rather than trusted.
+        for part, digest in zip(parts, digests):
+            if part['ETag'].strip('"') != digest.hex():
+                raise UploadIntegrityError('Part %s of object %s has ETag %s rather than %s' %
+                                           (part['PartNumber'], object_key, part['ETag'],
+                                            digest.hex()))
+
+    def _verify_multipart_etag(self, object_key, etag, parts, digests):
+        # S3 gives a multipart object the MD5 of its parts' MD5s as its ETag.
+        expected_etag = '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+        if etag.strip('"') != expected_etag:
+            logging.error('Deleting object [%s] with ETag [%s], expected [%s]', object_key, etag,
+                          expected_etag)
+            self.client.delete_object(Bucket=self.bucket_name, Key=object_key)
+            raise UploadIntegrityError('Object %s has ETag %s rather than %s' %
+                                       (object_key, etag, expected_etag))
+
+    def _upload_part(self, object_key, upload_id, part_number, part):
+        part_digest = hashlib.md5(part).digest()
+        part_checksum = base64.b64encode(part_digest).decode('utf-8')
+        logging.info('Uploading part [%s] ([%s] bytes) of object [%s]', part_number, len(part),
+                     object_key)
+        response = self.client.upload_part(
+            Body=part,
+            Bucket=self.bucket_name,
+            Key=object_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            ContentMD5=part_checksum
+        )
+        return {'ETag': response['ETag'], 'PartNumber': part_number}, part_digest
+
+    def _read_part(self, stream, part_size=None):
+        # File-like objects may return less than was asked for before the end of the stream.
+        part_size = part_size or self.part_size
+        chunks, size = [], 0
+        while size < part_size:
+            chunk = stream.read(part_size - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        return b''.join(chunks)
+
+    def _object_key(self, remote_url, md5_checksum, file_size):
+        if self.digest_index is None:
+            return self._build_object_key(remote_url)
+        return '{}{}-{}'.format(CONTENT_PREFIX, base64.b64decode(md5_checksum).hex(), file_size)
+
+    def _indexed_object(self, remote_url, object_key, file_size, md5_checksum, sha256_checksum,
+                        upload_etag=None):
+        # Returns the object already in the bucket that holds the file's contents, if there is
+        # one. `upload_etag` is the ETag a multipart upload of the file would have, if known.
+        if self.digest_index is not None:
+            # An object with the same checksum and size as the file holds its contents.
+            etag = self.digest_index.get(object_key)
+        elif self.bucket_index is not None:
+            # The object under the file's key holds its contents if it has the same size, and
+            # the ETag S3 would give the file.
+            listed = self.bucket_index.get(object_key)
+            etag = None
+            if listed is not None and listed['Size'] == file_size and self._holds_contents(
+                    object_key, listed['ETag'], md5_checksum, upload_etag):
+                etag = listed['ETag']
+                self.bucket_index.record_hit()
+        else:
+            etag = None
+        if etag is None:
+            return None
+        logging.info('S3 object [%s] already holds the contents of [%s], skipping upload',
+                     object_key, remote_url)
+        return self._object_metadata(
+            object_key, file_size, md5_checksum, sha256_checksum, etag, remote_url)
+
+    def _index_object(self, object_key, file_size, etag):
+        if self.digest_index is not None:
+            # Streams keyed by their URL may change, so they aren't indexed by their contents.
+            if object_key.startswith(CONTENT_PREFIX):
+                self.digest_index.put(object_key, etag)
+        elif self.bucket_index is not None:
+            self.bucket_index.put(object_key, file_size, etag)
+
+    def _file_part_size(self, file_size):
+        # The part size grows if need be to keep within S3's limit on the number of parts.
+        return max(self.part_size, math.ceil(file_size / MAXIMUM_PARTS))
+
+    def _upload_etag(self, file_size, md5_checksum, part_digests):
+        # The ETag `push_to_bucket` gives a file, if it can be worked out without reading the
+        # file again. That of a multipart upload is the MD5 of its parts' MD5s, so needs the
+        # file's `PartDigests` at the part size it would be uploaded with.
+        if file_size <= self.multipart_threshold:
+            return base64.b64decode(md5_checksum).hex()
+        if part_digests is None or part_digests.part_size != self._file_part_size(file_size):
+            return None
+        digests = part_digests.part_md5s()
+        return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+    def _holds_contents(self, object_key, listed_etag, md5_checksum, upload_etag):
+        # An object uploaded in one request has the hex of its MD5 as its ETag, whatever its
+        # size. Otherwise it was uploaded in parts, and if the ETag that would give the file
+        # isn't known, or the parts were a different size, the object's MD5 is taken from the
+        # metadata it was uploaded with.
+        listed_etag = listed_etag.strip('"')
+        if listed_etag in (base64.b64decode(md5_checksum).hex(), upload_etag):
+            return True
+        if '-' not in listed_etag:
+            return False
+        metadata = self.client.head_object(Bucket=self.bucket_name, Key=object_key)['Metadata']
+        return metadata.get('md5chksum') == md5_checksum
 
     def _build_object_key(self, remote_url):
         # Strip the protocol, hostname and port off of the URL, leaving just the path behind. S3
@@ -2,16 +2,30 @@
 import json
 import logging
 import os
+import shutil
 import sys
+import tempfile
 import itertools
+import functools
+import time
 
+from collections import OrderedDict
+from contextlib import closing
+from app import CachingTransport
 from app import OAIPMHClient
+from app import DigestIndex
+from app import DiskBudget
+from app import DownloadCache
 from app import DownloadClient
+from app import DownloadTimeoutError
 from app import DynamoDBClient
+from app import HarvestWindowPlanner
+from app import IncompleteDownloadError
 from app import KinesisClient
 from app import MessageGenerator
 from app import MessageValidator
 from app import PoisonPill
+from app import PooledHTTPTransport
 from app import S3Client
 import datetime
 
@@ -28,6 +42,9 @@ kinesis_client = None
 message_generator = None
 message_validator = None
 s3_client = None
+transfer_mode = None
+record_timeout = None
+verify_uploads = False
 
 
 def main():
@@ -36,7 +53,7 @@ def main():
 
     # Initialise the various clients, generator, etc.
     global download_client
-    download_client = _initialise_download_client()
+    download_client = _initialise_download_client(settings)
     global dynamodb_client
     dynamodb_client = _initialise_dynamodb_client(settings)
     global oai_pmh_client
@@ -48,15 +65,53 @@ def main():
     global message_validator
     message_validator = _initialise_message_validator(settings)
     global s3_client
-    s3_client = _initialise_s3_client(settings)
-
-    def get_records(start_timestamp, until_timestamp=None):
-        """ """
-        flow_limit = int(settings['OAI_PMH_ADAPTOR_FLOW_LIMIT'])
-        # Query OAI endpoint for all the records since the high watermark.
-        records = oai_pmh_client.fetch_records_from(start_timestamp, until_timestamp)
-        # Filter out records that have already been successfully processed
-        return itertools.islice(filter(_record_success_filter, records), flow_limit)
+    s3_client = _initialise_s3_client(settings, dynamodb_client)
+    global transfer_mode
+    transfer_mode = settings['DOWNLOAD_TRANSFER_MODE']
+    global record_timeout
+    record_timeout = float(settings['DOWNLOAD_RECORD_TIMEOUT'])
+    global verify_uploads
+    verify_uploads = settings['S3_VERIFY_UPLOADS'].lower() == 'true'
+
+    flow_limit = int(settings['OAI_PMH_ADAPTOR_FLOW_LIMIT'])
+    window_planner = _initialise_window_planner(settings, flow_limit)
+
+    # When harvesting sets separately, each set remembers the end of the last window it was
+    # completely harvested up to, so that it isn't harvested again when a window is revisited.
+    set_watermarks = dynamodb_client.fetch_set_high_watermarks() \
+        if oai_pmh_client.set_workers else None
+    completed_sets = {}
+
+    def get_records(start_timestamp, until_timestamp=None, resumption_tokens=None):
+        """ Lazily harvests the records since the given timestamp, page by page, so that no
+            further pages are fetched once one more than the flow limit has been reached.
+            """
+        records = []
+        window_completed_sets = set()
+
+        def checkpoint(tokens):
+            if tokens is None:
+                dynamodb_client.clear_harvest_checkpoint()
+            elif not records:
+                # The pages harvested so far can only be skipped on a restart if none of their
+                # records are still waiting to be processed.
+                dynamodb_client.update_harvest_checkpoint(
+                    start_timestamp, until_timestamp, tokens, high_watermark)
+
+        set_args = {}
+        if set_watermarks is not None:
+            set_args = {
+                'set_watermarks': set_watermarks,
+                'set_complete': window_completed_sets.add
+            }
+        # Query OAI endpoint for the records since the high watermark, filtering out those that
+        # have already been successfully processed a page at a time.
+        harvested_records = oai_pmh_client.stream_records_from(
+            start_timestamp, until_timestamp, resumption_tokens, checkpoint,
+            _unprocessed_identifiers_filter, **set_args)
+        for record in itertools.islice(harvested_records, flow_limit + 1):
+            records.append(record)
+        return records, window_completed_sets
 
     # Query DynamoDB for the high watermark. If it exists, use that, otherwise this is probably a
     # "first run", so set the watermark to a date in the past to catch all records.
@@ -64,35 +119,134 @@ def main():
     if start_timestamp is None:
         start_timestamp = datetime.datetime(2000, 1, 1, 0, 0)
         dynamodb_client.update_high_watermark(start_timestamp)
-
-    today = datetime.datetime.today()
-    records = []
-    while not records:
-        if start_timestamp.date() == today.date():
-            logging.info('Start timestamp %s is today %s', start_timestamp.date(), today.date())
-            records = get_records(start_timestamp)
-            break
+    high_watermark = start_timestamp
+
+    # If a previous run was interrupted part way through harvesting a window, and no records have
+    # been processed since, carry on from the last page it completed. The window may start after
+    # the high watermark, as walking forward across empty windows doesn't move the watermark, but
+    # the checkpoint is only used if the harvest started from the same high watermark. If the
+    # watermark has been reset since, the windows in between are to be harvested again.
+    checkpoint = dynamodb_client.fetch_harvest_checkpoint()
+    if checkpoint is not None:
+        if checkpoint['high_watermark'] == high_watermark:
+            logging.info('Resuming harvest checkpoint [%s]', checkpoint)
+            start_timestamp = checkpoint['from']
         else:
-            until_timestamp = start_timestamp + datetime.timedelta(days=1)
-            records = list(get_records(start_timestamp, until_timestamp))
-            start_timestamp = until_timestamp
-
-    for record in records:
+            logging.info('Ignoring harvest checkpoint [%s], high watermark has moved to [%s]',
+                         checkpoint, start_timestamp)
+            checkpoint = None
+
+    # Walk forward from the high watermark until we find a window with records to process. The
+    # planner widens the window across empty ranges and splits it when it holds too many records.
+    now = datetime.datetime.now()
+    while True:
+        if checkpoint is not None:
+            until_timestamp = checkpoint['until']
+            resumption_tokens = checkpoint['resumption_tokens']
+            checkpoint = None
+        else:
+            until_timestamp = window_planner.window_end(start_timestamp, now)
+            resumption_tokens = None
+        records, window_completed_sets = get_records(
+            start_timestamp, until_timestamp, resumption_tokens)
+        if len(records) > flow_limit and window_planner.split_window(
+                start_timestamp, until_timestamp or now):
+            continue
+        window_planner.record_window(start_timestamp, until_timestamp or now, len(records))
+        completed_sets.update(
+            (set_spec, until_timestamp or now) for set_spec in window_completed_sets)
+        if records or until_timestamp is None:
+            break
+        start_timestamp = until_timestamp
+    records = sorted(records, key=lambda k: k['datestamp'])
+
+    # The high watermark stops short of the first record whose files couldn't be transferred in
+    # time, so that the next run harvests it again. The records after it are still processed,
+    # and are skipped as already processed when they're harvested again.
+    retried_records = []
+    for record in records[:flow_limit]:
         logging.info('Processing record [%s]', record)
-        _process_record(record)
+        if not _process_record(record):
+            retried_records.append(record)
+        if not retried_records:
+            # Update the high watermark to the datestamp of this record.
+            dynamodb_client.update_high_watermark(record['datestamp'])
+
+    if set_watermarks is not None:
+        # A completed set can only move its watermark on if none of its records were left over,
+        # or are to be tried again.
+        for record in records[flow_limit:] + retried_records:
+            completed_sets.pop(record.get('set_spec'), None)
+        if completed_sets:
+            set_watermarks.update(completed_sets)
+            dynamodb_client.update_set_high_watermarks(set_watermarks)
 
     # We're done, shut down
     _shutdown()
 
 
-def _initialise_download_client():
-    return DownloadClient()
+def _initialise_download_client(settings):
+    return DownloadClient(
+        int(settings['DOWNLOAD_MAX_WORKERS']),
+        int(settings['DOWNLOAD_MAX_PER_HOST']),
+        int(settings['DOWNLOAD_POOL_SIZE']),
+        int(settings['DOWNLOAD_MAX_RETRIES']),
+        sha256=settings['DOWNLOAD_SHA256'].lower() == 'true',
+        partial_dir=settings['DOWNLOAD_PARTIAL_DIR'] or None,
+        segments=int(settings['DOWNLOAD_SEGMENTS']),
+        segment_min_size=int(settings['DOWNLOAD_SEGMENT_MIN_MB']) * 1024 * 1024,
+        buffer_size=int(settings['DOWNLOAD_BUFFER_KB']) * 1024,
+        cache=_initialise_download_cache(settings),
+        spool_size=int(settings['DOWNLOAD_SPOOL_MAX_KB']) * 1024,
+        disk_budget=_initialise_disk_budget(settings),
+        connect_timeout=float(settings['DOWNLOAD_CONNECT_TIMEOUT']),
+        read_timeout=float(settings['DOWNLOAD_READ_TIMEOUT']),
+        min_rate=float(settings['DOWNLOAD_STALL_MIN_KBPS']) * 1024,
+        stall_seconds=float(settings['DOWNLOAD_STALL_SECONDS']),
+        part_size=_download_part_size(settings)
+    )
+
+
+def _download_part_size(settings):
+    # Files are only compared with the objects already under their keys when skipping unchanged
+    # files, and then their part digests tell whether a multipart object holds the same bytes.
+    if settings['S3_SKIP_UNCHANGED'].lower() != 'true' or \
+            settings['S3_CONTENT_ADDRESSED'].lower() == 'true':
+        return None
+    return int(settings['S3_PART_SIZE_MB']) * 1024 * 1024
+
+
+def _initialise_disk_budget(settings):
+    if settings['DOWNLOAD_DISK_BUDGET_MB']:
+        max_bytes = int(settings['DOWNLOAD_DISK_BUDGET_MB']) * 1024 * 1024
+    else:
+        # Leave some room for everything else on the disk the downloads are written to.
+        download_dir = settings['DOWNLOAD_PARTIAL_DIR'] or tempfile.gettempdir()
+        max_bytes = int(shutil.disk_usage(download_dir).free * 0.9)
+    logging.info('Limiting downloads to [%s] bytes of disk', max_bytes)
+    return DiskBudget(max_bytes)
+
+
+def _initialise_download_cache(settings):
+    if not settings['DOWNLOAD_CACHE_DIR']:
+        return None
+    logging.info('Caching downloaded file validators in [%s]', settings['DOWNLOAD_CACHE_DIR'])
+    return DownloadCache(settings['DOWNLOAD_CACHE_DIR'])
+
+
+def _initialise_window_planner(settings, flow_limit):
+    return HarvestWindowPlanner(
+        flow_limit,
+        datetime.timedelta(days=float(settings['OAI_PMH_INITIAL_WINDOW_DAYS'])),
+        datetime.timedelta(days=float(settings['OAI_PMH_MAXIMUM_WINDOW_DAYS']))
+    )
 
 
 def _initialise_dynamodb_client(settings):
     return DynamoDBClient(
         settings['DYNAMODB_WATERMARK_TABLE_NAME'],
-        settings['DYNAMODB_PROCESSED_TABLE_NAME']
+        settings['DYNAMODB_PROCESSED_TABLE_NAME'],
+        settings['DYNAMODB_DIGEST_TABLE_NAME'] or None
     )
 
 
@@ -108,7 +262,30 @@ def _initialise_oai_pmh_client(settings):
                  )
     return OAIPMHClient(
         settings['OAI_PMH_ENDPOINT_URL'],
-        use_ore[settings['OAI_PMH_PROVIDER']]
+        use_ore[settings['OAI_PMH_PROVIDER']],
+        _initialise_oai_pmh_transport(settings),
+        settings['OAI_PMH_PARSER'],
+        settings['OAI_PMH_HARVEST_STRATEGY'],
+        int(settings['OAI_PMH_SET_WORKERS'])
+    )
+
+
+def _initialise_oai_pmh_transport(settings):
+    transport = PooledHTTPTransport(
+        int(settings['OAI_PMH_POOL_SIZE']),
+        float(settings['OAI_PMH_CONNECT_TIMEOUT']),
+        float(settings['OAI_PMH_READ_TIMEOUT'])
+    )
+    if not settings['OAI_PMH_CACHE_DIR']:
+        return transport
+    logging.info('Caching OAI-PMH responses in [%s] in [%s] mode',
+                 settings['OAI_PMH_CACHE_DIR'], settings['OAI_PMH_CACHE_MODE'])
+    return CachingTransport(
+        transport,
+        settings['OAI_PMH_CACHE_DIR'],
+        int(settings['OAI_PMH_CACHE_MAX_MB']) * 1024 * 1024,
+        settings['OAI_PMH_CACHE_MODE'],
+        float(settings['OAI_PMH_CACHE_TTL_HOURS']) * 60 * 60
     )
 
 
@@ -131,32 +308,50 @@ def _initialise_message_validator(settings):
     return MessageValidator(settings['RDSS_MESSAGE_API_SPECIFICATION_VERSION'])
 
 
-def _initialise_s3_client(settings):
-    return S3Client(settings['S3_BUCKET_NAME'])
+def _initialise_s3_client(settings, dynamodb_client):
+    upload_concurrency = int(settings['S3_UPLOAD_CONCURRENCY'])
+    if upload_concurrency < 1:
+        raise ValueError(
+            'S3_UPLOAD_CONCURRENCY must be at least 1, not [{}]'.format(upload_concurrency))
+    return S3Client(
+        settings['S3_BUCKET_NAME'],
+        int(settings['S3_PART_SIZE_MB']) * 1024 * 1024,
+        upload_concurrency,
+        int(settings['S3_MULTIPART_THRESHOLD_MB']) * 1024 * 1024,
+        _initialise_digest_index(settings, dynamodb_client),
+        settings['S3_SKIP_UNCHANGED'].lower() == 'true'
+    )
+
+
+def _initialise_digest_index(settings, dynamodb_client):
+    if settings['S3_CONTENT_ADDRESSED'].lower() != 'true':
+        return None
+    return DigestIndex(dynamodb_client)
 
 
-def _record_success_filter(record):
-    """ Filters out records that have already been processed successfully.
+def _unprocessed_identifiers_filter(identifiers):
+    """ Filters out the identifiers of records that have already been processed successfully.
         """
-    status = dynamodb_client.fetch_processed_status(record['identifier'])
-    logging.info(
-        'Got processed status [%s] for identifier [%s]',
-        status,
-        record['identifier']
-    )
-    if status == 'Success':
-        logging.info(
-            'Record [%s] already successfully processed, skipping',
-            record['identifier']
-        )
-        return False
-    else:
-        return True
+    statuses = dynamodb_client.fetch_processed_statuses(identifiers)
+    unprocessed = []
+    for identifier in identifiers:
+        if statuses.get(identifier) == 'Success':
+            logging.info(
+                'Record [%s] already successfully processed, skipping',
+                identifier
+            )
+        else:
+            unprocessed.append(identifier)
+    return unprocessed
 
 
 def _process_record(record):
+    """ Processes the given record, returning False if it failed only because its files couldn't
+        be transferred in time, so it should be tried again.
+        """
     logging.info('Processing record [%s]', record['identifier'])
     message, status, reason, err_code = None, 'Success', '-', None
+    retry = False
     try:
         # Fetch from EPrints and push the files associated with the record into S3.
         s3_objects = _push_files_to_s3(record)
@@ -183,6 +378,7 @@ def _process_record(record):
 
     except Exception as e:
         logging.exception('An error occurred processing EPrints record [%s]', record)
+        retry = isinstance(e, (DownloadTimeoutError, IncompleteDownloadError))
         if err_code is None:
             err_code = 'GENERR009'
         status, reason = 'Failure', str(e)
@@ -196,28 +392,83 @@ def _process_record(record):
         status,
         reason
     )
-
-    # Update the high watermark to the datestamp of this record.
-    dynamodb_client.update_high_watermark(record['datestamp'])
+    return not retry
 
 
 def _push_files_to_s3(record):
-    s3_file_locations = []
-    for file_location in record['file_locations']:
-        file_path = download_client.download_file(file_location)
-        if file_path is not None:
-            s3_file_locations.append(
-                s3_client.push_to_bucket(file_location, file_path)
-            )
-            try:
-                os.remove(file_path)
-            except FileNotFoundError:
-                logging.warning('An error occurred removing file [%s]', file_path)
-        else:
+    # Download the files concurrently, pushing each one into S3 as soon as it arrives, but keep
+    # the S3 objects in the same order as the file locations.
+    # A file that is still transferring when the record's time is up is aborted, failing the
+    # record so that it is tried again.
+    file_locations = list(OrderedDict.fromkeys(record['file_locations']))
+    deadline = time.time() + record_timeout if record_timeout else None
+    if transfer_mode == 'stream':
+        s3_file_locations = {
+            file_location: s3_object
+            for file_location, s3_object in download_client.transfer_files(
+                file_locations, functools.partial(_stream_file_to_s3, deadline=deadline))
+            if s3_object is not None
+        }
+    else:
+        s3_file_locations = _download_files_to_s3(file_locations, deadline)
+    s3_objects = [s3_file_locations[file_location] for file_location in record['file_locations']
+                  if file_location in s3_file_locations]
+    if verify_uploads:
+        # Check the record's objects against the bucket in one go, rather than each upload.
+        s3_client.verify_objects(s3_objects)
+    return s3_objects
+
+
+def _download_files_to_s3(file_locations, deadline=None):
+    s3_file_locations = {}
+    for file_location, download in download_client.download_files(file_locations, deadline):
+        if download is None:
             logging.warning('Unable to download file [%s], skipping file', file_location)
+        elif download.s3_object is not None:
+            # The file hasn't changed since it was last pushed to S3.
+            s3_file_locations[file_location] = download.s3_object
+        else:
+            s3_object = _push_download_to_s3(file_location, download)
+            _cache_s3_object(file_location, download.etag, download.last_modified, s3_object)
+            s3_file_locations[file_location] = s3_object
     return s3_file_locations
 
 
+def _push_download_to_s3(file_location, download):
+    # Small files are downloaded into memory rather than to disk.
+    if download.data is not None:
+        return s3_client.push_data_to_bucket(
+            file_location, download.data, download.md5, download.sha256)
+    try:
+        return s3_client.push_to_bucket(
+            file_location, download.file_path, download.md5, download.sha256,
+            download.part_digests)
+    finally:
+        download.discard()
+
+
+def _stream_file_to_s3(file_location, deadline=None):
+    # Stream the download straight into S3, without a temporary file.
+    response = download_client.open_download(file_location, deadline)
+    if response is None:
+        logging.warning('Unable to download file [%s], skipping file', file_location)
+        return None
+    with closing(response):
+        if response.status_code == 304:
+            return download_client.cache.s3_object(file_location)
+        s3_object = s3_client.push_stream_to_bucket(
+            file_location, download_client.watch(response, deadline), download_client.sha256)
+    _cache_s3_object(file_location, response.headers.get('ETag'),
+                     response.headers.get('Last-Modified'), s3_object)
+    return s3_object
+
+
+def _cache_s3_object(file_location, etag, last_modified, s3_object):
+    # Remember where the file went, so that it isn't transferred again unless it changes.
+    if download_client.cache is not None:
+        download_client.cache.put(file_location, etag, last_modified, s3_object)
+
+
 def _decorate_message_with_error(message, error_code, error_message):
     # We need to be able to get the message as a dict
     try:
@@ -254,8 +505,12 @@ def _parse_env_vars(env_var_names):
     return env_vars
 
 
+def _parse_optional_env_vars(env_var_defaults):
+    return {name: os.environ.get(name, default) for name, default in env_var_defaults.items()}
+
+
 def _get_settings():
-    return _parse_env_vars((
+    settings = _parse_env_vars((
         'OAI_PMH_PROVIDER',
         'OAI_PMH_ENDPOINT_URL',
         'JISC_ID',
@@ -268,10 +523,64 @@ def _get_settings():
         'RDSS_MESSAGE_API_SPECIFICATION_VERSION',
         'OAI_PMH_ADAPTOR_FLOW_LIMIT'
     ))
+    settings.update(_parse_optional_env_vars({
+        'OAI_PMH_INITIAL_WINDOW_DAYS': '1',
+        'OAI_PMH_MAXIMUM_WINDOW_DAYS': '3650',
+        'OAI_PMH_POOL_SIZE': '4',
+        'OAI_PMH_CONNECT_TIMEOUT': '10',
+        'OAI_PMH_READ_TIMEOUT': '120',
+        'OAI_PMH_PARSER': 'dom',
+        'OAI_PMH_HARVEST_STRATEGY': 'records',
+        'OAI_PMH_CACHE_DIR': '',
+        'OAI_PMH_CACHE_MAX_MB': '1024',
+        'OAI_PMH_CACHE_MODE': 'cache',
+        'OAI_PMH_CACHE_TTL_HOURS': '24',
+        'OAI_PMH_SET_WORKERS': '0',
+        'DOWNLOAD_MAX_WORKERS': '8',
+        'DOWNLOAD_MAX_PER_HOST': '2',
+        'DOWNLOAD_POOL_SIZE': '4',
+        'DOWNLOAD_MAX_RETRIES': '3',
+        'DOWNLOAD_TRANSFER_MODE': 'file',
+        'DOWNLOAD_SHA256': 'false',
+        'DOWNLOAD_PARTIAL_DIR': '',
+        'DOWNLOAD_SEGMENTS': '1',
+        'DOWNLOAD_SEGMENT_MIN_MB': '64',
+        'DOWNLOAD_BUFFER_KB': '1024',
+        'DOWNLOAD_CACHE_DIR': '',
+        'DOWNLOAD_SPOOL_MAX_KB': '4096',
+        'DOWNLOAD_DISK_BUDGET_MB': '',
+        'DOWNLOAD_CONNECT_TIMEOUT': '10',
+        'DOWNLOAD_READ_TIMEOUT': '60',
+        'DOWNLOAD_STALL_MIN_KBPS': '1',
+        'DOWNLOAD_STALL_SECONDS': '60',
+        'DOWNLOAD_RECORD_TIMEOUT': '3600',
+        'S3_PART_SIZE_MB': '8',
+        'S3_UPLOAD_CONCURRENCY': '2',
+        'S3_MULTIPART_THRESHOLD_MB': '64',
+        'S3_VERIFY_UPLOADS': 'false',
+        'S3_CONTENT_ADDRESSED': 'false',
+        'S3_SKIP_UNCHANGED': 'false',
+        'DYNAMODB_DIGEST_TABLE_NAME': ''
+    }))
+    return settings
 
 
 def _shutdown():
     logging.info('Shutting adaptor down...')
+    if oai_pmh_client is not None:
+        logging.info('OAI-PMH transport [%s] made %s', oai_pmh_client.transport,
+                     oai_pmh_client.transport.stats)
+    if download_client is not None:
+        logging.info('Downloaded %s', download_client.stats)
+        if download_client.cache is not None:
+            logging.info('Download cache [%s]', download_client.cache)
+        for host, stats in download_client.connection_stats().items():
+            logging.info('Made [%s] download requests to [%s] over [%s] connections',
+                         stats['requests'], host, stats['connections'])
+    if s3_client is not None and s3_client.digest_index is not None:
+        logging.info('Digest index [%s]', s3_client.digest_index)
+    if s3_client is not None and s3_client.bucket_index is not None:
+        logging.info('Bucket index [%s]', s3_client.bucket_index)
     if kinesis_client is not None:
         kinesis_client.put_message_on_queue(PoisonPill)
     if message_validator is not None:
@@ -0,0 +1,48 @@
+import threading
+
+from app.bucket_index import BucketIndex
+from mock import MagicMock
+
+
+def test_objects_are_listed_once_per_prefix():
+    client = MagicMock()
+    client.get_paginator.return_value.paginate.return_value = [
+        {'Contents': [{'Key': 'download/a.dat', 'Size': 1, 'ETag': '"a"'}]},
+        {'Contents': [{'Key': 'download/b.dat', 'Size': 2, 'ETag': '"b"'}]}
+    ]
+    bucket_index = BucketIndex(client, 'rdss-prints-adaptor-test-bucket')
+
+    # Verify that every page of the listing is indexed, and the prefix isn't listed again
+    assert bucket_index.get('download/a.dat') == {'Size': 1, 'ETag': '"a"'}
+    assert bucket_index.get('download/b.dat') == {'Size': 2, 'ETag': '"b"'}
+    assert bucket_index.get('download/c.dat') is None
+    client.get_paginator.return_value.paginate.assert_called_once_with(
+        Bucket='rdss-prints-adaptor-test-bucket', Prefix='download/')
+
+
+def test_listing_a_prefix_doesnt_hold_up_others():
+    listing = threading.Event()
+    released = threading.Event()
+
+    def paginate(Bucket, Prefix):
+        if Prefix == 'slow/':
+            listing.set()
+            released.wait(5)
+        return [{'Contents': [{'Key': Prefix + 'file.dat', 'Size': 1, 'ETag': '"e"'}]}]
+    client = MagicMock()
+    client.get_paginator.return_value.paginate.side_effect = paginate
+    bucket_index = BucketIndex(client, 'rdss-prints-adaptor-test-bucket')
+    results = []
+    slow = threading.Thread(target=lambda: results.append(bucket_index.get('slow/file.dat')))
+    slow.start()
+    listing.wait(5)
+
+    # Verify that objects under other prefixes, and uploaded ones, are looked up meanwhile
+    try:
+        assert bucket_index.get('fast/file.dat') == {'Size': 1, 'ETag': '"e"'}
+        bucket_index.put('slow/other.dat', 2, '"o"')
+    finally:
+        released.set()
+    slow.join(5)
+    assert results == [{'Size': 1, 'ETag': '"e"'}]
+    assert bucket_index.get('slow/other.dat') == {'Size': 2, 'ETag': '"o"'}
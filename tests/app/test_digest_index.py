@@ -0,0 +1,36 @@
+from app import DigestIndex
+
+
+class MockDynamoDBClient(object):
+
+    def __init__(self):
+        self.etags = {}
+        self.fetches = []
+
+    def fetch_digest_etag(self, object_key):
+        self.fetches.append(object_key)
+        return self.etags.get(object_key)
+
+    def update_digest_etag(self, object_key, etag):
+        self.etags[object_key] = etag
+
+
+def test_objects_are_remembered():
+    digest_index = DigestIndex()
+    assert digest_index.get('content/abc-1') is None
+    digest_index.put('content/abc-1', '"abc"')
+    assert digest_index.get('content/abc-1') == '"abc"'
+    assert digest_index.hits == 1
+
+
+def test_objects_are_shared_through_dynamodb():
+    dynamodb_client = MockDynamoDBClient()
+    DigestIndex(dynamodb_client).put('content/abc-1', '"abc"')
+
+    # Verify that another run finds the object, and only asks DynamoDB once
+    digest_index = DigestIndex(dynamodb_client)
+    assert digest_index.get('content/abc-1') == '"abc"'
+    assert digest_index.get('content/abc-1') == '"abc"'
+    assert digest_index.get('content/def-2') is None
+    assert dynamodb_client.fetches == ['content/abc-1', 'content/def-2']
+    assert digest_index.hits == 2
@@ -0,0 +1,54 @@
+import threading
+
+from app import DiskBudget
+
+
+def test_reserve_and_release():
+    # Create the budget we'll be testing against
+    budget = DiskBudget(100)
+
+    # Verify that reservations are refused once the budget is used up
+    first = budget.try_reserve(60)
+    assert first.size == 60
+    assert budget.try_reserve(50) is None
+    second = budget.try_reserve(40)
+    assert budget.reserved_bytes == 100
+
+    # Verify that releasing a reservation twice only gives its room back once
+    first.release()
+    first.release()
+    second.release()
+    assert budget.reserved_bytes == 0
+
+
+def test_unknown_and_oversized_files_take_whole_budget():
+    budget = DiskBudget(100)
+    assert budget.try_reserve(None).size == 100
+    assert budget.try_reserve(1) is None
+    budget.release(100)
+    assert budget.try_reserve(1000).size == 100
+
+
+def test_reserve_waits_for_room():
+    budget = DiskBudget(100)
+    first = budget.reserve(80)
+    reservations = []
+    waiter = threading.Thread(target=lambda: reservations.append(budget.reserve(50)))
+    waiter.start()
+
+    # Verify that the second reservation only goes ahead once the first is released
+    waiter.join(0.1)
+    assert waiter.is_alive()
+    first.release()
+    waiter.join(5)
+    assert reservations[0].size == 50
+    assert budget.reserved_bytes == 50
+
+
+def test_reserve_times_out():
+    budget = DiskBudget(100)
+    budget.reserve(80)
+
+    # Verify that a reservation gives up once its timeout has passed without room
+    assert budget.reserve(50, 0.05) is None
+    assert budget.reserved_bytes == 80
@@ -0,0 +1,53 @@
+import requests_mock
+
+from app import DownloadCache
+from app import DownloadClient
+
+S3_OBJECT = {
+    'file_name': 'file.dat',
+    'file_path': 'eprints.test/download/file.dat',
+    'file_size': 17280,
+    'file_checksum': 'DJomkLQb4mYNsqra0T2/BQ==',
+    'download_url': 's3://bucket/eprints.test/download/file.dat'
+}
+
+
+def test_conditional_headers(tmpdir):
+    # Create the cache we'll be testing against
+    cache = DownloadCache(str(tmpdir))
+    url = 'http://eprints.test/download/file.dat'
+    assert cache.conditional_headers(url) == {}
+
+    # Verify that a file without validators isn't cached
+    cache.put(url, None, None, S3_OBJECT)
+    assert cache.get(url) is None
+
+    cache.put(url, '"v1"', 'Wed, 21 Oct 2015 07:28:00 GMT', S3_OBJECT)
+    assert cache.conditional_headers(url) == {
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'
+    }
+
+    # Verify that the entry survives into a new cache over the same directory
+    assert DownloadCache(str(tmpdir)).s3_object(url) == S3_OBJECT
+
+
+def test_unchanged_file_is_not_downloaded(tmpdir):
+    cache = DownloadCache(str(tmpdir))
+    download_client = DownloadClient(cache=cache)
+    url = 'http://eprints.test/download/file.dat'
+    cache.put(url, '"v1"', None, S3_OBJECT)
+    with requests_mock.Mocker() as requests_mocker:
+        requests_mocker.get(url, request_headers={'If-None-Match': '"v1"'}, status_code=304)
+
+        # Verify that the S3 object is reused, without writing a file
+        download = download_client.download_file(url)
+        assert download.file_path is None
+        assert download.s3_object == S3_OBJECT
+        assert download.md5 == S3_OBJECT['file_checksum']
+        assert cache.hits == 1
+        assert download_client.stats.files == 0
+
+        # Verify that a streamed download gets the 304 response
+        response = download_client.open_download(url)
+        assert response.status_code == 304
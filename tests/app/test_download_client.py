@@ -1,7 +1,23 @@
+import hashlib
 import os.path
+import pytest
+import requests
 import requests_mock
+import threading
+import time
 
+from app import DiskBudget
 from app import DownloadClient
+from app.download_client import DownloadTimeoutError
+from app.download_client import IncompleteDownloadError
+from app.download_client import StalledDownloadError
+from app.download_client import TransferWatchdog
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from mock import patch
+from socketserver import ThreadingMixIn
 
 
 @requests_mock.mock()
@@ -17,14 +33,95 @@ def test_download_file_success(*args):
     requests_mocker.get('http://eprints.test/download/file.dat', content=response_data)
 
     # Attempt to download the file
-    file_path = download_client.download_file('http://eprints.test/download/file.dat')
-    assert file_path is not None
-    assert os.path.exists(file_path)
+    download = download_client.download_file('http://eprints.test/download/file.dat')
+    assert download is not None
+    assert os.path.exists(download.file_path)
+
+    # Verify that the size and checksum were calculated during the download
+    assert download.file_size == 17280
+    assert download.md5 == 'DJomkLQb4mYNsqra0T2/BQ=='
+    assert download.sha256 is None
 
     # Read the downloaded file
-    downloaded_file = _get_file_bytes(file_path)
+    downloaded_file = _get_file_bytes(download.file_path)
     assert response_data == downloaded_file
 
+    # Verify that the transfer was counted
+    assert download_client.stats.files == 1
+    assert download_client.stats.bytes == 17280
+
+
+@requests_mock.mock()
+def test_download_file_sha256(*args):
+    requests_mocker = args[0]
+    download_client = DownloadClient(sha256=True)
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    requests_mocker.get('http://eprints.test/download/file.dat', content=response_data)
+
+    download = download_client.download_file('http://eprints.test/download/file.dat')
+    assert download.md5 == 'DJomkLQb4mYNsqra0T2/BQ=='
+    assert download.sha256 == hashlib.sha256(response_data).hexdigest()
+    download.discard()
+    assert not os.path.exists(download.file_path)
+
+
+@requests_mock.mock()
+def test_download_file_spooled(*args):
+    requests_mocker = args[0]
+    download_client = DownloadClient(spool_size=17280)
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    requests_mocker.get('http://eprints.test/download/file.dat', content=response_data,
+                        headers={'Content-Length': '17280'})
+
+    # Verify that a file no bigger than the spool size is kept in memory
+    download = download_client.download_file('http://eprints.test/download/file.dat')
+    assert download.file_path is None
+    assert download.data == response_data
+    assert download.open().read() == response_data
+    assert download.md5 == 'DJomkLQb4mYNsqra0T2/BQ=='
+
+    # Verify that a bigger file is written to disk
+    download_client.spool_size = 17279
+    download = download_client.download_file('http://eprints.test/download/file.dat')
+    assert download.data is None
+    assert _get_file_bytes(download.file_path) == response_data
+    download.discard()
+
+
+@requests_mock.mock()
+def test_download_file_disk_budget(*args):
+    requests_mocker = args[0]
+    budget = DiskBudget(20000)
+    download_client = DownloadClient(disk_budget=budget)
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    requests_mocker.get('http://eprints.test/download/file.dat', content=response_data,
+                        headers={'Content-Length': '17280'})
+
+    # Verify that a download keeps its room on disk until its file is removed
+    first = download_client.download_file('http://eprints.test/download/file.dat')
+    assert budget.reserved_bytes == 17280
+
+    # Verify that a download that doesn't fit waits, then asks for the file again
+    downloads = []
+    waiter = threading.Thread(target=lambda: downloads.append(
+        download_client.download_file('http://eprints.test/download/file.dat')))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()
+    first.discard()
+    waiter.join(5)
+    assert _get_file_bytes(downloads[0].file_path) == response_data
+    assert requests_mocker.call_count == 3
+    downloads[0].discard()
+    assert budget.reserved_bytes == 0
+
+    # Verify that a download stops waiting for room on disk once its deadline passes
+    first = download_client.download_file('http://eprints.test/download/file.dat')
+    with pytest.raises(DownloadTimeoutError):
+        download_client.download_file('http://eprints.test/download/file.dat', time.time() + 0.2)
+    first.discard()
+    assert budget.reserved_bytes == 0
+
 
 @requests_mock.mock()
 def test_download_file_error(*args):
@@ -42,8 +139,421 @@ def test_download_file_error(*args):
     )
 
     # Attempt to download the file
-    file_path = download_client.download_file('http://eprints.test/download/file.dat')
-    assert file_path is None
+    download = download_client.download_file('http://eprints.test/download/file.dat')
+    assert download is None
+
+
+@requests_mock.mock()
+def test_download_files(*args):
+    requests_mocker = args[0]
+    download_client = DownloadClient(max_workers=3, max_per_host=2)
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    urls = ['http://{}.test/download/file{}.dat'.format(host, i)
+            for host in ('eprints', 'dspace') for i in range(3)]
+    for url in urls:
+        requests_mocker.get(url, content=response_data)
+
+    # Track how many downloads are running at once, in total and for each host
+    running, peaks, lock = {}, {}, threading.Lock()
+    download_file = download_client.download_file
+
+    def tracked_download_file(url):
+        host = url.split('/')[2]
+        with lock:
+            running[host] = running.get(host, 0) + 1
+            peaks[host] = max(peaks.get(host, 0), running[host])
+            peaks['total'] = max(peaks.get('total', 0), sum(running.values()))
+        time.sleep(0.05)
+        try:
+            return download_file(url)
+        finally:
+            with lock:
+                running[host] -= 1
+    download_client.download_file = tracked_download_file
+
+    # Verify that every file is downloaded, without exceeding either limit
+    results = dict(download_client.download_files(urls))
+    assert sorted(results) == sorted(urls)
+    for download in results.values():
+        assert _get_file_bytes(download.file_path) == response_data
+        download.discard()
+    assert peaks['eprints.test'] == 2
+    assert peaks['dspace.test'] <= 2
+    assert peaks['total'] == 3
+
+
+@requests_mock.mock()
+def test_download_files_stopped_early(*args):
+    requests_mocker = args[0]
+    download_client = DownloadClient(max_workers=2, max_per_host=2)
+    urls = ['http://eprints.test/download/file{}.dat'.format(i) for i in range(2)]
+    for url in urls:
+        requests_mocker.get(url, content=b'data')
+
+    # Remember every file that was downloaded
+    downloads = []
+    download_file = download_client.download_file
+
+    def tracked_download_file(url):
+        downloads.append(download_file(url))
+        return downloads[-1]
+    download_client.download_file = tracked_download_file
+
+    # Verify that the file still being downloaded when iteration stops is removed
+    results = download_client.download_files(urls)
+    url, download = next(results)
+    results.close()
+    assert len(downloads) == 2
+    assert [os.path.exists(d.file_path) for d in downloads if d is not download] == [False]
+    download.discard()
+
+
+@patch('app.download_client.time.sleep')
+@requests_mock.mock()
+def test_download_file_retries(*args):
+    mock_sleep, requests_mocker = args
+    download_client = DownloadClient()
+
+    # The first attempt fails to connect, and the second is asked to come back later
+    requests_mocker.get('http://eprints.test/download/file.dat', [
+        {'exc': requests.exceptions.ConnectionError},
+        {'status_code': 503, 'headers': {'Retry-After': '7'}},
+        {'content': b'data'}
+    ])
+    download = download_client.download_file('http://eprints.test/download/file.dat')
+    assert _get_file_bytes(download.file_path) == b'data'
+    download.discard()
+    assert requests_mocker.call_count == 3
+
+    # Verify that the connection error backed off with jitter, and Retry-After was honoured
+    assert 0 <= mock_sleep.call_args_list[0][0][0] <= 0.5
+    assert mock_sleep.call_args_list[1][0][0] == 7
+
+
+@patch('app.download_client.time.sleep')
+@requests_mock.mock()
+def test_download_file_retry_past_deadline(*args):
+    mock_sleep, requests_mocker = args
+    download_client = DownloadClient()
+    requests_mocker.get('http://eprints.test/download/file.dat', [
+        {'status_code': 503, 'headers': {'Retry-After': '30'}},
+        {'content': b'data'}
+    ])
+
+    # Verify that a retry that would only start after the deadline isn't waited for
+    with pytest.raises(DownloadTimeoutError):
+        download_client.download_file('http://eprints.test/download/file.dat', time.time() + 10)
+    assert requests_mocker.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+@patch('app.download_client.time.sleep')
+@requests_mock.mock()
+def test_download_file_retry_after_date(*args):
+    mock_sleep, requests_mocker = args
+    download_client = DownloadClient()
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    requests_mocker.get('http://eprints.test/download/file.dat', [
+        {'status_code': 503, 'headers': {'Retry-After': format_datetime(retry_at, usegmt=True)}},
+        {'status_code': 503, 'headers': {'Retry-After': 'Fri, 31 Dec 2100 23:59:59 GMT'}},
+        {'status_code': 503, 'headers': {'Retry-After': 'Thu, 01 Jan 1970 00:00:00 GMT'}},
+        {'content': b'data'}
+    ])
+    download = download_client.download_file('http://eprints.test/download/file.dat')
+    assert _get_file_bytes(download.file_path) == b'data'
+    download.discard()
+
+    # Verify that the date is waited for, up to the limit, and a date in the past isn't
+    waits = [c[0][0] for c in mock_sleep.call_args_list]
+    assert 28 <= waits[0] <= 30
+    assert waits[1:] == [60, 0]
+
+
+@patch('app.download_client.time.sleep')
+@requests_mock.mock()
+def test_download_file_gives_up(*args):
+    mock_sleep, requests_mocker = args
+    download_client = DownloadClient(max_retries=2)
+    requests_mocker.get(
+        'http://eprints.test/download/file.dat',
+        status_code=500,
+        headers={'Retry-After': '86400'}
+    )
+    assert download_client.download_file('http://eprints.test/download/file.dat') is None
+    assert requests_mocker.call_count == 3
+
+    # Verify that an unreasonable Retry-After doesn't stall the download
+    assert [c[0][0] for c in mock_sleep.call_args_list] == [60, 60]
+
+
+@requests_mock.mock()
+def test_download_file_timeouts(*args):
+    requests_mocker = args[0]
+    download_client = DownloadClient(connect_timeout=5, read_timeout=30)
+    requests_mocker.get('http://eprints.test/download/file.dat', content=b'data')
+
+    # Verify that every request is made with the timeouts
+    download_client.download_file('http://eprints.test/download/file.dat').discard()
+    assert requests_mocker.request_history[0].timeout == (5, 30)
+
+    # Verify that a download isn't started once its deadline has passed
+    with pytest.raises(DownloadTimeoutError):
+        download_client.download_file('http://eprints.test/download/file.dat', time.time() - 1)
+    assert requests_mocker.call_count == 1
+
+
+@patch('app.download_client.time.time')
+def test_transfer_watchdog(mock_time):
+    mock_time.return_value = 1000
+    watchdog = TransferWatchdog('http://eprints.test/download/file.dat', 100, 10, 1100)
+
+    # Verify that a transfer keeping up the minimum rate is left alone
+    mock_time.return_value = 1010
+    watchdog.check(1000)
+    mock_time.return_value = 1015
+    watchdog.check(10)
+
+    # Verify that a transfer averaging less than the minimum rate over the window is aborted
+    mock_time.return_value = 1020
+    with pytest.raises(StalledDownloadError):
+        watchdog.check(10)
+
+    # Verify that a transfer running past its deadline is aborted
+    mock_time.return_value = 1101
+    with pytest.raises(DownloadTimeoutError):
+        TransferWatchdog('http://eprints.test/download/file.dat', deadline=1100).check(10)
+
+
+def test_download_files_reuse_connections():
+    # Serve a few files over a real keep-alive HTTP connection
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '4')
+            self.end_headers()
+            self.wfile.write(b'data')
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        download_client = DownloadClient(max_per_host=1)
+        base_url = 'http://127.0.0.1:{}/file'.format(server.server_port)
+        for url, download in download_client.download_files(
+                [base_url + str(i) for i in range(3)]):
+            download.discard()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Verify that every download went over the one connection
+    assert download_client.connection_stats() == {
+        '127.0.0.1': {'connections': 1, 'requests': 3}
+    }
+
+
+@patch('app.download_client.time.sleep')
+def test_download_file_resumes_interrupted_transfer(*args):
+    # The first response stops after 4096 bytes
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    with _serve_ranges(response_data, [4096]) as (url, requests_seen):
+        download = DownloadClient(sha256=True, buffer_size=1024).download_file(url)
+
+    # Verify that the rest of the file was fetched with a range request, and hashed correctly
+    assert [headers.get('Range') for headers in requests_seen] == [None, 'bytes=4096-17279']
+    assert requests_seen[1]['If-Range'] == '"v1"'
+    assert _get_file_bytes(download.file_path) == response_data
+    assert download.md5 == 'DJomkLQb4mYNsqra0T2/BQ=='
+    assert download.sha256 == hashlib.sha256(response_data).hexdigest()
+    download.discard()
+
+
+@patch('app.download_client.time.sleep')
+@pytest.mark.parametrize('segments', [1, 3])
+def test_download_file_part_digests(_, segments):
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    with _serve_ranges(response_data, [4096]) as (url, requests_seen):
+        download = DownloadClient(segments=segments, segment_min_size=4096, buffer_size=1024,
+                                  part_size=5000).download_file(url)
+
+    # Verify that the digest of each part is worked out along with the file's, even when the
+    # file was resumed or fetched in segments
+    assert download.part_digests.part_md5s() == [
+        hashlib.md5(response_data[start:start + 5000]).digest()
+        for start in range(0, len(response_data), 5000)
+    ]
+    download.discard()
+
+
+def test_download_file_resumes_in_later_run(tmpdir):
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    with _serve_ranges(response_data, [4096]) as (url, requests_seen):
+        # Verify that the partial download is kept when the retries run out
+        with pytest.raises(IncompleteDownloadError):
+            DownloadClient(
+                max_retries=0, partial_dir=str(tmpdir), buffer_size=1024).download_file(url)
+        assert len(os.listdir(str(tmpdir))) == 2
+
+        # Verify that the next run carries on from where the last one stopped
+        download = DownloadClient(partial_dir=str(tmpdir)).download_file(url)
+    assert [headers.get('Range') for headers in requests_seen] == [None, 'bytes=4096-17279']
+    assert download.md5 == 'DJomkLQb4mYNsqra0T2/BQ=='
+    assert os.listdir(str(tmpdir)) == [os.path.basename(download.file_path)]
+    download.discard()
+
+
+def test_download_file_timed_out_resumes_in_later_run(tmpdir):
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    checked_bytes = []
+
+    def check(watchdog, byte_count):
+        # The deadline passes once the first 4096 bytes have been written
+        if sum(checked_bytes) >= 4096:
+            raise DownloadTimeoutError('Download ran past its deadline')
+        checked_bytes.append(byte_count)
+
+    with _serve_ranges(response_data, []) as (url, requests_seen):
+        # Verify that the partial download is kept, along with how far it got
+        with patch('app.download_client.TransferWatchdog.check', autospec=True,
+                   side_effect=check):
+            with pytest.raises(DownloadTimeoutError):
+                DownloadClient(partial_dir=str(tmpdir), buffer_size=1024).download_file(
+                    url, time.time() + 60)
+        assert len(os.listdir(str(tmpdir))) == 2
+
+        # Verify that the next run carries on from where the last one stopped
+        download = DownloadClient(partial_dir=str(tmpdir)).download_file(url)
+    assert [headers.get('Range') for headers in requests_seen] == [None, 'bytes=4096-17279']
+    assert _get_file_bytes(download.file_path) == response_data
+    assert download.md5 == 'DJomkLQb4mYNsqra0T2/BQ=='
+    download.discard()
+
+
+def test_download_file_restarts_changed_file(tmpdir):
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    etag = ['"v1"']
+    with _serve_ranges(response_data, [4096], etag) as (url, requests_seen):
+        with pytest.raises(IncompleteDownloadError):
+            DownloadClient(
+                max_retries=0, partial_dir=str(tmpdir), buffer_size=1024).download_file(url)
+
+        # Verify that the whole file is downloaded again when its ETag has changed
+        etag[0] = '"v2"'
+        download = DownloadClient(partial_dir=str(tmpdir)).download_file(url)
+    assert requests_seen[1]['Range'] == 'bytes=4096-17279'
+    assert download.file_size == 17280
+    assert download.md5 == 'DJomkLQb4mYNsqra0T2/BQ=='
+    download.discard()
+
+
+def test_download_file_in_segments():
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    with _serve_ranges(response_data, []) as (url, requests_seen):
+        download_client = DownloadClient(segments=3, segment_min_size=4096)
+        download = download_client.download_file(url)
+
+    # Verify that the first response carried the first segment, and the rest were requested
+    assert sorted(str(headers.get('Range')) for headers in requests_seen) == \
+        ['None', 'bytes=11520-17279', 'bytes=5760-11519']
+    assert _get_file_bytes(download.file_path) == response_data
+    assert download.md5 == 'DJomkLQb4mYNsqra0T2/BQ=='
+    download.discard()
+
+
+@requests_mock.mock()
+def test_open_download(*args):
+    requests_mocker = args[0]
+    download_client = DownloadClient()
+    response_data = _get_file_bytes('tests/app/data/smiling.png')
+    requests_mocker.get('http://eprints.test/download/file.dat', content=response_data)
+    requests_mocker.get('http://eprints.test/download/missing.dat', status_code=404)
+
+    # Verify that the body can be streamed from the response, without writing it to disk
+    response = download_client.open_download('http://eprints.test/download/file.dat')
+    assert response.raw.read() == response_data
+    response.close()
+    assert download_client.open_download('http://eprints.test/download/missing.dat') is None
+
+
+@requests_mock.mock()
+def test_watch_download(*args):
+    requests_mocker = args[0]
+    download_client = DownloadClient()
+    url = 'http://eprints.test/download/file.dat'
+
+    # Verify that a streamed body is added to the transfer metrics once it has been read
+    requests_mocker.get(url, content=b'data', headers={'Content-Length': '4'})
+    response = download_client.open_download(url)
+    body = download_client.watch(response)
+    assert body.read(1024) == b'data'
+    assert download_client.stats.files == 0
+    assert body.read(1024) == b''
+    body.read(1024)
+    assert download_client.stats.files == 1
+    assert download_client.stats.bytes == 4
+
+    # Verify that a body that ends short of its Content-Length, as when the connection is
+    # dropped, isn't taken for the whole file
+    requests_mocker.get(url, content=b'data', headers={'Content-Length': '10'})
+    body = download_client.watch(download_client.open_download(url))
+    with pytest.raises(IncompleteDownloadError):
+        while body.read(1024):
+            pass
+    assert download_client.stats.files == 1
+
+
+@contextmanager
+def _serve_ranges(content, cut_offs, etag=None):
+    # Serve the content over HTTP with support for range requests, stopping each of the first
+    # responses after the number of bytes given in `cut_offs`. The ETag is the first item of the
+    # `etag` list, so that a test can change it.
+    etag = etag or ['"v1"']
+    requests_seen = []
+    cut_offs = list(cut_offs)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            requests_seen.append(dict(self.headers))
+            start, end = 0, len(content) - 1
+            byte_range = self.headers.get('Range')
+            if byte_range is not None and self.headers.get('If-Range') == etag[0]:
+                first, last = byte_range[len('bytes='):].split('-')
+                start, end = int(first), int(last) if last else end
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, end, len(content)))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end + 1 - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag[0])
+            self.end_headers()
+            body = content[start:end + 1]
+            if cut_offs:
+                body = body[:cut_offs.pop(0)]
+                self.close_connection = True
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield 'http://127.0.0.1:{}/file.dat'.format(server.server_port), requests_seen
+    finally:
+        server.shutdown()
+        server.server_close()
 
 
 def _get_file_bytes(file_path):
@@ -1,9 +1,12 @@
 import boto3
+import pytest
 
 from datetime import timedelta
 from dateutil import parser
+from mock import MagicMock, patch
 from moto import mock_dynamodb2
 from app import DynamoDBClient
+from app.dynamodb_client import UnprocessedKeysError
 
 
 @mock_dynamodb2
@@ -95,13 +98,181 @@ def test_processed_table():
         }
     )
 
-    # Verify that a query that returns no rows gives us a 'None' response
-    processed_status = dynamodb_client.fetch_processed_status('eprints-identifier-test')
-    assert processed_status is None
+    # Verify that a record that has never been processed has no status
+    processed_statuses = dynamodb_client.fetch_processed_statuses(['eprints-identifier-test'])
+    assert processed_statuses == {}
 
     # Populate a processed record into the DynamoDB table
     dynamodb_client.update_processed_record('eprints-identifier-test', '{}', 'Success', '-')
 
     # Verify that we get the correct response
-    processed_status = dynamodb_client.fetch_processed_status('eprints-identifier-test')
-    assert processed_status == 'Success'
+    processed_statuses = dynamodb_client.fetch_processed_statuses(['eprints-identifier-test'])
+    assert processed_statuses == {'eprints-identifier-test': 'Success'}
+
+
+@mock_dynamodb2
+def test_harvest_checkpoint():
+    # Create the DynamoDB client we'll be testing against
+    dynamodb_client = DynamoDBClient(
+        'rdss-eprints-adaptor-watermark-test',
+        'rdss-eprints-adaptor-processed-test'
+    )
+
+    # Create a Boto3 DynamoDB client we'll use to create the mock table
+    boto3_client = boto3.client('dynamodb')
+    boto3_client.create_table(
+        TableName='rdss-eprints-adaptor-watermark-test',
+        KeySchema=[
+            {
+                'AttributeName': 'Key',
+                'KeyType': 'HASH'
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'Key',
+                'AttributeType': 'S'
+            }
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 20,
+            'WriteCapacityUnits': 60
+        }
+    )
+
+    # Verify that there is no checkpoint to begin with
+    assert dynamodb_client.fetch_harvest_checkpoint() is None
+
+    # Checkpoint a bounded window, and verify we get it back
+    from_datetime = parser.parse('2018-03-20T00:00:09')
+    until_datetime = parser.parse('2018-03-21T00:00:09')
+    high_watermark = parser.parse('2018-03-01T00:00:01')
+    dynamodb_client.update_harvest_checkpoint(
+        from_datetime, until_datetime, {'oai_dc': 'token-1', 'ore': 'token-2'}, high_watermark)
+    assert dynamodb_client.fetch_harvest_checkpoint() == {
+        'from': from_datetime,
+        'until': until_datetime,
+        'resumption_tokens': {'oai_dc': 'token-1', 'ore': 'token-2'},
+        'high_watermark': high_watermark
+    }
+
+    # Checkpoint an open-ended window
+    dynamodb_client.update_harvest_checkpoint(
+        from_datetime, None, {'oai_dc': 'token-3'}, high_watermark)
+    assert dynamodb_client.fetch_harvest_checkpoint()['until'] is None
+
+    # Verify that clearing the checkpoint removes it, without touching the high watermark
+    dynamodb_client.update_high_watermark(from_datetime)
+    dynamodb_client.clear_harvest_checkpoint()
+    assert dynamodb_client.fetch_harvest_checkpoint() is None
+    assert dynamodb_client.fetch_high_watermark() == from_datetime + timedelta(seconds=1)
+
+
+@mock_dynamodb2
+def test_set_high_watermarks():
+    # Create the DynamoDB client we'll be testing against
+    dynamodb_client = DynamoDBClient(
+        'rdss-eprints-adaptor-watermark-test',
+        'rdss-eprints-adaptor-processed-test'
+    )
+
+    # Create a Boto3 DynamoDB client we'll use to create the mock table
+    boto3_client = boto3.client('dynamodb')
+    boto3_client.create_table(
+        TableName='rdss-eprints-adaptor-watermark-test',
+        KeySchema=[
+            {
+                'AttributeName': 'Key',
+                'KeyType': 'HASH'
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'Key',
+                'AttributeType': 'S'
+            }
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 20,
+            'WriteCapacityUnits': 60
+        }
+    )
+
+    # Verify that there are no set watermarks to begin with
+    assert dynamodb_client.fetch_set_high_watermarks() == {}
+
+    # Set the watermarks of two sets, and verify they are stored as given
+    set_high_watermarks = {
+        'col_1': parser.parse('2018-03-20T00:00:09'),
+        'col_2': parser.parse('2018-03-21T00:00:09')
+    }
+    dynamodb_client.update_set_high_watermarks(set_high_watermarks)
+    assert dynamodb_client.fetch_set_high_watermarks() == set_high_watermarks
+    assert dynamodb_client.fetch_high_watermark() is None
+
+
+@mock_dynamodb2
+def test_fetch_processed_statuses():
+    dynamodb_client = DynamoDBClient(
+        'rdss-eprints-adaptor-watermark-test',
+        'rdss-eprints-adaptor-processed-test'
+    )
+    boto3_client = boto3.client('dynamodb')
+    boto3_client.create_table(
+        TableName='rdss-eprints-adaptor-processed-test',
+        KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 20, 'WriteCapacityUnits': 60}
+    )
+    for i in range(0, 250, 2):
+        dynamodb_client.update_processed_record('id-{}'.format(i), '{}', 'Success', '-')
+    dynamodb_client.update_processed_record('id-249', '{}', 'Error', 'GENERR001')
+
+    # Verify that more records than fit in one request are all fetched, without repeats
+    identifiers = ['id-{}'.format(i) for i in range(250)] + ['id-0']
+    with patch.object(dynamodb_client.client, 'batch_get_item',
+                      wraps=dynamodb_client.client.batch_get_item) as batch_get_item:
+        statuses = dynamodb_client.fetch_processed_statuses(identifiers)
+    assert statuses == dict({'id-{}'.format(i): 'Success' for i in range(0, 250, 2)},
+                            **{'id-249': 'Error'})
+    assert [len(c[1]['RequestItems']['rdss-eprints-adaptor-processed-test']['Keys'])
+            for c in batch_get_item.call_args_list] == [100, 100, 50]
+
+
+def test_fetch_processed_statuses_retries_unprocessed_keys():
+    dynamodb_client = DynamoDBClient(
+        'rdss-eprints-adaptor-watermark-test',
+        'rdss-eprints-adaptor-processed-test'
+    )
+    keys = [{'Identifier': {'S': 'id-1'}}, {'Identifier': {'S': 'id-2'}}]
+    item = {'Identifier': {'S': 'id-1'}, 'Status': {'S': 'Success'}}
+    dynamodb_client.client = MagicMock()
+    dynamodb_client.client.batch_get_item.side_effect = [
+        {'Responses': {}, 'UnprocessedKeys': {
+            'rdss-eprints-adaptor-processed-test': {'Keys': keys}}},
+        {'Responses': {'rdss-eprints-adaptor-processed-test': [item]}, 'UnprocessedKeys': {}}
+    ]
+
+    # Verify that keys that weren't read the first time are asked for again
+    assert dynamodb_client.fetch_processed_statuses(['id-1', 'id-2']) == {'id-1': 'Success'}
+    assert dynamodb_client.client.batch_get_item.call_count == 2
+    assert dynamodb_client.client.batch_get_item.call_args[1]['RequestItems'] == {
+        'rdss-eprints-adaptor-processed-test': {'Keys': keys}}
+
+
+@patch('app.dynamodb_client.time.sleep')
+def test_fetch_processed_statuses_gives_up_on_unprocessed_keys(mock_sleep):
+    dynamodb_client = DynamoDBClient(
+        'rdss-eprints-adaptor-watermark-test',
+        'rdss-eprints-adaptor-processed-test'
+    )
+    dynamodb_client.client = MagicMock()
+    dynamodb_client.client.batch_get_item.return_value = {'Responses': {}, 'UnprocessedKeys': {
+        'rdss-eprints-adaptor-processed-test': {'Keys': [{'Identifier': {'S': 'id-1'}}]}}}
+
+    # Verify that keys that are never read are retried with exponential backoff, then given up on
+    with pytest.raises(UnprocessedKeysError):
+        dynamodb_client.fetch_processed_statuses(['id-1'])
+    assert dynamodb_client.client.batch_get_item.call_count == 9
+    assert [c[0][0] for c in mock_sleep.call_args_list] == \
+        [0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 5]
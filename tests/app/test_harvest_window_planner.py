@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+from app import HarvestWindowPlanner
+
+
+def test_window_widens_across_empty_ranges():
+    # Create the planner we'll be testing against
+    window_planner = HarvestWindowPlanner(10, timedelta(days=1), timedelta(days=30))
+    now = datetime(2018, 1, 1)
+
+    # Walk forward over a range with no records, and verify the window doubles each time
+    from_datetime = datetime(2000, 1, 1)
+    widths = []
+    for _ in range(7):
+        until_datetime = window_planner.window_end(from_datetime, now)
+        widths.append((until_datetime - from_datetime).days)
+        window_planner.record_window(from_datetime, until_datetime, 0)
+        from_datetime = until_datetime
+    assert widths == [1, 2, 4, 8, 16, 30, 30]
+
+
+def test_window_is_open_ended_when_it_reaches_now():
+    window_planner = HarvestWindowPlanner(10, timedelta(days=1), timedelta(days=30))
+    assert window_planner.window_end(datetime(2018, 1, 1), datetime(2018, 1, 1, 12)) is None
+
+
+def test_window_is_split_when_dense():
+    window_planner = HarvestWindowPlanner(10, timedelta(days=8), timedelta(days=30))
+    from_datetime = datetime(2000, 1, 1)
+
+    # Verify that a dense window is halved, and that the next window uses the new width
+    assert window_planner.split_window(from_datetime, from_datetime + timedelta(days=8))
+    assert window_planner.window_end(from_datetime, datetime(2018, 1, 1)) == \
+        from_datetime + timedelta(days=4)
+
+    # Verify that the smallest window cannot be split
+    assert not window_planner.split_window(from_datetime, from_datetime + timedelta(seconds=1))
+
+
+def test_window_is_sized_from_observed_density():
+    window_planner = HarvestWindowPlanner(10, timedelta(days=4), timedelta(days=30))
+    from_datetime = datetime(2000, 1, 1)
+
+    # Twenty records over four days means the next window should hold ten records in two days
+    window_planner.record_window(from_datetime, from_datetime + timedelta(days=4), 20)
+    assert window_planner.window == timedelta(days=2)
+
+    # A sparse range should never grow the window by more than the growth factor
+    window_planner.record_window(from_datetime, from_datetime + timedelta(days=2), 1)
+    assert window_planner.window == timedelta(days=4)
+    assert len(window_planner.observations) == 2
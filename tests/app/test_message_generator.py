@@ -1,9 +1,11 @@
 import json
+import pytest
 import re
 import requests_mock
 
 from app import MessageGenerator
 from dateutil import parser
+from mock import patch
 
 # https://github.com/JiscRDSS/rdss-message-api-specification/blob/master/schemas/types.json#L11
 uuid4_regex = re.compile(
@@ -82,6 +84,28 @@ def test_generate_metadata_create(*args):
         'm/download/file.dat'
 
 
+@pytest.mark.parametrize('file_checksum_sha256, expected_checksums', [
+    (None, [(1, '0c9a2690b41be2660db2aadad13dbf05')]),
+    ('8a1c2f4b' * 8, [(1, '0c9a2690b41be2660db2aadad13dbf05'), (2, '8a1c2f4b' * 8)])
+])
+@patch('app.message_generator.MessageGenerator._get_machine_address',
+       return_value='123.123.123.123')
+def test_generate_metadata_create_file_checksums(_, file_checksum_sha256, expected_checksums):
+    message_generator = MessageGenerator(12345, 'Test Organisation', 'dspace')
+
+    # The SHA-256 checksum is only listed when the S3 object has one
+    test_s3_objects = _build_test_s3_objects()
+    if file_checksum_sha256:
+        test_s3_objects[0]['file_checksum_sha256'] = file_checksum_sha256
+    message = message_generator.generate_metadata_create(_build_test_record(), test_s3_objects)
+
+    file_checksums = json.loads(message)['messageBody']['objectFile'][0]['fileChecksum']
+    assert [(checksum['checksumType'], checksum['checksumValue'])
+            for checksum in file_checksums] == expected_checksums
+    for checksum in file_checksums:
+        assert uuid4_regex.match(checksum['checksumUuid'])
+
+
 def _build_test_record():
     return {
         'identifier': 'test-eprints-record',
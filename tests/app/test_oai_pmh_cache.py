@@ -0,0 +1,197 @@
+import os
+import pytest
+import requests_mock
+
+from app import CachingTransport
+from app import OAIPMHClient
+from app import PooledHTTPTransport
+from app.oai_pmh_cache import ResponseCacheMissError
+from app.oai_pmh_transport import TransportStats
+from dateutil import parser
+
+ENDPOINT_URL = 'http://dspace.test/dspace-oai/request'
+
+
+class MockTransport(object):
+
+    def __init__(self, content=b'<OAI-PMH/>'):
+        self.content = content
+        self.requests = []
+        self.stats = TransportStats()
+
+    def request(self, url, params):
+        self.requests.append(params)
+        return self.content
+
+
+def test_request_is_cached(tmpdir):
+    # Create the transport we'll be testing against
+    mock_transport = MockTransport()
+    transport = CachingTransport(mock_transport, str(tmpdir), 1024)
+    params = {
+        'verb': 'ListRecords',
+        'metadataPrefix': 'oai_dc',
+        'from': '2018-01-01T00:00:00Z',
+        'until': '2018-01-02T00:00:00Z'
+    }
+
+    # Verify that the second identical request is served from the cache
+    assert transport.request(ENDPOINT_URL, dict(params)) == b'<OAI-PMH/>'
+    assert transport.request(ENDPOINT_URL, dict(params)) == b'<OAI-PMH/>'
+    assert len(mock_transport.requests) == 1
+    assert transport.hits == 1
+    assert transport.misses == 1
+
+    # Verify that a different window is a different key
+    transport.request(ENDPOINT_URL, dict(params, until='2018-01-03T00:00:00Z'))
+    assert len(mock_transport.requests) == 2
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+def test_only_bounded_windows_are_cached(tmpdir):
+    transport = CachingTransport(MockTransport(), str(tmpdir), 1024 * 1024)
+    from_datetime = parser.parse('1970-01-01T00:00:00')
+
+    # Harvest an open-ended window, then an error, and verify neither is cached
+    with requests_mock.Mocker() as requests_mocker:
+        requests_mocker.post(ENDPOINT_URL, [
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_1.xml')},
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_2.xml')},
+            {'content': _get_file_bytes('tests/app/data/bad_resumption_token_response.xml')}
+        ])
+        transport.transport = PooledHTTPTransport()
+        oai_pmh_client = OAIPMHClient(ENDPOINT_URL, transport=transport)
+        assert len(oai_pmh_client.fetch_records_from(from_datetime)) == 3
+        transport.request(ENDPOINT_URL, {'verb': 'ListRecords', 'resumptionToken': 'expired'})
+    assert not os.listdir(str(tmpdir))
+
+    # Harvest a bounded window, and verify that both of its pages are cached
+    with requests_mock.Mocker() as requests_mocker:
+        requests_mocker.post(ENDPOINT_URL, [
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_1.xml')},
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_2.xml')}
+        ])
+        until_datetime = parser.parse('2019-01-01T00:00:00')
+        assert len(oai_pmh_client.fetch_records_from(from_datetime, until_datetime)) == 3
+        assert len(oai_pmh_client.fetch_records_from(from_datetime, until_datetime)) == 3
+        assert requests_mocker.call_count == 2
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+def test_least_recently_used_responses_are_evicted(tmpdir):
+    # Allow room for two 10 byte responses
+    mock_transport = MockTransport(b'0123456789')
+    transport = CachingTransport(mock_transport, str(tmpdir), 25)
+    first, second, third = ({'verb': 'ListRecords', 'from': '2018-01-01T00:00:00Z', 'until': day}
+                            for day in ('2018-01-02', '2018-01-03', '2018-01-04'))
+    transport.request(ENDPOINT_URL, first)
+    transport.request(ENDPOINT_URL, second)
+
+    # Make the first response the most recently used, so the second one is evicted
+    paths = {name: os.path.join(str(tmpdir), name) for name in os.listdir(str(tmpdir))}
+    for i, path in enumerate(sorted(paths.values(), key=os.path.getmtime)):
+        os.utime(path, (1000 + i, 1000 + i))
+    transport.request(ENDPOINT_URL, first)
+    transport.request(ENDPOINT_URL, third)
+    assert len(os.listdir(str(tmpdir))) == 2
+
+    transport.request(ENDPOINT_URL, first)
+    transport.request(ENDPOINT_URL, second)
+    assert [params['until'] for params in mock_transport.requests] == \
+        ['2018-01-02', '2018-01-03', '2018-01-04', '2018-01-03']
+
+
+def test_responses_expire(tmpdir):
+    mock_transport = MockTransport()
+    transport = CachingTransport(mock_transport, str(tmpdir), 1024, ttl=60)
+    params = {'verb': 'ListRecords', 'from': '2018-01-01T00:00:00Z', 'until': '2018-01-02'}
+    transport.request(ENDPOINT_URL, dict(params))
+    transport.request(ENDPOINT_URL, dict(params))
+    assert len(mock_transport.requests) == 1
+
+    # Verify that a response written longer ago than the TTL is requested again, even though it
+    # has been used since
+    path = os.path.join(str(tmpdir), os.listdir(str(tmpdir))[0])
+    os.utime(path, (os.path.getatime(path), os.path.getmtime(path) - 61))
+    transport.request(ENDPOINT_URL, dict(params))
+    assert len(mock_transport.requests) == 2
+
+
+def test_rejected_token_drops_cached_window(tmpdir):
+    from_datetime = parser.parse('1970-01-01T00:00:00')
+    until_datetime = parser.parse('2019-01-01T00:00:00')
+    transport = CachingTransport(PooledHTTPTransport(), str(tmpdir), 1024 * 1024, ttl=60)
+    oai_pmh_client = OAIPMHClient(ENDPOINT_URL, transport=transport)
+    with requests_mock.Mocker() as requests_mocker:
+        requests_mocker.post(ENDPOINT_URL, [
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_1.xml')},
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_2.xml')}
+        ])
+        assert len(oai_pmh_client.fetch_records_from(from_datetime, until_datetime)) == 3
+
+    # Expire the second page only, so that the cached first page hands out a token the
+    # repository has since expired
+    first_page, second_page = sorted(
+        (os.path.join(str(tmpdir), name) for name in os.listdir(str(tmpdir))),
+        key=lambda path: b'resumptionToken="oai_dc/page-2"' in _get_file_bytes(path))
+    os.utime(second_page, (0, 0))
+
+    # Verify that the window is harvested again from the start, without repeating records
+    transport = CachingTransport(PooledHTTPTransport(), str(tmpdir), 1024 * 1024, ttl=60)
+    oai_pmh_client = OAIPMHClient(ENDPOINT_URL, transport=transport)
+    with requests_mock.Mocker() as requests_mocker:
+        requests_mocker.post(ENDPOINT_URL, [
+            {'content': _get_file_bytes('tests/app/data/bad_resumption_token_response.xml')},
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_1.xml')},
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_2.xml')}
+        ])
+        records = oai_pmh_client.fetch_records_from(from_datetime, until_datetime)
+        assert requests_mocker.call_count == 3
+    assert sorted(r['identifier'] for r in records) == [
+        'oai:dspace.text:test_handle/one',
+        'oai:dspace.text:test_handle/three',
+        'oai:dspace.text:test_handle/two'
+    ]
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+def test_replay_miss_raises(tmpdir):
+    mock_transport = MockTransport()
+    transport = CachingTransport(mock_transport, str(tmpdir), 1024, 'replay')
+    with pytest.raises(ResponseCacheMissError):
+        transport.request(ENDPOINT_URL, {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'})
+    assert not mock_transport.requests
+
+
+def test_harvest_replay(tmpdir):
+    from_datetime = parser.parse('1970-01-01T00:00:00')
+
+    # Harvest a paged response through the cache
+    with requests_mock.Mocker() as requests_mocker:
+        requests_mocker.post(ENDPOINT_URL, [
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_1.xml')},
+            {'content': _get_file_bytes('tests/app/data/oai_dc_response_page_2.xml')}
+        ])
+        oai_pmh_client = OAIPMHClient(
+            ENDPOINT_URL,
+            transport=CachingTransport(
+                PooledHTTPTransport(), str(tmpdir), 1024 * 1024, 'record')
+        )
+        records = oai_pmh_client.fetch_records_from(from_datetime)
+        assert requests_mocker.call_count == 2
+
+    # Verify that the same harvest can be replayed without touching the network
+    mock_transport = MockTransport()
+    oai_pmh_client = OAIPMHClient(
+        ENDPOINT_URL,
+        transport=CachingTransport(mock_transport, str(tmpdir), 1024 * 1024, 'replay')
+    )
+    replayed_records = oai_pmh_client.fetch_records_from(from_datetime)
+    assert not mock_transport.requests
+    assert [r['identifier'] for r in replayed_records] == [r['identifier'] for r in records]
+    assert len(replayed_records) == 3
+
+
+def _get_file_bytes(file_path):
+    with open(file_path, 'rb') as file:
+        return file.read()
@@ -0,0 +1,56 @@
+import pytest
+
+from app.oai_pmh_parser import IterparseRecordParser
+from app.oaiore.reader import oai_ore_reader
+from mock import patch
+from oaipmh.error import BadResumptionTokenError
+from oaipmh.metadata import oai_dc_reader
+from app import OAIPMHClient
+from dateutil import parser
+from tests.app.test_oaipmh_client import MockResponse, oai_response_to_prefix, _get_xml_file
+
+
+@pytest.mark.parametrize('file_path, metadata_prefix', [
+    ('tests/app/data/eprints-response.xml', 'oai_dc'),
+    ('tests/app/data/oai_dc_response.xml', 'oai_dc'),
+    ('tests/app/data/oai_dc_response_page_1.xml', 'oai_dc'),
+    ('tests/app/data/ore_response.xml', 'ore')
+])
+def test_parse_matches_dom(file_path, metadata_prefix):
+    # Create the parser we'll be testing against, and a DOM based client to compare it with
+    record_parser = IterparseRecordParser({'oai_dc': oai_dc_reader, 'ore': oai_ore_reader})
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request')
+    xml = _get_xml_file(file_path)
+
+    with patch('oaipmh.client.urllib2.urlopen') as mock_urlopen:
+        mock_urlopen.return_value = MockResponse(xml, 200, 'OK')
+        expected_records, expected_token = oai_pmh_client._request_page(
+            metadata_prefix, verb='ListRecords', metadataPrefix=metadata_prefix)
+
+    # Verify that both parsers produce exactly the same records and resumption token
+    records, token = record_parser.parse(metadata_prefix, xml)
+    assert records == expected_records
+    assert token == expected_token
+    assert records
+
+
+def test_parse_error():
+    record_parser = IterparseRecordParser({'oai_dc': oai_dc_reader})
+
+    # Verify that OAI-PMH errors are raised as the matching pyoai exception
+    with pytest.raises(BadResumptionTokenError):
+        record_parser.parse(
+            'oai_dc', _get_xml_file('tests/app/data/bad_resumption_token_response.xml'))
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_fetch_records_from_with_ore_and_iterparse(mock_urlopen):
+    oai_pmh_client = OAIPMHClient(
+        'http://dspace.test/dspace-oai/request', use_ore=True, parser='iterparse')
+    mock_urlopen.side_effect = oai_response_to_prefix
+
+    records = oai_pmh_client.fetch_records_from(parser.parse('1970-01-01T00:00:00'))
+    assert [r['file_locations'] for r in records] == [
+        ['https://dspace.text/bitstream/test_handle/{0}/2/TestFile{0}.pdf'.format(label)]
+        for label in ('one', 'two', 'three')
+    ]
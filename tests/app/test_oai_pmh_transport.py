@@ -0,0 +1,76 @@
+import gzip
+import requests_mock
+
+from app import OAIPMHClient
+from app import PooledHTTPTransport
+from dateutil import parser
+from mock import patch
+
+
+@requests_mock.mock()
+def test_request(*args):
+    # Get a handle on the mocker - see https://github.com/pytest-dev/pytest/issues/2749
+    requests_mocker = args[0]
+
+    # Create the transport we'll be testing against
+    transport = PooledHTTPTransport()
+
+    # Set up a gzip compressed mock response
+    response_data = _get_file_bytes('tests/app/data/oai_dc_response.xml')
+    requests_mocker.post(
+        'http://dspace.test/dspace-oai/request',
+        content=gzip.compress(response_data),
+        headers={'Content-Encoding': 'gzip'}
+    )
+
+    # Verify that the decompressed response is returned, and that compression was requested
+    content = transport.request('http://dspace.test/dspace-oai/request', {'verb': 'Identify'})
+    assert content == response_data
+    request = requests_mocker.request_history[0]
+    assert 'gzip' in request.headers['Accept-Encoding']
+    assert request.text == 'verb=Identify'
+
+    # Verify that the request was counted
+    assert transport.stats.requests == 1
+    assert transport.stats.content_bytes == len(response_data)
+    assert 0 < transport.stats.wire_bytes < len(response_data)
+
+
+@patch('app.oai_pmh_transport.time.sleep')
+@requests_mock.mock()
+def test_request_retry_after(*args):
+    mock_sleep, requests_mocker = args
+    transport = PooledHTTPTransport()
+
+    # The first response asks us to come back later
+    requests_mocker.post('http://dspace.test/dspace-oai/request', [
+        {'status_code': 503, 'headers': {'Retry-After': '3'}},
+        {'content': b'<OAI-PMH/>'}
+    ])
+    content = transport.request('http://dspace.test/dspace-oai/request', {'verb': 'Identify'})
+    assert content == b'<OAI-PMH/>'
+    mock_sleep.assert_called_once_with(3)
+
+
+@requests_mock.mock()
+def test_fetch_records_from_with_transport(*args):
+    requests_mocker = args[0]
+
+    # Create the OAI-PMH client with a pooled transport, rather than the default urllib one
+    oai_pmh_client = OAIPMHClient(
+        'http://eprints.test/cgi/oai2',
+        transport=PooledHTTPTransport()
+    )
+    requests_mocker.post(
+        'http://eprints.test/cgi/oai2',
+        content=_get_file_bytes('tests/app/data/eprints-response.xml')
+    )
+
+    records = oai_pmh_client.fetch_records_from(parser.parse('1970-01-01T00:00:00'))
+    assert len(records) == 1
+    assert records[0]['identifier'] == 'hdl:1765/1163'
+
+
+def _get_file_bytes(file_path):
+    with open(file_path, 'rb') as file:
+        return file.read()
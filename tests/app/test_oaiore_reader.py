@@ -0,0 +1,50 @@
+import pytest
+
+from lxml import etree
+from oaipmh.metadata import Error
+
+from app.oaiore.reader import OREMetadataReader, oai_ore_reader
+
+
+def _get_metadata_elements():
+    tree = etree.parse('tests/app/data/ore_response.xml')
+    return tree.xpath(
+        '//oai:metadata', namespaces={'oai': 'http://www.openarchives.org/OAI/2.0/'})
+
+
+def test_reader_converts_links():
+    metadata = oai_ore_reader(_get_metadata_elements()[0]).getMap()
+
+    # Verify that each link is converted to a dict of its attributes, as plain strings
+    assert len(metadata['link']) == 4
+    assert metadata['link'][0] == {
+        'rel': 'alternate',
+        'href': 'http://hdl.handle.net/test_handle/one'
+    }
+    assert {
+        'rel': 'http://www.openarchives.org/ore/terms/aggregates',
+        'href': 'https://dspace.text/bitstream/test_handle/one/2/TestFileone.pdf',
+        'title': 'TestFileone.pdf',
+        'type': 'application/pdf',
+        'length': '54363712'
+    } in metadata['link']
+    assert all(type(v) is str for link in metadata['link'] for v in link.values())
+
+
+def test_reader_converts_text_fields():
+    reader = OREMetadataReader(
+        fields={
+            'id': ('text', 'string(atom:entry/atom:id)'),
+            'titles': ('textList', 'atom:entry/atom:title/text()')
+        },
+        namespaces=oai_ore_reader._namespaces
+    )
+    metadata = reader(_get_metadata_elements()[0]).getMap()
+    assert type(metadata['id']) is str
+    assert all(type(title) is str for title in metadata['titles'])
+
+
+def test_reader_rejects_unknown_field_types():
+    # Unknown field types are now reported when the reader is created, not on the first record
+    with pytest.raises(Error):
+        OREMetadataReader(fields={'link': ('unknown', 'atom:entry/atom:link')})
@@ -1,3 +1,5 @@
+import itertools
+
 from mock import patch
 
 from app import OAIPMHClient
@@ -18,6 +20,19 @@ def oai_response_to_prefix(*args, **kwargs):
     return responses[prefix]
 
 
+def oai_response_to_page(*args, **kwargs):
+    """ Returns the first page of a paged oai_dc response, unless a resumption token is given in
+        which case the second page is returned.
+        """
+    resumption_token = parse_qs(args[0].data).get(b'resumptionToken')
+    if resumption_token == [b'oai_dc/expired']:
+        return MockResponse(
+            _get_xml_file('tests/app/data/bad_resumption_token_response.xml'), 200, 'OK')
+    if resumption_token:
+        return MockResponse(_get_xml_file('tests/app/data/oai_dc_response_page_2.xml'), 200, 'OK')
+    return MockResponse(_get_xml_file('tests/app/data/oai_dc_response_page_1.xml'), 200, 'OK')
+
+
 @patch('oaipmh.client.urllib2.urlopen')
 def test_fetch_records_from_with_ore(mock_urlopen):
     endpoint_url = 'http://dspace.test/dspace-oai/request'
@@ -142,6 +157,242 @@ def test_fetch_records_from(mock_urlopen):
                                     ' LIS.pdf'
 
 
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request')
+    mock_urlopen.side_effect = oai_response_to_page
+
+    # Consuming the stream should follow the resumption token onto the second page
+    records = list(oai_pmh_client.stream_records_from(parser.parse('1970-01-01T00:00:00')))
+    assert [r['identifier'] for r in records] == [
+        'oai:dspace.text:test_handle/one',
+        'oai:dspace.text:test_handle/two',
+        'oai:dspace.text:test_handle/three'
+    ]
+    assert mock_urlopen.call_count == 2
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_filters_pages(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request')
+    mock_urlopen.side_effect = oai_response_to_page
+    pages = []
+
+    def unprocessed_filter(identifiers):
+        pages.append(identifiers)
+        return [i for i in identifiers if not i.endswith('two')]
+
+    # Verify that each page's identifiers are filtered together
+    records = list(oai_pmh_client.stream_records_from(
+        parser.parse('1970-01-01T00:00:00'), unprocessed_filter=unprocessed_filter))
+    assert [r['identifier'] for r in records] == [
+        'oai:dspace.text:test_handle/one',
+        'oai:dspace.text:test_handle/three'
+    ]
+    assert [sorted(page) for page in pages] == [
+        ['oai:dspace.text:test_handle/one', 'oai:dspace.text:test_handle/two'],
+        ['oai:dspace.text:test_handle/three']
+    ]
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_stops_fetching_pages(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request')
+    mock_urlopen.side_effect = oai_response_to_page
+
+    # Only records from the first page are needed, so the second page should never be requested
+    records = oai_pmh_client.stream_records_from(parser.parse('1970-01-01T00:00:00'))
+    records = list(itertools.islice(records, 2))
+    assert len(records) == 2
+    assert mock_urlopen.call_count == 1
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_with_ore_joins_across_pages(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request', use_ore=True)
+
+    def oai_response_to_prefix_and_page(*args, **kwargs):
+        # The ORE records all arrive in one page, whilst the DC records are split over two
+        if parse_qs(args[0].data).get(b'metadataPrefix') == [b'ore']:
+            return oai_response_to_prefix(*args, **kwargs)
+        return oai_response_to_page(*args, **kwargs)
+    mock_urlopen.side_effect = oai_response_to_prefix_and_page
+
+    records = list(oai_pmh_client.stream_records_from(parser.parse('1970-01-01T00:00:00')))
+    assert sorted(r['identifier'] for r in records) == [
+        'oai:dspace.text:test_handle/one',
+        'oai:dspace.text:test_handle/three',
+        'oai:dspace.text:test_handle/two'
+    ]
+    for record in records:
+        assert record['oai_dc']['title']
+        assert len(record['file_locations']) == 1
+    assert mock_urlopen.call_count == 3
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_checkpoints_resumption_tokens(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request')
+    mock_urlopen.side_effect = oai_response_to_page
+    checkpoints = []
+
+    # Verify the token for the second page is checkpointed once the first page is consumed, and
+    # that the checkpoint is cleared once the harvest is complete
+    records = oai_pmh_client.stream_records_from(
+        parser.parse('1970-01-01T00:00:00'), checkpoint=checkpoints.append)
+    list(itertools.islice(records, 2))
+    assert checkpoints == []
+    next(records)
+    assert checkpoints == [{'oai_dc': 'oai_dc/page-2'}]
+    list(records)
+    assert checkpoints == [{'oai_dc': 'oai_dc/page-2'}, None]
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_resumption_token(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request')
+    mock_urlopen.side_effect = oai_response_to_page
+
+    # Resuming from the checkpointed token should only fetch the second page
+    records = list(oai_pmh_client.stream_records_from(
+        parser.parse('1970-01-01T00:00:00'), resumption_tokens={'oai_dc': 'oai_dc/page-2'}))
+    assert [r['identifier'] for r in records] == ['oai:dspace.text:test_handle/three']
+    assert mock_urlopen.call_count == 1
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_rejected_resumption_token(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request')
+    mock_urlopen.side_effect = oai_response_to_page
+
+    # A rejected token should restart the harvest from the beginning of the window
+    records = list(oai_pmh_client.stream_records_from(
+        parser.parse('1970-01-01T00:00:00'), resumption_tokens={'oai_dc': 'oai_dc/expired'}))
+    assert len(records) == 3
+    assert mock_urlopen.call_count == 3
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_rejected_resumption_token_mid_harvest(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request')
+    mock_urlopen.side_effect = [
+        MockResponse(_get_xml_file('tests/app/data/oai_dc_response_page_1.xml'), 200, 'OK'),
+        MockResponse(
+            _get_xml_file('tests/app/data/bad_resumption_token_response.xml'), 200, 'OK'),
+        MockResponse(_get_xml_file('tests/app/data/oai_dc_response_page_1.xml'), 200, 'OK'),
+        MockResponse(_get_xml_file('tests/app/data/oai_dc_response_page_2.xml'), 200, 'OK')
+    ]
+
+    # A token rejected after the first page restarts the harvest, without repeating records
+    records = list(oai_pmh_client.stream_records_from(parser.parse('1970-01-01T00:00:00')))
+    assert [r['identifier'] for r in records] == [
+        'oai:dspace.text:test_handle/one',
+        'oai:dspace.text:test_handle/two',
+        'oai:dspace.text:test_handle/three'
+    ]
+    assert mock_urlopen.call_count == 4
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_identifiers(mock_urlopen):
+    oai_pmh_client = OAIPMHClient(
+        'http://dspace.test/dspace-oai/request', use_ore=True, harvest_strategy='identifiers')
+    requested = []
+
+    def oai_response_to_verb(*args, **kwargs):
+        # List the identifiers first, then serve each GetRecord from the ListRecords responses
+        query = parse_qs(args[0].data)
+        requested.append((query[b'verb'][0], query.get(b'identifier', [b''])[0]))
+        if query[b'verb'] == [b'ListIdentifiers']:
+            return MockResponse(
+                _get_xml_file('tests/app/data/oai_dc_identifiers_response.xml'), 200, 'OK')
+        return oai_response_to_prefix(*args, **kwargs)
+    mock_urlopen.side_effect = oai_response_to_verb
+
+    # Pretend the second record has already been processed
+    records = list(oai_pmh_client.stream_records_from(
+        parser.parse('1970-01-01T00:00:00'),
+        unprocessed_filter=lambda identifiers: [i for i in identifiers if not i.endswith('two')]
+    ))
+    assert [r['identifier'] for r in records] == [
+        'oai:dspace.text:test_handle/one',
+        'oai:dspace.text:test_handle/three'
+    ]
+    assert records[1]['file_locations'] == [
+        'https://dspace.text/bitstream/test_handle/three/2/TestFilethree.pdf']
+
+    # Verify that neither the processed nor the deleted record were fetched
+    assert requested == [
+        (b'ListIdentifiers', b''),
+        (b'GetRecord', b'oai:dspace.text:test_handle/one'),
+        (b'GetRecord', b'oai:dspace.text:test_handle/one'),
+        (b'GetRecord', b'oai:dspace.text:test_handle/three'),
+        (b'GetRecord', b'oai:dspace.text:test_handle/three')
+    ]
+
+
+def oai_response_to_set(*args, **kwargs):
+    """ Lists two sets, serving a paged response for the community and the whole response for
+        the collection, so that every record in the collection is also in the community.
+        """
+    query = parse_qs(args[0].data)
+    if query[b'verb'] == [b'ListSets']:
+        return MockResponse(_get_xml_file('tests/app/data/oai_dc_sets_response.xml'), 200, 'OK')
+    if query.get(b'set') == [b'col_10023_53']:
+        return MockResponse(_get_xml_file('tests/app/data/oai_dc_response.xml'), 200, 'OK')
+    return oai_response_to_page(*args, **kwargs)
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_sets(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request', set_workers=2)
+    mock_urlopen.side_effect = oai_response_to_set
+    completed_sets = []
+
+    records = list(oai_pmh_client.stream_records_from(
+        parser.parse('1970-01-01T00:00:00'), set_complete=completed_sets.append))
+
+    # Verify that each record is only streamed once, tagged with the set it was found in
+    assert sorted(r['identifier'] for r in records) == [
+        'oai:dspace.text:test_handle/one',
+        'oai:dspace.text:test_handle/three',
+        'oai:dspace.text:test_handle/two'
+    ]
+    assert all(r['set_spec'] in ('com_10023_51', 'col_10023_53') for r in records)
+    assert sorted(completed_sets) == ['col_10023_53', 'com_10023_51']
+    assert mock_urlopen.call_count == 4
+
+    # Verify that harvesting another window doesn't list the sets again
+    list(oai_pmh_client.stream_records_from(parser.parse('1970-01-01T00:00:00')))
+    verbs = [parse_qs(c[0][0].data)[b'verb'][0] for c in mock_urlopen.call_args_list]
+    assert verbs.count(b'ListSets') == 1
+
+
+@patch('oaipmh.client.urllib2.urlopen')
+def test_stream_records_from_sets_with_watermarks(mock_urlopen):
+    oai_pmh_client = OAIPMHClient('http://dspace.test/dspace-oai/request', set_workers=2)
+    mock_urlopen.side_effect = oai_response_to_set
+
+    # The community has already been harvested to the end of the window, and the collection
+    # part of the way through it
+    records = list(oai_pmh_client.stream_records_from(
+        parser.parse('1970-01-01T00:00:00'),
+        parser.parse('2019-01-01T00:00:00'),
+        set_watermarks={
+            'com_10023_51': parser.parse('2019-01-01T00:00:00'),
+            'col_10023_53': parser.parse('2018-01-01T00:00:00')
+        }
+    ))
+    assert len(records) == 3
+    assert all(r['set_spec'] == 'col_10023_53' for r in records)
+
+    # Verify that only the collection was harvested, from its own watermark
+    assert mock_urlopen.call_count == 2
+    query = parse_qs(mock_urlopen.call_args[0][0].data)
+    assert query[b'set'] == [b'col_10023_53']
+    assert query[b'from'] == [b'2018-01-01T00:00:00Z']
+
+
 def _get_xml_file(file_path):
     return minidom.parse(file_path).toxml()
 
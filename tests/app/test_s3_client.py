@@ -1,7 +1,19 @@
+import base64
 import boto3
+import hashlib
+import io
+import os
+import pytest
 
 from moto import mock_s3
+from unittest.mock import patch
+from app import DigestIndex
 from app import S3Client
+from app.download_client import IncompleteDownloadError
+from app.download_client import PartDigests
+from app.download_client import TransferWatchdog
+from app.download_client import WatchedReader
+from app.s3_client import UploadIntegrityError
 
 
 @mock_s3
@@ -19,7 +31,7 @@ def test_push_to_bucket():
         'tests/app/data/smiling.png'
     )
     assert object_metadata is not None
-    assert len(object_metadata) == 5
+    assert len(object_metadata) == 6
 
     # Verify the fields returned match what is expected
     assert object_metadata['file_name'] == 'file.dat'
@@ -28,3 +40,284 @@ def test_push_to_bucket():
     assert object_metadata['file_checksum'] == 'DJomkLQb4mYNsqra0T2/BQ=='
     assert object_metadata['download_url'] == 's3://rdss-prints-adaptor-test-bucket' \
                                               '/download/file.dat'
+    assert object_metadata['etag'] == '"0c9a2690b41be2660db2aadad13dbf05"'
+
+
+@mock_s3
+def test_push_to_bucket_with_checksums():
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket')
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+
+    # Push the file with checksums calculated while it was downloaded, so it isn't read for them
+    sha256_checksum = hashlib.sha256(open('tests/app/data/smiling.png', 'rb').read()).hexdigest()
+    s3_client._calculate_file_checksum = None
+    object_metadata = s3_client.push_to_bucket(
+        'http://eprints.test/download/file.dat',
+        'tests/app/data/smiling.png',
+        'DJomkLQb4mYNsqra0T2/BQ==',
+        sha256_checksum
+    )
+    assert object_metadata['file_checksum'] == 'DJomkLQb4mYNsqra0T2/BQ=='
+    assert object_metadata['file_checksum_sha256'] == sha256_checksum
+    s3_object = conn.Object('rdss-prints-adaptor-test-bucket', 'download/file.dat').get()
+    assert s3_object['Metadata'] == {
+        'md5chksum': 'DJomkLQb4mYNsqra0T2/BQ==',
+        'sha256chksum': sha256_checksum
+    }
+
+
+@mock_s3
+def test_push_data_to_bucket():
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket')
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+    with open('tests/app/data/smiling.png', 'rb') as f:
+        data = f.read()
+
+    object_metadata = s3_client.push_data_to_bucket(
+        'http://eprints.test/download/file.dat', data, 'DJomkLQb4mYNsqra0T2/BQ==')
+    assert object_metadata['file_size'] == 17280
+    assert object_metadata['file_checksum'] == 'DJomkLQb4mYNsqra0T2/BQ=='
+    s3_object = conn.Object('rdss-prints-adaptor-test-bucket', 'download/file.dat').get()
+    assert s3_object['Body'].read() == data
+
+
+@mock_s3
+def test_push_stream_to_bucket():
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket')
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+
+    # Stream a file smaller than one part, and verify it matches pushing the file itself
+    with open('tests/app/data/smiling.png', 'rb') as stream:
+        object_metadata = s3_client.push_stream_to_bucket(
+            'http://eprints.test/download/file.dat', stream)
+    assert object_metadata['file_path'] == 'download/file.dat'
+    assert object_metadata['file_size'] == 17280
+    assert object_metadata['file_checksum'] == 'DJomkLQb4mYNsqra0T2/BQ=='
+    s3_object = conn.Object('rdss-prints-adaptor-test-bucket', 'download/file.dat').get()
+    assert s3_object['Metadata']['md5chksum'] == 'DJomkLQb4mYNsqra0T2/BQ=='
+
+
+@mock_s3
+def test_push_stream_to_bucket_truncated():
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket', part_size=5 * 1024 * 1024)
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+
+    # Verify that neither a small nor a multipart stream that ends short of its length is kept
+    for size in (1024, 11 * 1024 * 1024):
+        stream = WatchedReader(io.BytesIO(os.urandom(size)),
+                               TransferWatchdog('http://eprints.test/download/file.dat'),
+                               size + 1)
+        with pytest.raises(IncompleteDownloadError):
+            s3_client.push_stream_to_bucket('http://eprints.test/download/file.dat', stream)
+    assert not list(conn.Bucket('rdss-prints-adaptor-test-bucket').objects.all())
+
+
+@mock_s3
+def test_push_stream_to_bucket_multipart():
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket', part_size=5 * 1024 * 1024)
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+
+    # Stream 11MB in short reads, as an HTTP response would, so it is sent in three parts
+    data = os.urandom(11 * 1024 * 1024)
+    stream = io.BytesIO(data)
+    short_read = stream.read
+    stream.read = lambda size: short_read(min(size, 64 * 1024))
+    object_metadata = s3_client.push_stream_to_bucket(
+        'http://eprints.test/download/large.dat', stream)
+
+    # Verify that the whole object arrived, with the checksum of the whole stream
+    assert object_metadata['file_size'] == len(data)
+    assert object_metadata['file_checksum'] == \
+        base64.b64encode(hashlib.md5(data).digest()).decode('utf-8')
+    s3_object = conn.Object('rdss-prints-adaptor-test-bucket', 'download/large.dat').get()
+    assert s3_object['Body'].read() == data
+    assert s3_object['ETag'].endswith('-3"')
+
+
+@mock_s3
+def test_push_to_bucket_multipart(tmpdir):
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket', part_size=5 * 1024 * 1024,
+                         upload_concurrency=3, multipart_threshold=5 * 1024 * 1024)
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+    data = os.urandom(11 * 1024 * 1024)
+    file_path = str(tmpdir.join('large.dat'))
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    md5_checksum = base64.b64encode(hashlib.md5(data).digest()).decode('utf-8')
+
+    # Verify that a file over the threshold is uploaded in parts, keeping its checksum metadata
+    object_metadata = s3_client.push_to_bucket(
+        'http://eprints.test/download/large.dat', file_path, md5_checksum)
+    assert object_metadata['file_size'] == len(data)
+    assert object_metadata['file_checksum'] == md5_checksum
+    s3_object = conn.Object('rdss-prints-adaptor-test-bucket', 'download/large.dat').get()
+    assert s3_object['Body'].read() == data
+    assert s3_object['ETag'].endswith('-3"')
+    assert s3_object['Metadata'] == {'md5chksum': md5_checksum}
+
+
+@mock_s3
+def test_multipart_upload_etag_mismatch():
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket')
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+    conn.Object('rdss-prints-adaptor-test-bucket', 'download/large.dat').put(Body=b'data')
+    digests = [hashlib.md5(b'part').digest()]
+    parts = [{'ETag': '"{}"'.format(digests[0].hex()), 'PartNumber': 1}]
+
+    # Verify that an object that isn't made of the parts that were sent is removed
+    with pytest.raises(UploadIntegrityError):
+        s3_client._verify_multipart_etag('download/large.dat', '"0-1"', parts, digests)
+    assert not list(conn.Bucket('rdss-prints-adaptor-test-bucket').objects.all())
+
+
+@mock_s3
+def test_multipart_upload_part_etag_mismatch(tmpdir):
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket', part_size=5 * 1024 * 1024,
+                         multipart_threshold=5 * 1024 * 1024)
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+    file_path = tmpdir.join('large.dat')
+    file_path.write_binary(os.urandom(6 * 1024 * 1024))
+    upload_part = s3_client._upload_part
+
+    def _upload_part(*args):
+        part, digest = upload_part(*args)
+        return dict(part, ETag='"{}"'.format(hashlib.md5(b'other').hexdigest())), digest
+    s3_client._upload_part = _upload_part
+
+    # Verify that a part S3 didn't store as sent aborts the upload
+    with pytest.raises(UploadIntegrityError):
+        s3_client.push_to_bucket('http://eprints.test/download/large.dat', str(file_path))
+    assert not list(conn.Bucket('rdss-prints-adaptor-test-bucket').objects.all())
+    assert not s3_client.client.list_multipart_uploads(
+        Bucket='rdss-prints-adaptor-test-bucket').get('Uploads')
+
+
+def test_upload_concurrency_must_be_positive():
+    with pytest.raises(ValueError):
+        S3Client('rdss-prints-adaptor-test-bucket', upload_concurrency=0)
+
+
+@mock_s3
+def test_audit_objects():
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket')
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+    s3_objects = [
+        s3_client.push_data_to_bucket(
+            'http://eprints.test/download/{}.dat'.format(name), data,
+            base64.b64encode(hashlib.md5(data).digest()).decode('utf-8'))
+        for name, data in (('first', b'first'), ('second', b'second'), ('third', b'third'))
+    ]
+    assert not s3_client.audit_objects(s3_objects)
+
+    # Verify that objects that were changed or removed since they were uploaded are found
+    conn.Object('rdss-prints-adaptor-test-bucket', 'download/second.dat').put(Body=b'changed')
+    conn.Object('rdss-prints-adaptor-test-bucket', 'download/third.dat').delete()
+    assert s3_client.audit_objects(s3_objects) == s3_objects[1:]
+    with pytest.raises(UploadIntegrityError):
+        s3_client.verify_objects(s3_objects)
+
+
+@mock_s3
+def test_push_to_bucket_content_addressed(tmpdir):
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket', digest_index=DigestIndex())
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+    data = b'licence'
+    md5_checksum = base64.b64encode(hashlib.md5(data).digest()).decode('utf-8')
+    file_path = tmpdir.join('licence.pdf')
+    file_path.write_binary(data)
+
+    # Push the same file for two records, and verify that it's only uploaded once
+    first = s3_client.push_to_bucket('http://eprints.test/1/licence.pdf', str(file_path))
+    s3_client.client = None
+    second = s3_client.push_data_to_bucket(
+        'http://eprints.test/2/licence.txt', data, md5_checksum)
+    key = 'content/{}-7'.format(hashlib.md5(data).hexdigest())
+    assert [o.key for o in conn.Bucket('rdss-prints-adaptor-test-bucket').objects.all()] == [key]
+    assert first['file_path'] == second['file_path'] == key
+    assert first['download_url'] == 's3://rdss-prints-adaptor-test-bucket/' + key
+    assert first['etag'] == second['etag']
+    assert first['file_name'] == 'licence.pdf'
+    assert second['file_name'] == 'licence.txt'
+    assert s3_client.digest_index.hits == 1
+
+    # Verify that content-addressed objects are audited without listing the whole store
+    s3_client.client = boto3.client('s3')
+    assert not s3_client.audit_objects([first])
+
+
+@mock_s3
+def test_push_to_bucket_skip_unchanged(tmpdir):
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+    small_path = tmpdir.join('small.dat')
+    small_path.write_binary(b'small')
+    large_path = tmpdir.join('large.dat')
+    large_path.write_binary(os.urandom(6 * 1024 * 1024))
+    small_url = 'http://eprints.test/download/small.dat'
+    large_url = 'http://eprints.test/download/large.dat'
+    S3Client('rdss-prints-adaptor-test-bucket').push_to_bucket(small_url, str(small_path))
+    s3_client = S3Client('rdss-prints-adaptor-test-bucket', part_size=5 * 1024 * 1024,
+                         multipart_threshold=5 * 1024 * 1024, skip_unchanged=True)
+    large_object = s3_client.push_to_bucket(large_url, str(large_path))
+
+    # Verify that files already in the bucket aren't uploaded again, whether they were found by
+    # listing the bucket or uploaded since
+    with patch.object(s3_client.client, 'put_object', side_effect=AssertionError), \
+            patch.object(s3_client.client, 'create_multipart_upload', side_effect=AssertionError):
+        assert s3_client.push_to_bucket(small_url, str(small_path))['file_size'] == 5
+        assert s3_client.push_to_bucket(large_url, str(large_path)) == large_object
+    assert s3_client.bucket_index.hits == 2
+    assert s3_client.bucket_index.listed_prefixes == {'download/'}
+
+    # Verify that a changed file is uploaded
+    small_path.write_binary(b'changed')
+    s3_client.push_to_bucket(small_url, str(small_path))
+    assert conn.Object('rdss-prints-adaptor-test-bucket', 'download/small.dat').get()[
+        'Body'].read() == b'changed'
+
+
+@mock_s3
+def test_push_to_bucket_skip_unchanged_multipart(tmpdir):
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket='rdss-prints-adaptor-test-bucket')
+    data = os.urandom(6 * 1024 * 1024)
+    file_path = tmpdir.join('large.dat')
+    file_path.write_binary(data)
+    url = 'http://eprints.test/download/large.dat'
+    part_digests = PartDigests(5 * 1024 * 1024)
+    part_digests.update(data)
+
+    def new_client():
+        return S3Client('rdss-prints-adaptor-test-bucket', part_size=5 * 1024 * 1024,
+                        multipart_threshold=5 * 1024 * 1024, skip_unchanged=True)
+
+    def assert_skipped(s3_client, part_digests, head_object_calls):
+        with patch.object(s3_client.client, 'put_object', side_effect=AssertionError), \
+                patch.object(s3_client.client, 'create_multipart_upload',
+                             side_effect=AssertionError), \
+                patch.object(s3_client.client, 'head_object',
+                             wraps=s3_client.client.head_object) as head_object:
+            s3_client.push_to_bucket(url, str(file_path), part_digests=part_digests)
+        assert head_object.call_count == head_object_calls
+
+    # Verify that an object uploaded in one request matches, however big it is
+    conn.Object('rdss-prints-adaptor-test-bucket', 'download/large.dat').put(Body=data)
+    assert_skipped(new_client(), part_digests, 0)
+
+    # Verify that an object uploaded in parts matches the file's part digests, or failing that
+    # the MD5 checksum stored in its metadata
+    conn.Object('rdss-prints-adaptor-test-bucket', 'download/large.dat').delete()
+    new_client().push_to_bucket(url, str(file_path))
+    assert_skipped(new_client(), part_digests, 0)
+    assert_skipped(new_client(), None, 1)
+    assert_skipped(new_client(), PartDigests(6 * 1024 * 1024), 1)
@@ -2,9 +2,12 @@ import json
 import os
 import run
 import datetime
+import pytest
 
 from app import OAIPMHClient
 from app import DownloadClient
+from app import DownloadResult
+from app import DownloadTimeoutError
 from app import DynamoDBClient
 from app import KinesisClient
 from app import MessageGenerator
@@ -12,7 +15,7 @@ from app import MessageValidator
 from app import PoisonPill
 from app import S3Client
 from dateutil import parser
-from mock import MagicMock, patch
+from mock import ANY, MagicMock, patch
 
 
 @patch('run._initialise_download_client')
@@ -61,14 +64,21 @@ def test_main(_initialise_s3_client, _initialise_message_validator, _initialise_
 
     # Validate that the appropriate calls were made
     mock_dynamodb_client.fetch_high_watermark.assert_called_once_with()
-    # mock_oai_pmh_client.fetch_records_from.assert_called_once_with('1970-01-01T00:00:00')
-    mock_dynamodb_client.fetch_processed_status.assert_called_once_with('test-identifier')
+    # mock_oai_pmh_client.stream_records_from.assert_called_once_with('1970-01-01T00:00:00')
+    unprocessed_filter = mock_oai_pmh_client.stream_records_from.call_args_list[0][0][4]
+    assert unprocessed_filter(['test-identifier', 'processed-identifier']) == ['test-identifier']
+    mock_dynamodb_client.fetch_processed_statuses.assert_called_once_with(
+        ['test-identifier', 'processed-identifier'])
     mock_download_client.download_file.assert_called_once_with(
-        'http://eprints.test/download/file.dat'
+        'http://eprints.test/download/file.dat',
+        deadline=ANY
     )
     mock_s3_client.push_to_bucket.assert_called_once_with(
         'http://eprints.test/download/file.dat',
-        '/path/to/file.dat'
+        '/path/to/file.dat',
+        'DJomkLQb4mYNsqra0T2/BQ==',
+        None,
+        None
     )
     mock_message_generator.generate_metadata_create.assert_called_once_with(
         {
@@ -103,6 +113,92 @@ def test_main(_initialise_s3_client, _initialise_message_validator, _initialise_
     )
 
 
+@patch('run._initialise_download_client')
+@patch('run._initialise_dynamodb_client')
+@patch('run._initialise_oai_pmh_client')
+@patch('run._initialise_kinesis_client')
+@patch('run._initialise_message_generator')
+@patch('run._initialise_message_validator')
+@patch('run._initialise_s3_client')
+@pytest.mark.parametrize('checkpoint_watermark, expected_window', [
+    # The interrupted harvest started from the current high watermark, so carries on from the
+    # checkpoint rather than starting the walk again
+    (datetime.datetime(2000, 1, 1, 0, 0, 1),
+     (datetime.datetime(2015, 1, 1), datetime.datetime(2015, 6, 1), {'oai_dc': 'oai_dc/page-2'})),
+    # The high watermark has been reset since, so the walk starts again from it
+    (datetime.datetime(2016, 1, 1, 0, 0, 1),
+     (datetime.datetime(2000, 1, 1, 0, 0, 1), ANY, None)),
+    # The checkpoint was taken before high watermarks were recorded with checkpoints
+    (None, (datetime.datetime(2000, 1, 1, 0, 0, 1), ANY, None))
+])
+def test_main_resumes_harvest_checkpoint(
+        _initialise_s3_client, _initialise_message_validator, _initialise_message_generator,
+        _initialise_kinesis_client, _initialise_oai_pmh_client, _initialise_dynamodb_client,
+        _initialise_download_client, checkpoint_watermark, expected_window):
+    _initialise_env_variables()
+    _initialise_download_client.return_value = _mock_download_client()
+    _initialise_kinesis_client.return_value = _mock_kinesis_client()
+    _initialise_message_generator.return_value = _mock_message_generator()
+    _initialise_message_validator.return_value = _mock_message_validator()
+    _initialise_s3_client.return_value = _mock_s3_client()
+    mock_oai_pmh_client = _mock_oai_pmh_client()
+    _initialise_oai_pmh_client.return_value = mock_oai_pmh_client
+
+    # The interrupted harvest was of a window some way past the high watermark
+    mock_dynamodb_client = _mock_dynamodb_client()
+    mock_dynamodb_client.fetch_high_watermark.return_value = datetime.datetime(2000, 1, 1, 0, 0, 1)
+    mock_dynamodb_client.fetch_harvest_checkpoint.return_value = {
+        'from': datetime.datetime(2015, 1, 1),
+        'until': datetime.datetime(2015, 6, 1),
+        'resumption_tokens': {'oai_dc': 'oai_dc/page-2'},
+        'high_watermark': checkpoint_watermark
+    }
+    _initialise_dynamodb_client.return_value = mock_dynamodb_client
+
+    run.main()
+
+    args = mock_oai_pmh_client.stream_records_from.call_args_list[0][0]
+    assert args[:3] == expected_window
+    mock_dynamodb_client.update_high_watermark.assert_called_once_with(
+        parser.parse('2004-02-16T14:10:55')
+    )
+
+
+@patch('run._initialise_download_client')
+@patch('run._initialise_dynamodb_client')
+@patch('run._initialise_oai_pmh_client')
+@patch('run._initialise_kinesis_client')
+@patch('run._initialise_message_generator')
+@patch('run._initialise_message_validator')
+@patch('run._initialise_s3_client')
+def test_main_holds_watermark_for_timed_out_record(
+        _initialise_s3_client, _initialise_message_validator, _initialise_message_generator,
+        _initialise_kinesis_client, _initialise_oai_pmh_client, _initialise_dynamodb_client,
+        _initialise_download_client):
+    _initialise_env_variables()
+    mock_download_client = _mock_download_client()
+    mock_download_client.download_file.side_effect = DownloadTimeoutError(
+        'Download of http://eprints.test/download/file.dat ran past its deadline')
+    _initialise_download_client.return_value = mock_download_client
+    mock_kinesis_client = _mock_kinesis_client()
+    _initialise_kinesis_client.return_value = mock_kinesis_client
+    _initialise_message_generator.return_value = _mock_message_generator()
+    _initialise_message_validator.return_value = _mock_message_validator()
+    _initialise_s3_client.return_value = _mock_s3_client()
+    _initialise_oai_pmh_client.return_value = _mock_oai_pmh_client()
+    mock_dynamodb_client = _mock_dynamodb_client()
+    _initialise_dynamodb_client.return_value = mock_dynamodb_client
+
+    run.main()
+
+    # Verify that the record is marked as failed, but the high watermark isn't moved past it, so
+    # that it's harvested again by the next run
+    mock_dynamodb_client.update_processed_record.assert_called_once_with(
+        'test-identifier', ANY, 'Failure', ANY)
+    mock_kinesis_client.put_invalid_message_on_queue.assert_called_once_with(ANY)
+    mock_dynamodb_client.update_high_watermark.assert_not_called()
+
+
 def _initialise_env_variables():
     os.environ['OAI_PMH_ENDPOINT_URL'] = 'http://eprints.test/cgi/oai2'
     os.environ['OAI_PMH_PROVIDER'] = 'eprints'
@@ -119,7 +215,8 @@ def _initialise_env_variables():
 
 def _mock_download_client():
     mock_download_client = DownloadClient()
-    mock_download_client.download_file = MagicMock(return_value='/path/to/file.dat')
+    mock_download_client.download_file = MagicMock(
+        return_value=DownloadResult('/path/to/file.dat', 17280, 'DJomkLQb4mYNsqra0T2/BQ=='))
     return mock_download_client
 
 
@@ -131,15 +228,19 @@ def _mock_dynamodb_client():
     mock_dynamodb_client.fetch_high_watermark = MagicMock(
         return_value=datetime.datetime(1970, 1, 1, 0, 0, 0))
     mock_dynamodb_client.update_high_watermark = MagicMock(return_value=None)
-    mock_dynamodb_client.fetch_processed_status = MagicMock(return_value=None)
+    mock_dynamodb_client.fetch_harvest_checkpoint = MagicMock(return_value=None)
+    mock_dynamodb_client.update_harvest_checkpoint = MagicMock(return_value=None)
+    mock_dynamodb_client.clear_harvest_checkpoint = MagicMock(return_value=None)
+    mock_dynamodb_client.fetch_processed_statuses = MagicMock(
+        return_value={'processed-identifier': 'Success'})
     mock_dynamodb_client.update_processed_record = MagicMock(return_value=None)
     return mock_dynamodb_client
 
 
 def _mock_oai_pmh_client():
     mock_oai_pmh_client = OAIPMHClient('http://eprints.test/cgi/oai2')
-    mock_oai_pmh_client.fetch_records_from = MagicMock(
-        return_value=[
+    mock_oai_pmh_client.stream_records_from = MagicMock(
+        return_value=iter([
             {
                 'identifier': 'test-identifier',
                 'datestamp': parser.parse('2004-02-16T14:10:55'),
@@ -157,7 +258,7 @@ def _mock_oai_pmh_client():
                 },
                 'file_locations': ['http://eprints.test/download/file.dat'],
             }
-        ]
+        ])
     )
     return mock_oai_pmh_client
 